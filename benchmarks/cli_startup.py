@@ -0,0 +1,116 @@
+"""
+Startup time of CLI commands, each measured in a fresh interpreter running `<command> --help`,
+exits with 1 if a command is slower than --max-ms or imports a module it shouldn't
+
+    python -m benchmarks.cli_startup
+    python -m benchmarks.cli_startup --command suumo --max-ms 800
+"""
+
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+import click
+
+log = logging.getLogger(__name__)
+
+HEAVY_MODULES = [
+    "pandas",
+    "numpy",
+    "xgboost",
+    "sklearn",
+    "googlemaps",
+    "bs4",
+    "jismesh",
+]
+# Command -> modules which shouldn't be imported for its --help
+DEFAULT_COMMANDS = {
+    "": HEAVY_MODULES + ["pymongo", "pydantic_settings"],
+    "suumo": HEAVY_MODULES + ["pymongo", "pydantic_settings"],
+    "train": HEAVY_MODULES,
+    "score": HEAVY_MODULES,
+    "serve": HEAVY_MODULES,
+    "import-trading-api": HEAVY_MODULES,
+    "ensure-indexes": HEAVY_MODULES + ["pymongo", "pydantic_settings"],
+    "listing-history backfill": HEAVY_MODULES,
+    "enrich work": HEAVY_MODULES + ["pymongo", "pydantic_settings"],
+    "enrich stream": HEAVY_MODULES + ["pymongo", "pydantic_settings"],
+    "gis-import": HEAVY_MODULES + ["pymongo"],
+    "gis-import bus-stop": HEAVY_MODULES,
+    "gis-import export-snapshot": HEAVY_MODULES,
+    "gis-import export-raster": HEAVY_MODULES,
+    "trading-rollup": ["xgboost", "sklearn", "googlemaps", "bs4", "jismesh"],
+}
+
+SCRIPT = """
+import json, sys
+from domus_analytica.cli import app
+try:
+    app(sys.argv[1:] + ["--help"], prog_name="domus-analytica")
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)), file=sys.stderr)
+"""
+
+
+def measure(command: str) -> Tuple[float, List[str]]:
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT, *command.split()],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result.stderr.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option(
+    "--command",
+    "commands",
+    multiple=True,
+    help="Commands to measure, e.g. 'gis-import bus-stop', default to a preset list",
+)
+@click.option("--repeat", default=5, type=int, show_default=True)
+@click.option(
+    "--max-ms",
+    default=None,
+    type=float,
+    help="Fail if the median startup time of a command exceeds it",
+)
+def main(commands: Tuple[str], repeat: int, max_ms: float):
+    logging.basicConfig(level=logging.INFO)
+    failed = False
+    for command in commands or DEFAULT_COMMANDS.keys():
+        timings = []
+        modules: List[str] = []
+        for _ in range(repeat):
+            elapsed, modules = measure(command)
+            timings.append(elapsed * 1000)
+        median = statistics.median(timings)
+        forbidden = [
+            m
+            for m in DEFAULT_COMMANDS.get(command, [])
+            if any(x == m or x.startswith(f"{m}.") for x in modules)
+        ]
+        log.info(
+            f"{command or '(group)':<24} median={median:.0f}ms min={min(timings):.0f}ms "
+            f"modules={len(modules)}"
+        )
+        if forbidden:
+            failed = True
+            log.error(f"{command or '(group)'} imported {forbidden}")
+        if max_ms is not None and median > max_ms:
+            failed = True
+            log.error(f"{command or '(group)'} is slower than {max_ms}ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+End-to-end throughput of the crawler against the local SUUMO stand-in
+
+    python -m benchmarks.crawler_load --listings 500 --latency-ms 100 --throttle-rate 0.05
+    python -m benchmarks.crawler_load --concurrency 4 --passes 2 --use-cache
+    python -m benchmarks.crawler_load --command --mongo-uri mongodb://localhost:27017
+
+By default SuumoSpider is driven directly with an in-memory page cache, --concurrency spiders
+read detail pages in parallel. With --command, `domus-analytica suumo --detailed` runs as is and
+writes to --mongo-db, which is dropped first.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import click
+
+from benchmarks.suumo_server import SEARCH_PATH, StandInSettings, start_server
+from domus_analytica.spider import BasePageCache, SuumoSpider
+
+log = logging.getLogger(__name__)
+
+
+class MemoryPageCache(BasePageCache):
+    def __init__(self):
+        self.pages: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def get_cache(self, filename: str) -> Optional[bytes]:
+        with self._lock:
+            return self.pages.get(filename)
+
+    def set_cache(self, filename: str, data: bytes):
+        with self._lock:
+            self.pages[filename] = data
+
+
+def crawl(
+    base_url: str,
+    cache: MemoryPageCache,
+    concurrency: int,
+    use_cache: bool,
+    **spider_options,
+) -> Dict[str, int]:
+    """
+    Read every search page, then read and parse the detail pages with `concurrency` spiders
+    :return: counts of listings, requests retried and listings failed
+    """
+
+    def new_spider() -> SuumoSpider:
+        return SuumoSpider(
+            cache=cache, use_cache=use_cache, base_url=base_url, **spider_options
+        )
+
+    search_spider = new_spider()
+    items = list(search_spider.iter_search_results(SEARCH_PATH, {"ar": ["030"]}))
+    local = threading.local()
+    spiders = [search_spider]
+
+    def read_detail(item: dict) -> bool:
+        if not hasattr(local, "spider"):
+            local.spider = new_spider()
+            spiders.append(local.spider)
+        try:
+            local.spider.parse_detail_page(local.spider.read_detail_page(item["url"]))
+            return True
+        except Exception as ex:
+            log.debug(f"Failed to read {item['url']}", exc_info=ex)
+            return False
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        succeeded = sum(executor.map(read_detail, items))
+    return {
+        "listings": succeeded,
+        "failed": len(items) - succeeded,
+        "retries": sum(s.retries for s in spiders),
+    }
+
+
+def run_command(base_url: str, mongo_uri: str, mongo_db: str, **spider_options) -> int:
+    from domus_analytica.cli import app
+    from domus_analytica.mongo import get_database
+
+    db = get_database(mongo_uri, mongo_db)
+    db.client.drop_database(mongo_db)
+    os.environ.update(MONGO_URI=mongo_uri, MONGO_DB_NAME=mongo_db)
+    # Required by DomusSettings but unused by the crawler
+    os.environ.setdefault("GOOGLE_API_KEY", "unused")
+    os.environ.setdefault("REINFOLIB_API_KEY", "unused")
+    app.main(
+        [
+            "suumo",
+            "--detailed",
+            "--base-url",
+            base_url,
+            "--search-url",
+            f"{base_url}{SEARCH_PATH}?ar=030",
+            "--wait-interval",
+            str(spider_options["wait_interval"]),
+            "--max-retries",
+            str(spider_options["max_retries"]),
+        ],
+        prog_name="domus-analytica",
+        standalone_mode=False,
+    )
+    return db.get_collection("suumo_details").count_documents({})
+
+
+@click.command()
+@click.option("--listings", default=500, type=int, show_default=True)
+@click.option("--latency-ms", default=50.0, type=float, show_default=True)
+@click.option("--latency-jitter-ms", default=20.0, type=float, show_default=True)
+@click.option("--error-rate", default=0.0, type=float, show_default=True)
+@click.option("--throttle-rate", default=0.0, type=float, show_default=True)
+@click.option("--max-rps", default=None, type=float)
+@click.option("--retry-after", default=1, type=int, show_default=True)
+@click.option(
+    "--wait-interval",
+    default=0.0,
+    type=float,
+    show_default=True,
+    help="Min seconds between requests of a spider",
+)
+@click.option("--max-retries", default=3, type=int, show_default=True)
+@click.option("--retry-backoff", default=0.5, type=float, show_default=True)
+@click.option("--concurrency", default=1, type=int, show_default=True)
+@click.option(
+    "--passes",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Crawls in a row sharing the page cache",
+)
+@click.option("--use-cache", is_flag=True, help="Read detail pages from the cache")
+@click.option(
+    "--command",
+    "use_command",
+    is_flag=True,
+    help="Run `domus-analytica suumo` instead of driving the spider",
+)
+@click.option("--mongo-uri", default="mongodb://localhost:27017", envvar="MONGO_URI")
+@click.option("--mongo-db", default="domus_benchmark", show_default=True)
+def main(
+    listings: int,
+    latency_ms: float,
+    latency_jitter_ms: float,
+    error_rate: float,
+    throttle_rate: float,
+    max_rps: Optional[float],
+    retry_after: int,
+    wait_interval: float,
+    max_retries: int,
+    retry_backoff: float,
+    concurrency: int,
+    passes: int,
+    use_cache: bool,
+    use_command: bool,
+    mongo_uri: str,
+    mongo_db: str,
+):
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("domus_analytica.spider").setLevel(logging.ERROR)
+    server = start_server(
+        StandInSettings(
+            listings=listings,
+            latency_ms=latency_ms,
+            latency_jitter_ms=latency_jitter_ms,
+            error_rate=error_rate,
+            throttle_rate=throttle_rate,
+            max_rps=max_rps,
+            retry_after=retry_after,
+        )
+    )
+    spider_options = dict(
+        wait_interval=wait_interval,
+        max_retries=max_retries,
+        retry_backoff=retry_backoff,
+    )
+    cache = MemoryPageCache()
+    try:
+        for i in range(passes):
+            server.stand_in.statuses.clear()
+            start = time.perf_counter()
+            if use_command:
+                result = {
+                    "listings": run_command(
+                        server.base_url, mongo_uri, mongo_db, **spider_options
+                    )
+                }
+            else:
+                result = crawl(
+                    server.base_url, cache, concurrency, use_cache, **spider_options
+                )
+            elapsed = time.perf_counter() - start
+            log.info(
+                f"Pass {i + 1}: {result['listings'] / elapsed * 60:.0f} listings/minute, "
+                f"{result} in {elapsed:.1f}s, responses {dict(server.stand_in.statuses)}"
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Quadtree sweep against the offline Places API stub, no network access or API key needed
+
+    python -m benchmarks.places_sweep --places 5000
+"""
+
+import logging
+import tempfile
+import time
+
+import click
+
+from domus_analytica.places import (
+    CachedPlacesClient,
+    OfflinePlacesClient,
+    PlacesResponseCache,
+    QuadtreeSweep,
+    SweepCell,
+)
+
+log = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option(
+    "--bbox",
+    default="130.25,33.50,130.50,33.70",
+    type=str,
+    show_default=True,
+    help="min_lng,min_lat,max_lng,max_lat",
+)
+@click.option("--places", default=5000, type=int, show_default=True)
+@click.option("--concurrency", default=8, type=int, show_default=True)
+@click.option("--latency", default=0.05, type=float, show_default=True)
+@click.option("--min-radius", default=100, type=int, show_default=True)
+@click.option("--seed", default=0, type=int, show_default=True)
+def main(
+    bbox: str,
+    places: int,
+    concurrency: int,
+    latency: float,
+    min_radius: int,
+    seed: int,
+):
+    logging.basicConfig(level=logging.INFO)
+    cell = SweepCell.parse_bbox(bbox)
+    stub = OfflinePlacesClient(
+        OfflinePlacesClient.random_places(cell, places, "cemetery", seed=seed),
+        token_delay=latency,
+        latency=latency,
+    )
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ("cold", "cached"):
+            client = CachedPlacesClient(
+                stub, PlacesResponseCache(cache_dir), page_token_delay=latency
+            )
+            sweeper = QuadtreeSweep(
+                client, "cemetery", min_radius=min_radius, concurrency=concurrency
+            )
+            start = time.perf_counter()
+            found = {p["place_id"] for p in sweeper.sweep(cell)}
+            elapsed = time.perf_counter() - start
+            print(
+                f"{run}: found {len(found)}/{places} places in {elapsed:.2f}s, "
+                f"{client.api_requests} API requests, {client.cache_hits} cache hits, "
+                f"{sweeper.report}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Latency of nearest-neighbour POI queries under each storage layout
+
+Run `domus-analytica gis-import migrate-layout --to-layout split` (without --drop-source) first,
+then compare the layouts with:
+
+    python -m benchmarks.poi_nearest --layout shared --layout split
+
+With --raster-dir (written by `gis-import export-raster`), the categories in the rasters are
+also looked up from them, and the nearest POI is checked against the one of $near.
+"""
+
+import logging
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStorageLayout, PoiStore
+
+log = logging.getLogger(__name__)
+
+# Radius used by data_clean for each category, None means unbounded nearest query
+QUERY_RADIUS = {
+    "mafia": None,
+    "google_cemetery": None,
+    "station_passengers": 2000,
+    "population": 1000,
+    "bus_stop": 1000,
+}
+
+
+def sample_points(store: PoiStore, size: int, seed: int) -> List[GeoPoint]:
+    """
+    Sample query points from population cells so that they are all on the land
+    """
+    coll = store.collection("population")
+    points = [
+        GeoPoint.from_geo_json_object(doc["loc"])
+        for doc in coll.aggregate(
+            [
+                {"$match": store.category_filter("population")},
+                {"$sample": {"size": size}},
+                {"$project": {"loc": True}},
+            ]
+        )
+    ]
+    random.Random(seed).shuffle(points)
+    return points
+
+
+def distance(doc: Optional[dict], point: GeoPoint) -> Optional[float]:
+    """
+    Rounded to centimeters, the raster computes the distance itself
+    """
+    if doc is None:
+        return None
+    return round(point - GeoPoint.from_geo_json_object(doc["loc"]), 5)
+
+
+def measure(store, category: str, points: List[GeoPoint]) -> np.ndarray:
+    radius = QUERY_RADIUS.get(category)
+    latencies = []
+    for point in points:
+        start = time.perf_counter()
+        if radius is None:
+            store.find_nearest(category, point)
+        else:
+            list(store.find_near(category, point, radius))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000.0
+
+
+@click.command()
+@click.option(
+    "--layout",
+    "layouts",
+    multiple=True,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Layouts to benchmark, all of them should be populated",
+)
+@click.option("--queries", default=500, type=int, show_default=True)
+@click.option("--seed", default=42, type=int, show_default=True)
+@click.option("--mongo-uri", required=True, type=str, envvar="MONGO_URI")
+@click.option("--mongo-db", default="domus", type=str, envvar="MONGO_DB_NAME")
+@click.option("--mongo-coll", default="japan_gis_poi", type=str)
+@click.option("--raster-dir", default=None, type=str)
+def main(
+    layouts: Tuple[str, ...],
+    queries: int,
+    seed: int,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    raster_dir: Optional[str],
+):
+    logging.basicConfig(level=logging.INFO)
+    db = get_database(mongo_uri, mongo_db)
+    stores = [
+        PoiStore(db, layout=PoiStorageLayout(layout), base_collection=mongo_coll)
+        for layout in (layouts or [PoiStorageLayout.SHARED.value])
+    ]
+    points = sample_points(stores[0], queries, seed)
+    log.info(f"Sampled {len(points)} query points")
+
+    labelled = [(store.layout.value, store) for store in stores]
+    rasters = None
+    if raster_dir:
+        from domus_analytica.poi_raster import PoiRasters, RasterPoiStore
+
+        rasters = PoiRasters(raster_dir)
+        raster_store = RasterPoiStore(stores[0], rasters)
+        for category in rasters.categories:
+            mismatches = sum(
+                distance(stores[0].find_nearest(category, p), p)
+                != distance(raster_store.find_nearest(category, p), p)
+                for p in points
+            )
+            log.info(f"{category}: {mismatches} of {len(points)} nearest POI differ")
+        labelled.append(("raster", raster_store))
+
+    results: List[Dict] = []
+    for category in POI_CATEGORIES:
+        for label, store in labelled:
+            if label == "raster" and category not in rasters.categories:
+                continue
+            # Warm up the cache so that the first layout isn't penalized
+            measure(store, category, points[:20])
+            latency = measure(store, category, points)
+            results.append(
+                {
+                    "category": category,
+                    "layout": label,
+                    "mean_ms": latency.mean(),
+                    "p50_ms": np.percentile(latency, 50),
+                    "p99_ms": np.percentile(latency, 99),
+                }
+            )
+
+    print(f"{'category':<20}{'layout':<10}{'mean_ms':>10}{'p50_ms':>10}{'p99_ms':>10}")
+    for r in results:
+        print(
+            f"{r['category']:<20}{r['layout']:<10}"
+            f"{r['mean_ms']:>10.2f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+"""
+Throughput and peak memory of the hot paths with synthetic data, every run of a case is
+a fresh process so that peak memory isn't shared between cases
+
+    python -m benchmarks.suite --output benchmarks/results.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json --tolerance 0.2
+    python -m benchmarks.suite --skip-mongo --case parse_detail_page --scale 0.2
+
+Cases marked with mongo use the database --mongo-db of a local MongoDB, which is dropped
+before every run of them.
+"""
+
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+from pydantic import BaseModel
+
+from benchmarks import synthetic
+
+log = logging.getLogger(__name__)
+
+BASELINE_FORMAT_VERSION = 1
+# Peak memory growth below this is noise of the allocator
+MEMORY_SLACK_MB = 5.0
+
+
+class CaseSettings(BaseModel):
+    work_dir: str
+    scale: float
+    seed: int
+    mongo_uri: str
+    mongo_db: str
+
+
+class CaseResult(BaseModel):
+    items: int
+    seconds: float
+    rss_start_mb: float
+    peak_rss_mb: float
+
+    @property
+    def items_per_second(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def peak_delta_mb(self) -> float:
+        return max(self.peak_rss_mb - self.rss_start_mb, 0.0)
+
+
+# A case prepares its input and returns the function to measure, which returns items processed
+Case = Callable[[CaseSettings, np.random.Generator], Callable[[], int]]
+
+
+def _size(settings: CaseSettings, base: int) -> int:
+    return max(int(base * settings.scale), 1)
+
+
+def case_geopoint_distance(settings: CaseSettings, rng: np.random.Generator):
+    from domus_analytica.geopoint import GeoPoint
+
+    size = _size(settings, 200000)
+    a = synthetic.random_points(rng, size)
+    # Half of the pairs are close enough for the local euclid distance
+    b = np.where(
+        rng.random((size, 1)) < 0.5,
+        a + rng.uniform(-0.0005, 0.0005, (size, 2)),
+        synthetic.random_points(rng, size),
+    )
+    pairs = [
+        (
+            GeoPoint(longitude=p[0], latitude=p[1]),
+            GeoPoint(longitude=q[0], latitude=q[1]),
+        )
+        for p, q in zip(a.tolist(), b.tolist())
+    ]
+
+    def run() -> int:
+        for p, q in pairs:
+            p - q
+        return len(pairs)
+
+    return run
+
+
+def _spider():
+    from domus_analytica.spider import BasePageCache, SuumoSpider
+
+    return SuumoSpider(cache=BasePageCache())
+
+
+def case_parse_search_page(settings: CaseSettings, rng: np.random.Generator):
+    spider = _spider()
+    pages = _size(settings, 50)
+    listing_data = synthetic.listings(rng, 100)
+    contents = [synthetic.search_html(listing_data, i + 1, pages) for i in range(pages)]
+
+    def run() -> int:
+        items = 0
+        for content in contents:
+            spider.get_page_count(content)
+            items += sum(1 for _ in spider.parse_search_page(content))
+        return items
+
+    return run
+
+
+def case_parse_detail_page(settings: CaseSettings, rng: np.random.Generator):
+    spider = _spider()
+    contents = [
+        synthetic.detail_html(x) for x in synthetic.listings(rng, _size(settings, 1000))
+    ]
+
+    def run() -> int:
+        for content in contents:
+            spider.parse_detail_page(content)
+        return len(contents)
+
+    return run
+
+
+def case_parse_listing(settings: CaseSettings, rng: np.random.Generator):
+    from domus_analytica.data_clean import parse_listing
+
+    documents = list(
+        synthetic.suumo_details_documents(
+            synthetic.listings(rng, _size(settings, 20000))
+        )
+    )
+
+    def run() -> int:
+        for doc in documents:
+            parse_listing(doc)
+        return len(documents)
+
+    return run
+
+
+def case_data_preprocessing(settings: CaseSettings, rng: np.random.Generator):
+    import pandas as pd
+
+    from domus_analytica.data_clean import parse_listing
+    from domus_analytica.model import data_preprocessing, preprocessing_mismatches
+
+    size = _size(settings, 100000)
+    sample = pd.DataFrame(
+        [
+            parse_listing(doc)
+            for doc in synthetic.suumo_details_documents(
+                synthetic.listings(rng, min(size, 2000))
+            )
+        ]
+    )
+    # The valuation service derives the same features row by row
+    mismatches = preprocessing_mismatches(sample)
+    if mismatches:
+        raise AssertionError(f"preprocess_record differs: {mismatches[:5]}")
+    table = pd.concat([sample] * (size // len(sample) + 1), ignore_index=True).iloc[
+        :size
+    ]
+
+    def run() -> int:
+        return len(data_preprocessing(table))
+
+    return run
+
+
+def _fresh_database(settings: CaseSettings):
+    from domus_analytica.mongo import get_database
+
+    db = get_database(settings.mongo_uri, settings.mongo_db)
+    db.client.drop_database(settings.mongo_db)
+    return db
+
+
+def case_extract_info_to_table(settings: CaseSettings, rng: np.random.Generator):
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.data_clean import extract_info_to_table
+    from domus_analytica.poi_store import PoiStore
+
+    db = _fresh_database(settings)
+    poi_store = PoiStore(db)
+    for category, documents in synthetic.poi_documents(rng, settings.scale).items():
+        poi_store.insert_many(category, documents)
+        poi_store.ensure_index(category)
+    size = _size(settings, 2000)
+    db.get_collection("suumo_details").insert_many(
+        synthetic.suumo_details_documents(synthetic.listings(rng, size))
+    )
+    config = DomusSettings(
+        mongo_uri=settings.mongo_uri,
+        mongo_db_name=settings.mongo_db,
+        google_api_key="unused",
+        reinfolib_api_key="unused",
+    )
+
+    def run() -> int:
+        return len(extract_info_to_table(config, {}))
+
+    return run
+
+
+def _cli_case(arguments: List[str], items: int, settings: CaseSettings):
+    from domus_analytica.cli import app
+
+    _fresh_database(settings)
+
+    def run() -> int:
+        app.main(
+            arguments
+            + ["--mongo-uri", settings.mongo_uri, "--mongo-db", settings.mongo_db],
+            prog_name="domus-analytica",
+            standalone_mode=False,
+        )
+        return items
+
+    return run
+
+
+def case_import_population(settings: CaseSettings, rng: np.random.Generator):
+    rows = _size(settings, 20000)
+    output = Path(settings.work_dir) / "population"
+    synthetic.write_population_files(rng, output, rows)
+    return _cli_case(["gis-import", "population", "-f", str(output)], rows, settings)
+
+
+def case_import_bus_stop(settings: CaseSettings, rng: np.random.Generator):
+    stops = _size(settings, 20000)
+    output = Path(settings.work_dir) / "bus_stop"
+    synthetic.write_bus_stop_files(rng, output, stops)
+    return _cli_case(["gis-import", "bus-stop", "-f", str(output)], stops, settings)
+
+
+def case_import_trading_csv(settings: CaseSettings, rng: np.random.Generator):
+    rows = _size(settings, 100000)
+    output = Path(settings.work_dir) / "trading"
+    synthetic.write_trading_csv_files(rng, output, rows)
+    # One worker process, its memory isn't included in the peak of this process
+    return _cli_case(
+        ["import-trading-csv", "-f", str(output), "--workers", "1"], rows, settings
+    )
+
+
+# Name -> (case, whether it needs MongoDB)
+CASES: Dict[str, Tuple[Case, bool]] = {
+    "geopoint_distance": (case_geopoint_distance, False),
+    "parse_search_page": (case_parse_search_page, False),
+    "parse_detail_page": (case_parse_detail_page, False),
+    "parse_listing": (case_parse_listing, False),
+    "data_preprocessing": (case_data_preprocessing, False),
+    "extract_info_to_table": (case_extract_info_to_table, True),
+    "import_population": (case_import_population, True),
+    "import_bus_stop": (case_import_bus_stop, True),
+    "import_trading_csv": (case_import_trading_csv, True),
+}
+
+
+def max_rss_mb() -> float:
+    # Kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_case(name: str, settings: CaseSettings) -> CaseResult:
+    """
+    Prepare and measure a case, it runs in a fresh process
+    """
+    logging.basicConfig(level=logging.WARNING)
+    run = CASES[name][0](settings, np.random.default_rng(settings.seed))
+    rss_start = max_rss_mb()
+    start = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - start
+    return CaseResult(
+        items=items, seconds=seconds, rss_start_mb=rss_start, peak_rss_mb=max_rss_mb()
+    )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(
+    results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float
+) -> List[str]:
+    """
+    :return: descriptions of regressions against the baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["items_per_second"] < base["items_per_second"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['items_per_second']:.1f} items/s, "
+                f"baseline {base['items_per_second']:.1f}"
+            )
+        if result["peak_delta_mb"] > max(
+            base["peak_delta_mb"] * (1 + tolerance),
+            base["peak_delta_mb"] + MEMORY_SLACK_MB,
+        ):
+            regressions.append(
+                f"{name}: peak memory +{result['peak_delta_mb']:.1f}MB, "
+                f"baseline +{base['peak_delta_mb']:.1f}MB"
+            )
+    return regressions
+
+
+@click.command()
+@click.option(
+    "--case",
+    "cases",
+    multiple=True,
+    type=click.Choice(list(CASES.keys())),
+    help="Cases to run, default to all",
+)
+@click.option(
+    "--scale",
+    default=1.0,
+    type=float,
+    show_default=True,
+    help="Multiplier of the input sizes",
+)
+@click.option("--repeat", default=3, type=int, show_default=True)
+@click.option("--seed", default=0, type=int, show_default=True)
+@click.option("--skip-mongo", is_flag=True, help="Skip the cases needing MongoDB")
+@click.option(
+    "--mongo-uri",
+    default="mongodb://localhost:27017",
+    type=str,
+    show_default=True,
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus_benchmark",
+    type=str,
+    show_default=True,
+    help="Database dropped and filled by the cases, never point it at real data",
+)
+@click.option("--output", "-o", type=str, help="Write results to this JSON file")
+@click.option("--compare", "baseline_path", type=str, help="Baseline JSON to compare")
+@click.option(
+    "--tolerance",
+    default=0.2,
+    type=float,
+    show_default=True,
+    help="Allowed ratio of throughput drop and peak memory growth against the baseline",
+)
+def main(
+    cases: Tuple[str, ...],
+    scale: float,
+    repeat: int,
+    seed: int,
+    skip_mongo: bool,
+    mongo_uri: str,
+    mongo_db: str,
+    output: Optional[str],
+    baseline_path: Optional[str],
+    tolerance: float,
+):
+    logging.basicConfig(level=logging.INFO)
+    names = [n for n in cases or CASES.keys() if not (skip_mongo and CASES[n][1])]
+    if any(CASES[n][1] for n in names):
+        from domus_analytica.mongo import get_client
+
+        try:
+            get_client(mongo_uri).admin.command("ping")
+        except Exception as ex:
+            raise click.ClickException(
+                f"MongoDB at {mongo_uri} isn't available ({ex}), use --skip-mongo"
+            )
+
+    results: Dict[str, dict] = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = CaseSettings(
+            work_dir=work_dir,
+            scale=scale,
+            seed=seed,
+            mongo_uri=mongo_uri,
+            mongo_db=mongo_db,
+        )
+        spawn = multiprocessing.get_context("spawn")
+        for name in names:
+            runs: List[CaseResult] = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(1, mp_context=spawn) as executor:
+                    runs.append(executor.submit(run_case, name, settings).result())
+            results[name] = {
+                "items": runs[0].items,
+                "seconds": statistics.median(r.seconds for r in runs),
+                "items_per_second": statistics.median(r.items_per_second for r in runs),
+                "peak_rss_mb": max(r.peak_rss_mb for r in runs),
+                "peak_delta_mb": max(r.peak_delta_mb for r in runs),
+                "runs": [r.model_dump() for r in runs],
+            }
+            log.info(
+                f"{name:<24} {results[name]['items_per_second']:>12.1f} items/s "
+                f"peak +{results[name]['peak_delta_mb']:.1f}MB "
+                f"({results[name]['peak_rss_mb']:.0f}MB)"
+            )
+
+    report = {
+        "format_version": BASELINE_FORMAT_VERSION,
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "scale": scale,
+            "seed": seed,
+            "repeat": repeat,
+        },
+        "cases": results,
+    }
+    if output:
+        with open(output, "w") as fp:
+            json.dump(report, fp, indent=2)
+        log.info(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path, "r") as fp:
+            baseline = json.load(fp)
+        if baseline["meta"]["scale"] != scale:
+            log.warning(
+                f"Baseline was measured with scale {baseline['meta']['scale']}, "
+                f"throughput may not be comparable"
+            )
+        regressions = compare(results, baseline["cases"], tolerance)
+        for regression in regressions:
+            log.error(f"Regression {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Local stand-in of SUUMO serving synthetic search and detail pages, with configurable
+latency, errors and throttling, for load testing the crawler offline
+
+    python -m benchmarks.suumo_server --port 8765 --listings 1000 --latency-ms 200 --throttle-rate 0.05
+    domus-analytica suumo --base-url http://127.0.0.1:8765 --detailed \\
+        --search-url 'http://127.0.0.1:8765/ms/chuko/tokyo/city/?ar=030'
+"""
+
+import logging
+import math
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+import click
+import numpy as np
+from pydantic import BaseModel
+
+from benchmarks import synthetic
+
+log = logging.getLogger(__name__)
+
+SEARCH_PATH = "/ms/chuko/tokyo/city/"
+
+
+class StandInSettings(BaseModel):
+    listings: int = 1000
+    seed: int = 0
+    # Latency of every response, normally distributed and truncated at 0
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    # Probability of 500 and 429 responses
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    # Requests per second above which 429 is returned, None for no limitation
+    max_rps: Optional[float] = None
+    retry_after: int = 1
+
+
+class SuumoStandIn:
+    def __init__(self, settings: StandInSettings):
+        self.settings = settings
+        self.listings = synthetic.listings(
+            np.random.default_rng(settings.seed), settings.listings
+        )
+        self.listing_by_url: Dict[str, dict] = {x["url"]: x for x in self.listings}
+        self.statuses: Counter = Counter()
+        self._random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+
+    def _throttled(self) -> bool:
+        if self.settings.max_rps is None:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1.0:
+                self._window_start, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.settings.max_rps
+
+    def respond(self, path: str):
+        """
+        :return: status, headers and body of the response
+        """
+        with self._lock:
+            latency = self._random.gauss(
+                self.settings.latency_ms, self.settings.latency_jitter_ms
+            )
+            dice = self._random.random()
+        if latency > 0:
+            time.sleep(latency / 1000)
+        if self._throttled() or dice < self.settings.throttle_rate:
+            return 429, {"Retry-After": str(self.settings.retry_after)}, b""
+        if dice < self.settings.throttle_rate + self.settings.error_rate:
+            return 500, {}, b"Internal Server Error"
+
+        parsed = urlparse(path)
+        if parsed.path == SEARCH_PATH:
+            query = parse_qs(parsed.query)
+            page_size = int(query.get("pc", ["100"])[0])
+            page_id = int(query.get("page", ["1"])[0])
+            page_count = max(math.ceil(len(self.listings) / page_size), 1)
+            begin = (page_id - 1) * page_size
+            return (
+                200,
+                {},
+                synthetic.search_html(
+                    self.listings[begin : begin + page_size], page_id, page_count
+                ),
+            )
+        listing = self.listing_by_url.get(parsed.path)
+        if listing is not None:
+            return 200, {}, synthetic.detail_html(listing)
+        return 404, {}, b"Not Found"
+
+    def record(self, status: int):
+        with self._lock:
+            self.statuses[status] += 1
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "StandInServer"
+
+    def do_GET(self):
+        status, headers, body = self.server.stand_in.respond(self.path)
+        self.server.stand_in.record(status)
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        log.debug(format % args)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, stand_in: SuumoStandIn):
+        super().__init__(address, StandInRequestHandler)
+        self.stand_in = stand_in
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+def start_server(settings: StandInSettings, port: int = 0) -> StandInServer:
+    """
+    Serve the stand-in in a daemon thread, call shutdown() to stop it
+    """
+    server = StandInServer(("127.0.0.1", port), SuumoStandIn(settings))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(
+        f"SUUMO stand-in serving {settings.listings} listings on {server.base_url}{SEARCH_PATH}"
+    )
+    return server
+
+
+@click.command()
+@click.option("--port", default=8765, type=int, show_default=True)
+@click.option("--listings", default=1000, type=int, show_default=True)
+@click.option("--seed", default=0, type=int, show_default=True)
+@click.option("--latency-ms", default=0.0, type=float, show_default=True)
+@click.option("--latency-jitter-ms", default=0.0, type=float, show_default=True)
+@click.option(
+    "--error-rate",
+    default=0.0,
+    type=float,
+    show_default=True,
+    help="Probability of 500",
+)
+@click.option(
+    "--throttle-rate",
+    default=0.0,
+    type=float,
+    show_default=True,
+    help="Probability of 429",
+)
+@click.option(
+    "--max-rps",
+    default=None,
+    type=float,
+    help="Return 429 to requests beyond this rate per second",
+)
+@click.option(
+    "--retry-after",
+    default=1,
+    type=int,
+    show_default=True,
+    help="Retry-After of 429 in seconds",
+)
+def main(port: int, **kwargs):
+    logging.basicConfig(level=logging.INFO)
+    server = start_server(StandInSettings(**kwargs), port)
+    try:
+        while True:
+            time.sleep(10)
+            log.info(f"Responses so far: {dict(server.stand_in.statuses)}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""
+Synthetic data in the formats read by the spider, data_clean and the importers,
+deterministic for a seed, so benchmark runs are comparable
+
+    python -m benchmarks.synthetic --output data/synthetic --scale 1
+"""
+
+import csv
+import html
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import click
+import jismesh.utils as ju
+import numpy as np
+
+from domus_analytica.cli.gis_import.population import FIELDS as POPULATION_FIELDS
+from domus_analytica.cli.trading.csv import FIELDS as TRADING_FIELDS
+
+log = logging.getLogger(__name__)
+
+# Around the 23 wards of Tokyo
+BBOX = (139.60, 35.55, 139.90, 35.80)
+STATIONS = ["六本木", "渋谷", "新宿", "池袋", "品川", "上野", "目黒", "中野", "錦糸町"]
+WARDS = [
+    ("13103", "港区"),
+    ("13113", "渋谷区"),
+    ("13104", "新宿区"),
+    ("13116", "豊島区"),
+]
+DIRECTIONS = ["南", "東", "西", "北", "南東", "南西", "北東", "北西"]
+LAYOUTS = ["1K", "1LDK", "2LDK", "3LDK", "2LDK+S", "3LDK+2S", "4LDK"]
+STRUCTURES = ["RC", "SRC", "木造", "鉄骨造"]
+ERAS = [("昭和", 1925), ("平成", 1988), ("令和", 2018)]
+
+
+def random_points(rng: np.random.Generator, size: int) -> np.ndarray:
+    """
+    :return: (size, 2) of lon/lat in BBOX
+    """
+    min_lng, min_lat, max_lng, max_lat = BBOX
+    return np.column_stack(
+        [rng.uniform(min_lng, max_lng, size), rng.uniform(min_lat, max_lat, size)]
+    )
+
+
+def _yen(value: int) -> str:
+    man, yen = divmod(value, 10000)
+    return f"{man}万{yen}円／月" if man else f"{yen}円／月"
+
+
+def listings(rng: np.random.Generator, size: int) -> List[dict]:
+    """
+    Listings as the (type, content) pairs of the detail table of SUUMO
+    """
+    result = []
+    for i, (lng, lat) in enumerate(random_points(rng, size)):
+        station = STATIONS[rng.integers(len(STATIONS))]
+        total_floors = int(rng.integers(3, 40))
+        year = int(rng.integers(1975, 2024))
+        result.append(
+            {
+                "url": f"/ms/chuko/tokyo/sc_minato/nc_{70000000 + i}/",
+                "title": f"{'ペット可 ' if rng.random() < 0.2 else ''}パーク{station}{i}",
+                "latitude": round(float(lat), 6),
+                "longitude": round(float(lng), 6),
+                "content_details": [
+                    ("物件名", f"パーク{station}{i}"),
+                    ("住所", f"東京都港区六本木{i % 9 + 1}-{i % 30 + 1}\n[■周辺環境]"),
+                    (
+                        "交通",
+                        f"東京メトロ日比谷線「{station}」歩{rng.integers(1, 20)}分",
+                    ),
+                    ("価格", f"{int(rng.integers(1500, 20000))}万円"),
+                    ("専有面積", f"{rng.uniform(20, 120):.2f}m2（壁芯）"),
+                    ("その他面積", f"バルコニー面積：{rng.uniform(3, 20):.2f}m2"),
+                    ("完成時期(築年月)", f"{year}年{rng.integers(1, 13)}月"),
+                    ("間取り", LAYOUTS[rng.integers(len(LAYOUTS))]),
+                    ("向き", DIRECTIONS[rng.integers(len(DIRECTIONS))]),
+                    ("所在階", f"{rng.integers(1, total_floors + 1)}階"),
+                    (
+                        "構造・階建て",
+                        f"{STRUCTURES[rng.integers(len(STRUCTURES))]}{total_floors}階建",
+                    ),
+                    ("管理費", _yen(int(rng.integers(5000, 40000)))),
+                    ("修繕積立金", _yen(int(rng.integers(3000, 30000)))),
+                    ("修繕積立基金", "-"),
+                    ("諸費用", "-" if rng.random() < 0.7 else _yen(800)),
+                ],
+            }
+        )
+    return result
+
+
+def detail_html(listing: dict) -> bytes:
+    """
+    Detail page of a listing in the markup read by SuumoSpider.parse_detail_page
+    """
+    rows = "".join(
+        f'<tr><th><div class="fl">{html.escape(t)}</div></th>'
+        f"<td>{html.escape(c)}</td></tr>"
+        for t, c in listing["content_details"]
+    )
+    nearby = "".join(
+        f'<li class="cf dibz vat"><div class="bgGreen">{kind}</div>'
+        f'<div class="lh15">{kind}{i}まで{i * 120}m</div></li>'
+        for i, kind in enumerate(["スーパー", "コンビニ", "小学校", "病院"], start=1)
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>"
+        f"{html.escape(listing['title'])}</title></head><body>"
+        f'<ul class="nearby">{nearby}</ul>'
+        f'<table summary="表"><tbody>{rows}</tbody></table>'
+        "<script>var mapOption = {zoom: 16"
+        f",initIdo: {listing['latitude']},initKeido: {listing['longitude']}"
+        "};</script></body></html>"
+    ).encode()
+
+
+def search_html(page_listings: List[dict], page_id: int, page_count: int) -> bytes:
+    """
+    Search result page in the markup read by SuumoSpider.parse_search_page / get_page_count
+    """
+    units = "".join(
+        '<div class="property_unit"><h2 class="property_unit-title">'
+        f'<a href="{x["url"]}">{html.escape(x["title"])}</a></h2>'
+        + "".join(
+            f"<dl><dt>{html.escape(t)}</dt><dd>{html.escape(c)}</dd></dl>"
+            for t, c in x["content_details"][1:6]
+        )
+        + "</div>"
+        for x in page_listings
+    )
+    pagination = "".join(
+        f'<li><a href="?page={p}">{p}</a></li>'
+        for p in range(max(1, page_id - 4), min(page_count, page_id + 5) + 1)
+    )
+    return (
+        f"<html><body>{units}"
+        f'<ol class="pagination-parts">{pagination}</ol></body></html>'
+    ).encode()
+
+
+def suumo_details_documents(listing_data: Iterable[dict]) -> Iterable[dict]:
+    """
+    Documents as saved in suumo_details by the suumo command with --detailed
+    """
+    now = datetime(2024, 4, 1)
+    for i, x in enumerate(listing_data):
+        yield {
+            "nearby_places": [],
+            "content_details": [
+                {"type": t, "content": c} for t, c in x["content_details"]
+            ],
+            "gps": {"latitude": str(x["latitude"]), "longitude": str(x["longitude"])},
+            "search_details": {"url": x["url"], "title": x["title"], "properties": []},
+            "search_url": "/ms/chuko/tokyo/city/",
+            "search_args": {},
+            "rank_order": i,
+            "create_time": now,
+            "search_time": now,
+        }
+
+
+def poi_documents(rng: np.random.Generator, scale: float) -> Dict[str, List[dict]]:
+    """
+    POI of every category read by data_clean.gis_features, by category
+    """
+
+    def docs(size: int, data_factory) -> List[dict]:
+        return [
+            {
+                "loc": {"type": "Point", "coordinates": p.tolist()},
+                "data": data_factory(),
+            }
+            for p in random_points(rng, max(int(size * scale), 1))
+        ]
+
+    return {
+        "mafia": docs(50, dict),
+        "google_cemetery": docs(300, dict),
+        "station_passengers": docs(
+            600,
+            lambda: {
+                "passengers_count_2019": int(rng.integers(1000, 100000)),
+                "passengers_count_2021": int(rng.integers(1000, 100000)),
+            },
+        ),
+        "population": docs(
+            14000, lambda: {"total_population": int(rng.integers(0, 3000))}
+        ),
+        "bus_stop": docs(
+            6000,
+            lambda: {
+                "station_name": "バス停",
+                "routes": [
+                    [{"route_name": f"系統{j}", "route_type": "1"}]
+                    for j in range(int(rng.integers(1, 4)))
+                ],
+            },
+        ),
+    }
+
+
+def write_population_files(
+    rng: np.random.Generator, output: Path, rows: int, files: int = 4
+) -> List[Path]:
+    """
+    Half mesh (500m) population txt files of e-Stat, read by `gis-import population`
+    """
+    output.mkdir(parents=True, exist_ok=True)
+    points = random_points(rng, rows * 2)
+    codes = np.unique(ju.to_meshcode(points[:, 1], points[:, 0], 4))[:rows]
+    rng.shuffle(codes)
+    header = ["KEY_CODE", "HTKSYORI", "HTKSAKI", "GASSAN"] + [
+        f["field"] for f in POPULATION_FIELDS
+    ]
+    paths = []
+    for f, chunk in enumerate(np.array_split(codes, files)):
+        path = output / f"tblT001142H{5339 + f}.txt"
+        with open(path, "w", encoding="cp932", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(header)
+            writer.writerow(
+                ["", "", "", ""] + [f["unix_name"] for f in POPULATION_FIELDS]
+            )
+            for code in chunk:
+                total = int(rng.integers(0, 5000))
+                values = [
+                    "*" if rng.random() < 0.02 else int(total * rng.uniform(0, 1))
+                    for _ in POPULATION_FIELDS[1:]
+                ]
+                writer.writerow([int(code), 0, "", ""] + [total] + values)
+        paths.append(path)
+    return paths
+
+
+def write_bus_stop_files(
+    rng: np.random.Generator, output: Path, stops: int, files: int = 4
+) -> List[Path]:
+    """
+    Bus stop GeoJSON of 国土数値情報 (P11), read by `gis-import bus-stop`
+    """
+    paths = []
+    for f, chunk in enumerate(np.array_split(random_points(rng, stops), files)):
+        path = output / f"P11-22_{13 + f}_GML" / f"P11-22_{13 + f}.geojson"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        features = []
+        for i, (lng, lat) in enumerate(chunk):
+            route_count = int(rng.integers(1, 6))
+            properties = {
+                "P11_001": f"バス停{f}-{i}",
+                "P11_002": "都営バス",
+                "P11_005": None,
+            }
+            for r in range(35):
+                properties[f"P11_003_{r + 1:02d}"] = (
+                    ",".join(f"系統{r}-{k}" for k in range(int(rng.integers(1, 3))))
+                    if r < route_count
+                    else None
+                )
+                properties[f"P11_004_{r + 1:02d}"] = (
+                    ",".join("1" for _ in properties[f"P11_003_{r + 1:02d}"].split(","))
+                    if r < route_count
+                    else None
+                )
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [lng, lat]},
+                    "properties": properties,
+                }
+            )
+        with open(path, "w") as fp:
+            json.dump({"type": "FeatureCollection", "features": features}, fp)
+        paths.append(path)
+    return paths
+
+
+def write_trading_csv_files(
+    rng: np.random.Generator, output: Path, rows: int, files: int = 4
+) -> List[Path]:
+    """
+    Transaction price CSV files of 不動産情報ライブラリ, read by `import-trading-csv`
+    """
+    output.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for f, size in enumerate(len(c) for c in np.array_split(np.arange(rows), files)):
+        path = output / f"13_Tokyo_20{10 + f}1_20{13 + f}4.csv"
+        with open(path, "w", encoding="cp932", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow([x["field"] for x in TRADING_FIELDS])
+            for _ in range(size):
+                city_code, city_name = WARDS[rng.integers(len(WARDS))]
+                area = int(rng.integers(15, 150))
+                price = int(area * rng.uniform(40, 200)) * 10000
+                era, offset = ERAS[rng.integers(len(ERAS))]
+                row = {
+                    "種類": "中古マンション等",
+                    "価格情報区分": "不動産取引価格情報",
+                    "地域": "",
+                    "市区町村コード": city_code,
+                    "都道府県名": "東京都",
+                    "市区町村名": city_name,
+                    "地区名": "六本木",
+                    "最寄駅：名称": STATIONS[rng.integers(len(STATIONS))],
+                    "最寄駅：距離（分）": str(rng.integers(1, 30)),
+                    "取引価格（総額）": str(price),
+                    "間取り": LAYOUTS[rng.integers(len(LAYOUTS))],
+                    "面積（㎡）": str(area) if area < 2000 else "2,000㎡以上",
+                    "建築年": f"{era}{rng.integers(1, 30)}年",
+                    "建物の構造": STRUCTURES[rng.integers(len(STRUCTURES))],
+                    "用途": "住宅",
+                    "今後の利用目的": "住宅",
+                    "都市計画": "商業地域",
+                    "建ぺい率（％）": "80",
+                    "容積率（％）": "500",
+                    "取引時期": f"20{13 + f}年第{rng.integers(1, 5)}四半期",
+                    "改装": "未改装",
+                    "取引の事情等": "",
+                }
+                writer.writerow([row.get(x["field"], "") for x in TRADING_FIELDS])
+        paths.append(path)
+    return paths
+
+
+@click.command()
+@click.option("--output", "-o", default="data/synthetic", type=str, show_default=True)
+@click.option(
+    "--scale",
+    default=1.0,
+    type=float,
+    show_default=True,
+    help="Multiplier of the sizes",
+)
+@click.option("--seed", default=0, type=int, show_default=True)
+def main(output: str, scale: float, seed: int):
+    logging.basicConfig(level=logging.INFO)
+    rng = np.random.default_rng(seed)
+    output_path = Path(output)
+    listing_data = listings(rng, int(1000 * scale))
+    detail_dir = output_path / "suumo_detail"
+    detail_dir.mkdir(parents=True, exist_ok=True)
+    for i, x in enumerate(listing_data):
+        (detail_dir / f"{i}.html").write_bytes(detail_html(x))
+    with open(output_path / "suumo_details.jsonl", "w") as fp:
+        for doc in suumo_details_documents(listing_data):
+            fp.write(json.dumps(doc, default=str, ensure_ascii=False) + "\n")
+    write_population_files(rng, output_path / "population", int(20000 * scale))
+    write_bus_stop_files(rng, output_path / "bus_stop", int(20000 * scale))
+    write_trading_csv_files(rng, output_path / "trading", int(100000 * scale))
+    log.info(f"Synthetic data written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Load test of the valuation service, against a running `domus-analytica serve`
+or an in-process server with a synthetic model and POI (no MongoDB needed)
+
+    python -m benchmarks.valuation_load --clients 4 --requests 1000
+    python -m benchmarks.valuation_load --url http://127.0.0.1:8080
+"""
+
+import http.client
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import click
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from domus_analytica.model import FEATURES, ModelArtifact
+from domus_analytica.poi_index import PoiIndex
+from domus_analytica.trading_rollup import ComparableSalesSummary, summarize_rollups
+from domus_analytica.valuation import ValuationServer, ValuationService
+
+log = logging.getLogger(__name__)
+
+# Around the 23 wards of Tokyo
+BBOX = (139.60, 35.55, 139.90, 35.80)
+
+
+def random_points(rng: np.random.Generator, size: int) -> np.ndarray:
+    min_lng, min_lat, max_lng, max_lat = BBOX
+    return np.column_stack(
+        [rng.uniform(min_lng, max_lng, size), rng.uniform(min_lat, max_lat, size)]
+    )
+
+
+def synthetic_service(seed: int) -> ValuationService:
+    rng = np.random.default_rng(seed)
+
+    def docs(size: int, data_factory) -> List[dict]:
+        return [
+            {
+                "loc": {"type": "Point", "coordinates": p.tolist()},
+                "data": data_factory(),
+            }
+            for p in random_points(rng, size)
+        ]
+
+    poi_index = PoiIndex(
+        {
+            "mafia": docs(50, dict),
+            "google_cemetery": docs(300, dict),
+            "station_passengers": docs(
+                600,
+                lambda: {
+                    "passengers_count_2019": int(rng.integers(1000, 100000)),
+                    "passengers_count_2021": int(rng.integers(1000, 100000)),
+                },
+            ),
+            # 250m grid of the bbox
+            "population": docs(
+                14000, lambda: {"total_population": int(rng.integers(0, 3000))}
+            ),
+            "bus_stop": docs(
+                6000,
+                lambda: {"routes": [[{"route_name": "r"}] * int(rng.integers(1, 4))]},
+            ),
+        }
+    )
+    features = FEATURES + [
+        "direction_S",
+        "direction_E",
+        "layout_main_2LDK",
+        "layout_main_3LDK",
+        "build_type_RC",
+    ]
+    x = rng.normal(size=(5000, len(features))).astype("float32")
+    booster = xgb.train(
+        {"tree_method": "hist", "max_depth": 7},
+        xgb.DMatrix(x, x[:, 0] * 10 + 80, feature_names=features),
+        num_boost_round=50,
+    )
+    empty = summarize_rollups(pd.DataFrame(), 4)
+    return ValuationService(
+        artifact=ModelArtifact(
+            booster=booster, metadata={"version": "benchmark", "features": features}
+        ),
+        poi_index=poi_index,
+        comps=ComparableSalesSummary(
+            cities={},
+            levels={
+                level: empty.add_prefix(f"comps_{level}_")
+                for level in ("city", "station")
+            },
+        ),
+    )
+
+
+def run_client(url: str, requests: int, seed: int) -> List[float]:
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+    rng = np.random.default_rng(seed)
+    latencies = []
+    for lng, lat in random_points(rng, requests):
+        body = json.dumps(
+            {
+                "latitude": lat,
+                "longitude": lng,
+                "address": "東京都港区六本木7-8-4",
+                "nearest_station_name": "六本木",
+                "price": float(rng.uniform(3000, 12000)),
+                "exclusive_area": float(rng.uniform(20, 120)),
+                "floor": int(rng.integers(1, 20)),
+                "total_floors": 20,
+                "completion_date": "2005-04-01",
+                "layout_main": "3LDK",
+                "direction": "南",
+                "build_type": "RC",
+                "layout_storage_room": 0,
+                "common_area": 8.5,
+                "monthly_fee_total": 32000.0,
+            }
+        )
+        start = time.perf_counter()
+        conn.request(
+            "POST",
+            "/valuation",
+            body=body,
+            headers={"Content-Type": "application/json"},
+        )
+        resp = conn.getresponse()
+        resp.read()
+        latencies.append(time.perf_counter() - start)
+        if resp.status != 200:
+            raise RuntimeError(f"Status {resp.status} from {url}")
+    conn.close()
+    return latencies
+
+
+@click.command()
+@click.option(
+    "--url",
+    default=None,
+    type=str,
+    help="Running service to test, start a synthetic one in process if not set",
+)
+@click.option("--clients", default=4, type=int, show_default=True)
+@click.option(
+    "--requests", default=1000, type=int, show_default=True, help="Per client"
+)
+@click.option("--seed", default=0, type=int, show_default=True)
+def main(url: Optional[str], clients: int, requests: int, seed: int):
+    logging.basicConfig(level=logging.INFO)
+    server = None
+    if url is None:
+        server = ValuationServer(synthetic_service(seed), "127.0.0.1", 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        log.info(f"Synthetic service started on {url}")
+    try:
+        # Warm up
+        run_client(url, 20, seed)
+        # Clients in other processes, so they don't compete for the GIL with an in-process server
+        start = time.perf_counter()
+        with ProcessPoolExecutor(clients) as executor:
+            latencies = np.concatenate(
+                list(
+                    executor.map(
+                        run_client,
+                        [url] * clients,
+                        [requests] * clients,
+                        range(seed + 1, seed + 1 + clients),
+                    )
+                )
+            )
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+    log.info(
+        f"{len(latencies)} requests by {clients} clients in {elapsed:.2f}s, "
+        f"{len(latencies) / elapsed:.0f} req/s, "
+        f"latency p50={p50:.2f}ms p90={p90:.2f}ms p99={p99:.2f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,157 @@
 import logging
+from typing import Optional
 
 import click
 
-from domus_analytica.cli.gis_import.bus_stop import import_bus_stops
-from domus_analytica.cli.gis_import.mafia import import_mafia
-from domus_analytica.cli.gis_import.poi_collector import import_google_poi
-from domus_analytica.cli.gis_import.population import import_population_grid_data
-from domus_analytica.cli.gis_import.station_passengers import import_station_passengers
-from domus_analytica.cli.suumo import download_from_suumo
-from domus_analytica.cli.trading.api import download_trading_record
-from domus_analytica.cli.trading.csv import import_trading_record
+from domus_analytica.cli.lazy import LazyGroup
 
 log = logging.getLogger(__name__)
 
 
-@click.group()
+# Subcommands are imported only when they run, keep heavy imports out of this module
+# and inside the command functions, `python -m benchmarks.cli_startup` checks it
+@click.group(cls=LazyGroup)
 @click.option("--debug", "-v", is_flag=True, help="Print debug logs.")
-def app(debug: bool):
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time the stages of feature extraction and MongoDB queries, report them at exit.",
+)
+@click.option(
+    "--metrics-port",
+    type=int,
+    envvar="DOMUS_METRICS_PORT",
+    help="Serve metrics in Prometheus text format on 127.0.0.1:<port>/metrics while running.",
+)
+@click.option(
+    "--metrics-summary",
+    type=click.Path(dir_okay=False),
+    envvar="DOMUS_METRICS_SUMMARY",
+    help="Write metrics to this JSON file at exit.",
+)
+@click.pass_context
+def app(
+    ctx: click.Context,
+    debug: bool,
+    profile: bool,
+    metrics_port: Optional[int],
+    metrics_summary: Optional[str],
+):
     logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+    if profile:
+        from domus_analytica.profiling import enable_profiling
 
+        ctx.call_on_close(enable_profiling().log_report)
+    if metrics_port is not None or metrics_summary:
+        from domus_analytica.metrics import REGISTRY, serve_metrics, stop_metrics
 
-app.command("suumo", help="Download data from SUUMO")(download_from_suumo)
+        server = serve_metrics(metrics_port) if metrics_port is not None else None
+        ctx.call_on_close(lambda: stop_metrics(server))
+        if metrics_summary:
+            ctx.call_on_close(lambda: REGISTRY.write_summary(metrics_summary))
 
-app.command("import-trading-csv")(import_trading_record)
-app.command("import-trading-api")(download_trading_record)
 
+app.lazy_command(
+    "suumo", "domus_analytica.cli.suumo:download_from_suumo", "Download data from SUUMO"
+)
+app.lazy_command("train", "domus_analytica.cli.train:train", "Train price model")
+app.lazy_command(
+    "tune", "domus_analytica.cli.tune:tune", "Search hyperparameters of price model"
+)
+app.lazy_command(
+    "score", "domus_analytica.cli.score:score", "Write price estimates to listings"
+)
+app.lazy_command(
+    "serve", "domus_analytica.cli.serve:serve", "Serve price estimation over HTTP"
+)
 
-@app.group()
+app.lazy_command(
+    "ensure-indexes",
+    "domus_analytica.cli.ensure_indexes:ensure_indexes",
+    "Build indexes of all collections and check the plans of queries",
+)
+
+app.lazy_command(
+    "import-trading-csv", "domus_analytica.cli.trading.csv:import_trading_record"
+)
+app.lazy_command(
+    "import-trading-api", "domus_analytica.cli.trading.api:download_trading_record"
+)
+app.lazy_command(
+    "trading-rollup", "domus_analytica.cli.trading.rollup:build_trading_rollup"
+)
+
+
+@app.group(cls=LazyGroup)
+def enrich():
+    pass
+
+
+enrich.lazy_command(
+    "enqueue",
+    "domus_analytica.cli.enrich:enqueue",
+    "Split listings without features into jobs",
+)
+enrich.lazy_command(
+    "work",
+    "domus_analytica.cli.enrich:work",
+    "Claim jobs and write features, run on any number of hosts",
+)
+enrich.lazy_command(
+    "stream",
+    "domus_analytica.cli.enrich:stream",
+    "Enrich and score listings from the change stream of suumo_details",
+)
+enrich.lazy_command(
+    "status", "domus_analytica.cli.enrich:status", "Print counts of jobs by status"
+)
+
+
+@app.group(cls=LazyGroup)
+def listing_history():
+    pass
+
+
+listing_history.lazy_command(
+    "backfill",
+    "domus_analytica.cli.listing_history:backfill_listing_history",
+    "Replay suumo_details snapshots into the listing history",
+)
+listing_history.lazy_command(
+    "show",
+    "domus_analytica.cli.listing_history:show_listing_history",
+    "Print the changes of a listing",
+)
+
+
+@app.group(cls=LazyGroup)
 def gis_import():
     pass
 
 
-gis_import.command("station-passengers")(import_station_passengers)
-gis_import.command("population")(import_population_grid_data)
-gis_import.command("bus-stop")(import_bus_stops)
-gis_import.command("google-poi")(import_google_poi)
-gis_import.command("mafia")(import_mafia)
+gis_import.lazy_command(
+    "station-passengers",
+    "domus_analytica.cli.gis_import.station_passengers:import_station_passengers",
+)
+gis_import.lazy_command(
+    "population",
+    "domus_analytica.cli.gis_import.population:import_population_grid_data",
+)
+gis_import.lazy_command(
+    "bus-stop", "domus_analytica.cli.gis_import.bus_stop:import_bus_stops"
+)
+gis_import.lazy_command(
+    "google-poi", "domus_analytica.cli.gis_import.poi_collector:import_google_poi"
+)
+gis_import.lazy_command("mafia", "domus_analytica.cli.gis_import.mafia:import_mafia")
+gis_import.lazy_command(
+    "migrate-layout", "domus_analytica.cli.gis_import.migrate:migrate_poi_layout"
+)
+gis_import.lazy_command(
+    "export-snapshot",
+    "domus_analytica.cli.gis_import.snapshot:export_poi_snapshot",
+)
+gis_import.lazy_command(
+    "export-raster",
+    "domus_analytica.cli.gis_import.raster:export_poi_raster",
+)
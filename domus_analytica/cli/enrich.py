@@ -0,0 +1,225 @@
+import json
+import logging
+from datetime import timedelta
+from typing import Optional
+
+import click
+from bson import json_util
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--filter",
+    "suumo_filter",
+    default="{}",
+    type=str,
+    show_default=True,
+    help="Filter of suumo_details in MongoDB extended JSON",
+)
+@click.option(
+    "--chunk-size",
+    default=500,
+    type=int,
+    show_default=True,
+    help="Listings per job",
+)
+@click.option(
+    "--retry-failed",
+    is_flag=True,
+    help="Put the failed jobs back to the queue as well",
+)
+def enqueue(suumo_filter: str, chunk_size: int, retry_failed: bool):
+    """
+    Split the listings without features of the current version into jobs
+    """
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.enrichment import EnrichmentQueue
+    from domus_analytica.mongo import get_database
+
+    config = DomusSettings()
+    db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    queue = EnrichmentQueue(db)
+    queue.ensure_indexes()
+    if retry_failed:
+        log.info(f"{queue.retry_failed()} failed jobs put back to the queue")
+    queue.enqueue(
+        db.get_collection(config.suumo_collection),
+        json_util.loads(suumo_filter),
+        chunk_size=chunk_size,
+    )
+
+
+@click.option(
+    "--worker-id",
+    default=None,
+    type=str,
+    help="Owner of the leases, <host>:<pid> by default",
+)
+@click.option(
+    "--lease-seconds",
+    default=600,
+    type=int,
+    show_default=True,
+    help="A job not completed in this period is claimed by another worker",
+)
+@click.option(
+    "--max-attempts",
+    default=3,
+    type=int,
+    show_default=True,
+    help="A job failed this many times is marked failed",
+)
+@click.option(
+    "--max-jobs",
+    default=None,
+    type=int,
+    help="Stop after this count of jobs",
+)
+@click.option(
+    "--poll-interval",
+    default=None,
+    type=float,
+    help="Wait for new jobs with this interval in seconds instead of stopping when the queue is empty",
+)
+@click.option(
+    "--model",
+    "model_path",
+    default=None,
+    type=str,
+    help="Score the listings as well with this model artifact directory, or the model directory "
+    "to use the latest one, needed for the jobs requeued by `enrich stream`",
+)
+def work(
+    worker_id: Optional[str],
+    lease_seconds: int,
+    max_attempts: int,
+    max_jobs: Optional[int],
+    poll_interval: Optional[float],
+    model_path: Optional[str],
+):
+    """
+    Claim jobs and write features to suumo_features, run it on as many hosts as needed
+    """
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.enrichment import (
+        EnrichmentQueue,
+        default_worker_id,
+        run_worker,
+    )
+    from domus_analytica.model import ModelArtifact
+    from domus_analytica.mongo import get_database
+
+    config = DomusSettings()
+    queue = EnrichmentQueue(
+        get_database(config.mongo_uri, config.mongo_db_name, config)
+    )
+    worker_id = worker_id or default_worker_id()
+    log.info(f"Worker {worker_id} started")
+    report = run_worker(
+        config,
+        queue,
+        worker_id,
+        lease=timedelta(seconds=lease_seconds),
+        max_attempts=max_attempts,
+        max_jobs=max_jobs,
+        poll_interval=poll_interval,
+        artifact=ModelArtifact.load(model_path) if model_path else None,
+    )
+    log.info(f"Worker {worker_id} finished: {report}")
+
+
+@click.option(
+    "--max-attempts",
+    default=3,
+    type=int,
+    show_default=True,
+    help="Jobs whose lease expired on this attempt are marked failed",
+)
+def status(max_attempts: int):
+    """
+    Print counts of jobs and listings by status
+    """
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.enrichment import EnrichmentQueue
+    from domus_analytica.mongo import get_database
+
+    config = DomusSettings()
+    queue = EnrichmentQueue(
+        get_database(config.mongo_uri, config.mongo_db_name, config)
+    )
+    exhausted = queue.fail_exhausted(max_attempts)
+    if exhausted:
+        log.warning(f"{exhausted} jobs expired on their last attempt, marked failed")
+    click.echo(json.dumps(queue.status(), indent=2))
+
+
+@click.option(
+    "--max-batch",
+    default=200,
+    type=int,
+    show_default=True,
+    help="Process a batch when it has this count of changed listings",
+)
+@click.option(
+    "--max-wait",
+    default=2.0,
+    type=float,
+    show_default=True,
+    help="Or when its first change waited this many seconds",
+)
+@click.option(
+    "--model",
+    "model_path",
+    default="models",
+    type=str,
+    show_default=True,
+    help="Model artifact directory, or the model directory to use the latest one",
+)
+@click.option(
+    "--score/--no-score",
+    default=True,
+    show_default=True,
+    help="Write price_estimate and cp_value of the changed listings as well",
+)
+@click.option(
+    "--reset",
+    is_flag=True,
+    help="Forget the saved resume token and start from now",
+)
+def stream(
+    max_batch: int,
+    max_wait: float,
+    model_path: str,
+    score: bool,
+    reset: bool,
+):
+    """
+    Enrich and score listings as they are inserted or updated, needs a replica set
+    """
+    from pymongo.errors import OperationFailure
+
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.enrichment_stream import StreamEnricher, change_stream_error
+    from domus_analytica.model import ModelArtifact
+    from domus_analytica.mongo import get_database
+
+    config = DomusSettings()
+    db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    artifact = ModelArtifact.load(model_path) if score else None
+    enricher = StreamEnricher(config, db, artifact=artifact)
+    if reset and enricher.tokens.reset(enricher.stream_id):
+        log.info(f"Resume token of {enricher.stream_id} removed")
+    if artifact is not None:
+        log.info(f"Scoring with model {artifact.version}, restart to use a newer one")
+    try:
+        enricher.run(max_batch=max_batch, max_wait=max_wait)
+    except OperationFailure as ex:
+        message = change_stream_error(ex)
+        if message is None:
+            raise
+        raise click.ClickException(message) from ex
+    except KeyboardInterrupt:
+        # The pending batch wasn't saved, it's processed again after restart
+        pass
+    log.info(f"Change stream stopped: {enricher.report}")
@@ -0,0 +1,112 @@
+import logging
+
+import click
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--build/--no-build",
+    default=True,
+    show_default=True,
+    help="Create the declared indexes",
+)
+@click.option(
+    "--check/--no-check",
+    default=True,
+    show_default=True,
+    help="Explain the canonical queries and fail if any of them scans a collection",
+)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--listing-coll",
+    default="suumo_listings",
+    type=str,
+    help="Collection of current listings of the listing history",
+)
+@click.option(
+    "--trading-csv-coll",
+    default="japan_trading",
+    type=str,
+    help="Collection of import-trading-csv",
+)
+@click.option(
+    "--trading-api-coll",
+    default="japan_trading_api",
+    type=str,
+    help="Collection of import-trading-api",
+)
+@click.option(
+    "--rollup-coll",
+    default="japan_trading_rollup",
+    type=str,
+    help="Collection of trading-rollup",
+)
+@click.option(
+    "--poi-coll",
+    default="japan_gis_poi",
+    type=str,
+    help="Base MongoDB collection of POI data",
+)
+@click.option(
+    "--poi-layout",
+    default="shared",
+    type=click.Choice(["shared", "partial", "split"]),
+    envvar="POI_STORAGE_LAYOUT",
+    help="Storage layout of POI collections",
+)
+def ensure_indexes(
+    build: bool,
+    check: bool,
+    mongo_uri: str,
+    mongo_db: str,
+    listing_coll: str,
+    trading_csv_coll: str,
+    trading_api_coll: str,
+    rollup_coll: str,
+    poi_coll: str,
+    poi_layout: str,
+):
+    from domus_analytica.indexes import (
+        CollectionNames,
+        build_indexes,
+        canonical_queries,
+        check_queries,
+    )
+    from domus_analytica.mongo import get_database
+    from domus_analytica.poi_store import PoiStorageLayout, PoiStore
+
+    db = get_database(mongo_uri, mongo_db)
+    names = CollectionNames(
+        suumo_listings=listing_coll,
+        trading_csv=trading_csv_coll,
+        trading_api=trading_api_coll,
+        trading_rollup=rollup_coll,
+    )
+    poi_store = PoiStore(
+        db, layout=PoiStorageLayout(poi_layout), base_collection=poi_coll
+    )
+    if build:
+        build_indexes(db, names, poi_store)
+    if check:
+        plans = check_queries(db, canonical_queries(names, poi_store))
+        scans = [p for p in plans if p.collection_scan]
+        if scans:
+            raise click.ClickException(
+                f"{len(scans)} of {len(plans)} queries scan whole collections: "
+                + ", ".join(f"{p.query} ({p.collection})" for p in scans)
+            )
+        log.info(f"All {len(plans)} queries are served by indexes")
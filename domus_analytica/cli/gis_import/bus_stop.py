@@ -3,8 +3,9 @@ from pathlib import Path
 
 import click
 import geojson
-import pymongo
-from pymongo import MongoClient
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
 
 log = logging.getLogger(__name__)
 # https://nlftp.mlit.go.jp/ksj/gml/datalist/KsjTmplt-P11-2022.html
@@ -44,13 +45,30 @@ properties2field = {
     type=str,
     help="MongoDB collection for saving data",
 )
-def import_bus_stops(file: str, mongo_uri: str, mongo_db: str, mongo_coll: str):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    coll.create_index(
-        [
-            ("category", pymongo.ASCENDING),
-            ("loc", pymongo.GEOSPHERE),
-        ]
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Storage layout of POI collections",
+    envvar="POI_STORAGE_LAYOUT",
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Only write new or changed documents instead of reloading the category",
+)
+def import_bus_stops(
+    file: str,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    poi_layout: str,
+    upsert: bool,
+):
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
     )
     category = "bus_stop"
 
@@ -85,7 +103,18 @@ def import_bus_stops(file: str, mongo_uri: str, mongo_db: str, mongo_coll: str):
                     ),
                 }
 
-    coll.delete_many({"category": category})
-    for f in Path(file).glob("*/*.geojson"):
-        log.info(f"Importing data from {f}")
-        coll.insert_many(document_loader(f))
+    files = list(Path(file).glob("*/*.geojson"))
+    if upsert:
+        poi_store.upsert_category(
+            category,
+            (doc for f in files for doc in document_loader(f)),
+            key_func=lambda doc: "{}@{},{}".format(
+                doc["data"]["station_name"], *doc["loc"]["coordinates"]
+            ),
+        )
+    else:
+        poi_store.collection(category).delete_many(poi_store.category_filter(category))
+        for f in files:
+            log.info(f"Importing data from {f}")
+            poi_store.insert_many(category, document_loader(f))
+    poi_store.ensure_index(category)
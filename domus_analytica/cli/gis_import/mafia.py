@@ -1,12 +1,12 @@
 import logging
-import time
 
 import click
-import googlemaps
 import pandas as pd
-import pymongo
 from geojson import Point
-from pymongo import MongoClient
+
+from domus_analytica.geocoding import DEFAULT_GEOCODE_CACHE_COLLECTION, GeocodingService
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
 
 log = logging.getLogger(__name__)
 
@@ -117,6 +117,18 @@ mafia_df = pd.DataFrame(
     type=str,
     help="MongoDB collection for saving data",
 )
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Storage layout of POI collections",
+    envvar="POI_STORAGE_LAYOUT",
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Only write new or changed documents instead of reloading the category",
+)
 @click.option(
     "--google-api-key",
     required=True,
@@ -124,26 +136,35 @@ mafia_df = pd.DataFrame(
     help="Google API key for Google Map",
     envvar="GOOGLE_API_KEY",
 )
+@click.option(
+    "--geocode-cache-coll",
+    default=DEFAULT_GEOCODE_CACHE_COLLECTION,
+    type=str,
+    help="MongoDB collection for caching geocoding results",
+)
 def import_mafia(
     mongo_uri: str,
     mongo_db: str,
     mongo_coll: str,
+    poi_layout: str,
+    upsert: bool,
     google_api_key: str,
+    geocode_cache_coll: str,
 ):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    gmaps = googlemaps.Client(key=google_api_key)
-    coll.create_index(
-        [
-            ("category", pymongo.ASCENDING),
-            ("loc", pymongo.GEOSPHERE),
-        ]
+    db = get_database(mongo_uri, mongo_db)
+    poi_store = PoiStore(
+        db,
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
     )
+    geocoder = GeocodingService(google_api_key, db.get_collection(geocode_cache_coll))
     category = "mafia"
 
     def doc_generator():
+        geocode_results = geocoder.geocode_many(mafia_df["主たる事務所の所在地"])
+        log.info(f"{geocoder.api_requests} requests sent to Google Maps")
         for index, row in mafia_df.iterrows():
-            address = row["主たる事務所の所在地"]
-            for doc in gmaps.geocode(address=address, language="ja", region="ja"):
+            for doc in geocode_results[row["主たる事務所の所在地"]]:
                 yield {
                     "category": category,
                     "loc": Point(
@@ -155,5 +176,10 @@ def import_mafia(
                     "data": doc,
                 }
 
-    coll.delete_many({"category": category})
-    coll.insert_many(doc_generator())
+    if upsert:
+        poi_store.upsert_category(
+            category, doc_generator(), key_func=lambda doc: doc["data"]["place_id"]
+        )
+    else:
+        poi_store.replace_category(category, doc_generator())
+    poi_store.ensure_index(category)
@@ -0,0 +1,138 @@
+import logging
+from typing import List, Tuple
+
+import click
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStorageLayout, PoiStore
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--from-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Current storage layout of POI collections",
+)
+@click.option(
+    "--to-layout",
+    required=True,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Target storage layout of POI collections",
+)
+@click.option(
+    "--category",
+    "-c",
+    "categories",
+    multiple=True,
+    type=str,
+    help="Categories to migrate, migrate all categories if not specified",
+)
+@click.option(
+    "--batch-size",
+    default=10000,
+    type=int,
+    show_default=True,
+    help="Documents copied per batch",
+)
+@click.option(
+    "--drop-source",
+    is_flag=True,
+    help="Remove documents/indexes of the old layout after migration",
+)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database for saving data",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--mongo-coll",
+    default="japan_gis_poi",
+    type=str,
+    help="Base MongoDB collection of POI data",
+)
+def migrate_poi_layout(
+    from_layout: str,
+    to_layout: str,
+    categories: Tuple[str, ...],
+    batch_size: int,
+    drop_source: bool,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+):
+    db = get_database(mongo_uri, mongo_db)
+    source = PoiStore(
+        db, layout=PoiStorageLayout(from_layout), base_collection=mongo_coll
+    )
+    target = PoiStore(
+        db, layout=PoiStorageLayout(to_layout), base_collection=mongo_coll
+    )
+    if source.layout == target.layout:
+        raise ValueError(f"Source and target layout are both {source.layout.value}")
+
+    if categories:
+        migrate_categories: List[str] = list(categories)
+    elif source.layout == PoiStorageLayout.SPLIT:
+        existing = set(db.list_collection_names())
+        migrate_categories = [
+            c for c in POI_CATEGORIES if source.collection(c).name in existing
+        ]
+    else:
+        migrate_categories = db.get_collection(mongo_coll).distinct("category")
+    log.info(
+        f"Migrating categories {migrate_categories} from {from_layout} to {to_layout}"
+    )
+
+    for category in migrate_categories:
+        source_coll = source.collection(category)
+        target_coll = target.collection(category)
+        if source_coll.name != target_coll.name:
+            log.info(
+                f"Copying {category} from {source_coll.name} to {target_coll.name}"
+            )
+            target_coll.delete_many(target.category_filter(category))
+            copied = target.insert_many(
+                category,
+                source_coll.find(
+                    source.category_filter(category),
+                    projection={"_id": False},
+                    batch_size=batch_size,
+                ),
+            )
+            log.info(f"{copied} documents of {category} copied")
+        log.info(f"Building index for {category} in {target_coll.name}")
+        target.ensure_index(category)
+
+        if drop_source:
+            if source_coll.name != target_coll.name:
+                if source.layout == PoiStorageLayout.SPLIT:
+                    source_coll.drop()
+                else:
+                    source_coll.delete_many(source.category_filter(category))
+            elif source.layout == PoiStorageLayout.PARTIAL:
+                source_coll.drop_index(source.index_name(category))
+
+    if (
+        drop_source
+        and source.layout == PoiStorageLayout.SHARED
+        and target.layout == PoiStorageLayout.PARTIAL
+    ):
+        # The compound index is shared by all categories, drop it only if all of them have been migrated
+        remaining = set(db.get_collection(mongo_coll).distinct("category")) - set(
+            migrate_categories
+        )
+        if remaining:
+            log.warning(f"Compound index is kept since {remaining} are not migrated")
+        else:
+            db.get_collection(mongo_coll).drop_index("category_1_loc_2dsphere")
@@ -1,11 +1,20 @@
 import logging
-import time
+from typing import Optional
 
 import click
 import googlemaps
-import pymongo
 from geojson import Point
-from pymongo import MongoClient
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.mongo import get_database
+from domus_analytica.places import (
+    CachedPlacesClient,
+    PlacesResponseCache,
+    QuadtreeSweep,
+    QuotaExceeded,
+    SweepCell,
+)
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
 
 log = logging.getLogger(__name__)
 
@@ -13,10 +22,14 @@ log = logging.getLogger(__name__)
 @click.option(
     "--points",
     "-p",
-    required=True,
     type=str,
     help="Key points for searching, lng0,lat0;lng1,lat1;lng2,lat2;...",
 )
+@click.option(
+    "--bbox",
+    type=str,
+    help="Sweep the bounding box instead of key points, min_lng,min_lat,max_lng,max_lat",
+)
 @click.option(
     "--types",
     "-t",
@@ -51,6 +64,19 @@ log = logging.getLogger(__name__)
     type=str,
     help="MongoDB collection for saving data",
 )
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Storage layout of POI collections",
+    envvar="POI_STORAGE_LAYOUT",
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Only write new or changed documents instead of reloading the category, "
+    "--bbox always upserts",
+)
 @click.option(
     "--google-api-key",
     required=True,
@@ -64,65 +90,142 @@ log = logging.getLogger(__name__)
     type=int,
     help="Radius for searching",
 )
+@click.option(
+    "--min-radius",
+    default=300,
+    type=int,
+    show_default=True,
+    help="Cells smaller than this radius (m) will not be split in sweep mode",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    type=int,
+    show_default=True,
+    help="Cells queried concurrently in sweep mode",
+)
+@click.option(
+    "--quota",
+    default=None,
+    type=int,
+    help="Max requests sent to Places API, no limitation if not set, needs --upsert with --points",
+)
+@click.option(
+    "--cache-dir",
+    default="data/places_cache",
+    type=str,
+    show_default=True,
+    help="Directory for caching raw responses of Places API",
+)
 def import_google_poi(
-    points: str,
+    points: Optional[str],
+    bbox: Optional[str],
     types: str,
     category: str,
     mongo_uri: str,
     mongo_db: str,
     mongo_coll: str,
+    poi_layout: str,
+    upsert: bool,
     google_api_key: str,
     radius: int,
+    min_radius: int,
+    concurrency: int,
+    quota: Optional[int],
+    cache_dir: str,
 ):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    gmaps = googlemaps.Client(key=google_api_key)
-    coll.create_index(
-        [
-            ("category", pymongo.ASCENDING),
-            ("loc", pymongo.GEOSPHERE),
-        ]
+    if (points is None) == (bbox is None):
+        raise click.UsageError("Please specify either --points or --bbox")
+    if bbox and upsert:
+        raise click.UsageError(
+            "--bbox always upserts without removing documents, drop --upsert"
+        )
+    if points and quota is not None and not upsert:
+        # Reloading deletes the category first, a run stopped by the quota would leave it partial
+        raise click.UsageError("--quota with --points needs --upsert")
+    location_types = [t for t in types.split(",") if t]
+    if len(location_types) <= 0:
+        raise ValueError("Should specify types")
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
+    )
+    places_client = CachedPlacesClient(
+        googlemaps.Client(key=google_api_key),
+        PlacesResponseCache(cache_dir),
+        quota=quota,
     )
 
-    def places_nearby(**kwargs):
-        result = gmaps.places_nearby(**kwargs)
-        yield from result["results"]
-        if kwargs.get("radius") is not None:
-            while "next_page_token" in result:
-                try:
-                    result = gmaps.places_nearby(page_token=result["next_page_token"])
-                    yield from result["results"]
-                except Exception as e:
-                    if str(e).find("INVALID_REQUEST") != -1:
-                        time.sleep(1.0)
-                    else:
-                        raise e
+    def build_doc(doc: dict) -> dict:
+        return {
+            "category": category,
+            "loc": Point(
+                coordinates=[
+                    doc["geometry"]["location"]["lng"],
+                    doc["geometry"]["location"]["lat"],
+                ]
+            ),
+            "data": doc,
+        }
 
-    def doc_generator():
-        location_types = [t for t in types.split(",") if t]
-        if len(location_types) <= 0:
-            raise ValueError("Should specify types")
+    def point_places():
         for lon, lat in (
             (float(x[0]), float(x[1]))
             for x in (s.split(",") for s in points.split(";"))
         ):
-            log.info(f"Searching location {location_types} for ({lon},{lat})")
-            for doc in places_nearby(
-                location=(lat, lon),
-                type=location_types,
-                radius=radius,
-                language="ja",
-            ):
-                yield doc["place_id"], {
-                    "category": category,
-                    "loc": Point(
-                        coordinates=[
-                            doc["geometry"]["location"]["lng"],
-                            doc["geometry"]["location"]["lat"],
-                        ]
-                    ),
-                    "data": doc,
-                }
+            for location_type in location_types:
+                log.info(f"Searching location {location_type} for ({lon},{lat})")
+                try:
+                    for page in places_client.nearby(
+                        GeoPoint(latitude=lat, longitude=lon), radius, location_type
+                    ):
+                        yield from page["results"]
+                except QuotaExceeded as ex:
+                    # The places found so far are still written, like QuadtreeSweep
+                    log.warning(f"{ex}, the remaining key points are skipped")
+                    return
+
+    def sweep_places():
+        for location_type in location_types:
+            log.info(f"Sweeping {location_type} in {bbox}")
+            sweeper = QuadtreeSweep(
+                places_client,
+                location_type,
+                min_radius=min_radius,
+                concurrency=concurrency,
+            )
+            yield from sweeper.sweep(SweepCell.parse_bbox(bbox))
+            log.info(f"Sweep of {location_type} finished: {sweeper.report}")
 
-    docs_dict = dict(doc_generator())
-    coll.delete_many({"category": category})
-    coll.insert_many(docs_dict.values())
+    def doc_generator():
+        seen = set()
+        for doc in sweep_places() if bbox else point_places():
+            if doc["place_id"] not in seen:
+                seen.add(doc["place_id"])
+                yield build_doc(doc)
+
+    if bbox:
+        # A sweep may be limited by quota or cover part of the category, never remove documents
+        poi_store.upsert_category(
+            category,
+            doc_generator(),
+            key_func=lambda doc: doc["data"]["place_id"],
+            remove_missing=False,
+            batch_size=200,
+        )
+    elif upsert:
+        poi_store.upsert_category(
+            category,
+            doc_generator(),
+            key_func=lambda doc: doc["data"]["place_id"],
+            # A run limited by quota may not reach every key point
+            remove_missing=quota is None,
+        )
+    else:
+        poi_store.replace_category(category, doc_generator())
+    poi_store.ensure_index(category)
+    log.info(
+        f"{places_client.api_requests} requests sent to Places API, "
+        f"{places_client.cache_hits} responses loaded from cache"
+    )
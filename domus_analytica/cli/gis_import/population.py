@@ -5,9 +5,10 @@ import click
 import jismesh.utils as ju
 import numpy as np
 import pandas as pd
-import pymongo
 from geojson import Point
-from pymongo import MongoClient
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
 
 log = logging.getLogger(__name__)
 FIELDS = [
@@ -91,8 +92,25 @@ FIELDS = [
     type=str,
     help="MongoDB collection for saving data",
 )
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Storage layout of POI collections",
+    envvar="POI_STORAGE_LAYOUT",
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Only write new or changed documents instead of reloading the category",
+)
 def import_population_grid_data(
-    file: str, mongo_uri: str, mongo_db: str, mongo_coll: str
+    file: str,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    poi_layout: str,
+    upsert: bool,
 ):
 
     _path = Path(file)
@@ -103,12 +121,10 @@ def import_population_grid_data(
     else:
         raise ValueError(f"Can't handle file/path {file}")
 
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    coll.create_index(
-        [
-            ("category", pymongo.ASCENDING),
-            ("loc", pymongo.GEOSPHERE),
-        ]
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
     )
     category = "population"
 
@@ -134,10 +150,23 @@ def import_population_grid_data(
                 log.error(f"failed to process GPS in row: {row}", exc_info=e)
                 raise e
 
-    log.info("Cleaning expired data...")
-    rows_deleted = coll.delete_many({"category": category}).deleted_count
-    log.info(f"{rows_deleted} rows were deleted")
-    for p in paths:
-        log.info(f"Importing from file {p}")
-        if not coll.insert_many(document_loader(p)).acknowledged:
-            log.warning(f"Failed to load data from {p}")
+    if upsert:
+        poi_store.upsert_category(
+            category,
+            (doc for p in paths for doc in document_loader(p)),
+            key_func=lambda doc: str(doc["data"]["KEY_CODE"]),
+        )
+    else:
+        log.info("Cleaning expired data...")
+        rows_deleted = (
+            poi_store.collection(category)
+            .delete_many(poi_store.category_filter(category))
+            .deleted_count
+        )
+        log.info(f"{rows_deleted} rows were deleted")
+        for p in paths:
+            log.info(f"Importing from file {p}")
+            log.info(
+                f"{poi_store.insert_many(category, document_loader(p))} rows inserted"
+            )
+    poi_store.ensure_index(category)
@@ -0,0 +1,93 @@
+import logging
+from typing import Tuple
+
+import click
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--output",
+    "-o",
+    default="data/poi_raster",
+    type=str,
+    show_default=True,
+    help="Raster directory, replaced when the build finishes",
+)
+@click.option(
+    "--category",
+    "-c",
+    "categories",
+    multiple=True,
+    type=str,
+    help="Categories to build, the ones only queried for the nearest POI (mafia, google_cemetery) if not specified",
+)
+@click.option(
+    "--mesh",
+    default="500",
+    type=click.Choice(["500", "250"]),
+    show_default=True,
+    help="Cell size in meters, the 4th or 5th level of the regional mesh",
+)
+@click.option(
+    "--batch-size",
+    default=10000,
+    type=int,
+    show_default=True,
+    help="Documents read per batch",
+)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database for saving data",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--mongo-coll",
+    default="japan_gis_poi",
+    type=str,
+    help="Base MongoDB collection of POI data",
+)
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    envvar="POI_STORAGE_LAYOUT",
+    help="Storage layout of POI collections",
+)
+def export_poi_raster(
+    output: str,
+    categories: Tuple[str, ...],
+    mesh: str,
+    batch_size: int,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    poi_layout: str,
+):
+    from domus_analytica.poi_raster import RASTER_CATEGORIES, export_rasters
+
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
+    )
+    export_rasters(
+        poi_store,
+        output,
+        categories or RASTER_CATEGORIES,
+        mesh=int(mesh),
+        batch_size=batch_size,
+    )
+    log.info(f"Rasters written to {output}, set POI_RASTER_DIR={output} to use them")
@@ -0,0 +1,84 @@
+import logging
+from typing import Tuple
+
+import click
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStorageLayout, PoiStore
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--output",
+    "-o",
+    default="data/poi_snapshot",
+    type=str,
+    show_default=True,
+    help="Snapshot directory, replaced when the export finishes",
+)
+@click.option(
+    "--category",
+    "-c",
+    "categories",
+    multiple=True,
+    type=str,
+    help="Categories to export, export all categories if not specified",
+)
+@click.option(
+    "--batch-size",
+    default=10000,
+    type=int,
+    show_default=True,
+    help="Documents read per batch",
+)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database for saving data",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--mongo-coll",
+    default="japan_gis_poi",
+    type=str,
+    help="Base MongoDB collection of POI data",
+)
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    envvar="POI_STORAGE_LAYOUT",
+    help="Storage layout of POI collections",
+)
+def export_poi_snapshot(
+    output: str,
+    categories: Tuple[str, ...],
+    batch_size: int,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    poi_layout: str,
+):
+    from domus_analytica.poi_snapshot import export_snapshot
+
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
+    )
+    manifest = export_snapshot(
+        poi_store, output, categories or POI_CATEGORIES, batch_size=batch_size
+    )
+    total = sum(c["count"] for c in manifest["categories"].values())
+    log.info(
+        f"{total} POI exported to {output}, set POI_SNAPSHOT_DIR={output} to use it"
+    )
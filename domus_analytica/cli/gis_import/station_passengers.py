@@ -1,8 +1,9 @@
 import click
 import geojson
 import numpy as np
-import pymongo
-from pymongo import MongoClient
+
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_store import PoiStorageLayout, PoiStore
 
 # https://nlftp.mlit.go.jp/ksj/gml/datalist/KsjTmplt-S12-2021.html
 properties2field = {
@@ -42,15 +43,30 @@ properties2field = {
     type=str,
     help="MongoDB collection for saving data",
 )
+@click.option(
+    "--poi-layout",
+    default=PoiStorageLayout.SHARED.value,
+    type=click.Choice([x.value for x in PoiStorageLayout]),
+    help="Storage layout of POI collections",
+    envvar="POI_STORAGE_LAYOUT",
+)
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Only write new or changed documents instead of reloading the category",
+)
 def import_station_passengers(
-    file: str, mongo_uri: str, mongo_db: str, mongo_coll: str
+    file: str,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    poi_layout: str,
+    upsert: bool,
 ):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    coll.create_index(
-        [
-            ("category", pymongo.ASCENDING),
-            ("loc", pymongo.GEOSPHERE),
-        ]
+    poi_store = PoiStore(
+        get_database(mongo_uri, mongo_db),
+        layout=PoiStorageLayout(poi_layout),
+        base_collection=mongo_coll,
     )
     category = "station_passengers"
 
@@ -84,4 +100,14 @@ def import_station_passengers(
                     ),
                 }
 
-    coll.insert_many(document_loader())
+    if upsert:
+        poi_store.upsert_category(
+            category,
+            document_loader(),
+            key_func=lambda doc: "{}@{}".format(
+                doc["data"]["station_code"], doc["data"]["route_name"]
+            ),
+        )
+    else:
+        poi_store.replace_category(category, document_loader())
+    poi_store.ensure_index(category)
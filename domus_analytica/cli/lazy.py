@@ -0,0 +1,52 @@
+import importlib
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+
+class LazyGroup(click.Group):
+    """
+    Click group importing the module of a subcommand only when the subcommand runs,
+    so that a command doesn't pay for importing pandas, xgboost, etc. of the others
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # name -> (import path like "package.module:function", help)
+        self.lazy_commands: Dict[str, Tuple[str, Optional[str]]] = {}
+
+    def lazy_command(self, name: str, import_path: str, help: Optional[str] = None):
+        """
+        :param name: name of the subcommand
+        :param import_path: "package.module:attribute", the attribute is a click.Command
+            or a function decorated with click.option
+        :param help: shown in the help of the group without importing the module
+        """
+        self.lazy_commands[name] = (import_path, help)
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(super().list_commands(ctx)) | self.lazy_commands.keys())
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name in self.lazy_commands:
+            import_path, help = self.lazy_commands.pop(cmd_name)
+            module_name, attribute = import_path.split(":")
+            command = getattr(importlib.import_module(module_name), attribute)
+            if not isinstance(command, click.Command):
+                command = click.command(cmd_name, help=help)(command)
+            self.add_command(command, cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.lazy_commands:
+                rows.append((name, self.lazy_commands[name][1] or ""))
+            else:
+                command = super().get_command(ctx, name)
+                if command is None or command.hidden:
+                    continue
+                rows.append((name, command.get_short_help_str(formatter.width)))
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
@@ -0,0 +1,98 @@
+import json
+import logging
+
+import click
+
+from domus_analytica.mongo import get_database
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--filter",
+    "suumo_filter",
+    default="{}",
+    type=str,
+    show_default=True,
+    help="Filter of suumo_details in MongoDB extended JSON, selects the snapshots to replay",
+)
+@click.option(
+    "--batch-size",
+    default=1000,
+    type=int,
+    show_default=True,
+    help="Listings recorded per batch",
+)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--mongo-coll",
+    default="suumo_listings",
+    type=str,
+    help="Collection of current listings, changes are in <collection>_changes",
+)
+def backfill_listing_history(
+    suumo_filter: str, batch_size: int, mongo_uri: str, mongo_db: str, mongo_coll: str
+):
+    """
+    Replay suumo_details snapshots crawl by crawl into the listing history
+    """
+    import pymongo
+    from bson import json_util
+
+    from domus_analytica.listing_history import ListingHistoryStore, backfill
+
+    db = get_database(mongo_uri, mongo_db)
+    store = ListingHistoryStore(db, mongo_coll)
+    store.ensure_indexes()
+    snapshots = (
+        db.get_collection("suumo_details")
+        .find(json_util.loads(suumo_filter), batch_size=batch_size)
+        .sort([("search_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+    )
+    report = backfill(store, snapshots, batch_size=batch_size)
+    log.info(f"Backfill finished: {report}")
+
+
+@click.argument("url", type=str)
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--mongo-coll",
+    default="suumo_listings",
+    type=str,
+    help="Collection of current listings, changes are in <collection>_changes",
+)
+def show_listing_history(url: str, mongo_uri: str, mongo_db: str, mongo_coll: str):
+    """
+    Print the changes of a listing as JSON lines, URL is the path like /ms/chuko/tokyo/sc_minato/nc_12345678/
+    """
+    from domus_analytica.listing_history import ListingHistoryStore
+
+    store = ListingHistoryStore(get_database(mongo_uri, mongo_db), mongo_coll)
+    for change in store.history(url):
+        click.echo(json.dumps(change, ensure_ascii=False, default=str))
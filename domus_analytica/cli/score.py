@@ -0,0 +1,51 @@
+import logging
+
+import click
+from bson import json_util
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--filter",
+    "suumo_filter",
+    default="{}",
+    type=str,
+    show_default=True,
+    help="Filter of suumo_details in MongoDB extended JSON",
+)
+@click.option(
+    "--model",
+    "model_path",
+    default="models",
+    type=str,
+    show_default=True,
+    help="Model artifact directory, or the model directory to use the latest one",
+)
+@click.option(
+    "--batch-size",
+    default=5000,
+    type=int,
+    show_default=True,
+    help="Listings predicted and written in one batch",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only score listings inserted (changed in the history store) since the last run with the same filter and model",
+)
+def score(suumo_filter: str, model_path: str, batch_size: int, incremental: bool):
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.model import ModelArtifact
+    from domus_analytica.scoring import score_listings
+
+    config = DomusSettings()
+    artifact = ModelArtifact.load(model_path)
+    report = score_listings(
+        config,
+        artifact,
+        json_util.loads(suumo_filter),
+        batch_size=batch_size,
+        incremental=incremental,
+    )
+    log.info(f"Scoring finished with model {artifact.version}: {report}")
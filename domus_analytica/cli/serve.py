@@ -0,0 +1,32 @@
+import logging
+
+import click
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--model",
+    "model_path",
+    default="models",
+    type=str,
+    show_default=True,
+    help="Model artifact directory, or the model directory to use the latest one",
+)
+@click.option("--host", default="127.0.0.1", type=str, show_default=True)
+@click.option("--port", default=8080, type=int, show_default=True)
+def serve(model_path: str, host: str, port: int):
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.valuation import ValuationServer, ValuationService
+
+    service = ValuationService.load(DomusSettings(), model_path)
+    server = ValuationServer(service, host, port)
+    log.info(
+        f"Serving model {service.artifact.version} on http://{host}:{port}/valuation"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
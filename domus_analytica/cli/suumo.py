@@ -1,13 +1,9 @@
 import logging
+import time
 from datetime import datetime
-from typing import Iterable
 from urllib.parse import parse_qs, urlparse
 
 import click
-import pymongo
-
-from domus_analytica.config import DomusSettings
-from domus_analytica.spider import SuumoSpider, MongoDBPageCache
 
 log = logging.getLogger(__name__)
 
@@ -27,33 +23,74 @@ log = logging.getLogger(__name__)
 )
 @click.option("--detailed", is_flag=True, help="Download detailed data")
 @click.option("--use-cache", is_flag=True, help="Use cache for downloading data")
+@click.option(
+    "--history",
+    is_flag=True,
+    help="With --detailed, keep one current document per listing in suumo_listings and record "
+    "changes, instead of inserting a snapshot of every listing into suumo_details",
+)
+@click.option(
+    "--max-retries",
+    type=int,
+    default=3,
+    show_default=True,
+    help="Retries of a request on 429, 5xx and connection errors",
+)
+@click.option(
+    "--base-url",
+    type=str,
+    default="https://suumo.jp",
+    show_default=True,
+    envvar="SUUMO_BASE_URL",
+    help="Site to download from, e.g. the stand-in of `python -m benchmarks.suumo_server`",
+)
 def download_from_suumo(
-    search_url: str, wait_interval: float, detailed: bool, use_cache: bool
+    search_url: str,
+    wait_interval: float,
+    detailed: bool,
+    use_cache: bool,
+    history: bool,
+    max_retries: int,
+    base_url: str,
 ):
+    if history and not detailed:
+        raise click.UsageError("--history requires --detailed")
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.indexes import SUUMO_DETAILS_INDEXES, SUUMO_SEARCH_INDEXES
+    from domus_analytica.listing_history import (
+        CrawlReport,
+        ListingHistoryStore,
+        search_key,
+    )
+    from domus_analytica.metrics import record_write
+    from domus_analytica.mongo import get_database
+    from domus_analytica.spider import SuumoSpider, MongoDBPageCache
+
     config = DomusSettings()
-    domus_db = pymongo.MongoClient(config.mongo_uri).get_database(config.mongo_db_name)
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
     suumo_search = domus_db.get_collection("suumo_search")
+    suumo_search.create_indexes(SUUMO_SEARCH_INDEXES)
     suumo_details = domus_db.get_collection("suumo_details")
+    suumo_details.create_indexes(SUUMO_DETAILS_INDEXES)
+    history_store = ListingHistoryStore(domus_db)
+    if history:
+        history_store.ensure_indexes()
+    report = CrawlReport()
     spider = SuumoSpider(
         cache=MongoDBPageCache(config.mongo_uri, db_name=config.mongo_db_name),
         wait_interval=wait_interval,
         use_cache=use_cache,
+        base_url=base_url,
+        max_retries=max_retries,
     )
     search_url_parse = urlparse(search_url)
     # Query:
     query = parse_qs(search_url_parse.query)
     search_time = datetime.now()
 
-    def _iter_details(current_page_id: int) -> Iterable[dict]:
-        _content = spider.read_search_page(
-            search_url_parse.path, query, page_id=current_page_id, page_size=100
-        )
-        total_pages = spider.get_page_count(_content)
-        yield from spider.parse_search_page(_content)
-        if total_pages > current_page_id:
-            yield from _iter_details(current_page_id + 1)
-
-    for i, item_detail in enumerate(_iter_details(1)):
+    for i, item_detail in enumerate(
+        spider.iter_search_results(search_url_parse.path, query, page_size=100)
+    ):
         query_details = {
             "search_url": search_url_parse.path,
             "search_args": query,
@@ -67,8 +104,22 @@ def download_from_suumo(
             )
             item_detail_page_parsed["search_details"] = item_detail
             item_detail_page_parsed.update(query_details)
+            if history:
+                report.add(history_store.record(item_detail_page_parsed, search_time))
+                continue
+            start = time.perf_counter()
             suumo_details.insert_one(item_detail_page_parsed)
+            record_write(suumo_details.name, 1, time.perf_counter() - start)
         else:
             item_detail_save = item_detail.copy()
             item_detail_save.update(query_details)
+            start = time.perf_counter()
             suumo_search.insert_one(item_detail_save)
+            record_write(suumo_search.name, 1, time.perf_counter() - start)
+
+    if history:
+        # Every page was read, listings not seen this time are gone
+        report.removed = history_store.mark_removed(
+            search_key(search_url_parse.path, query), search_time
+        )
+        log.info(f"Listing history updated: {report}")
@@ -4,14 +4,24 @@
 
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
 
 import click
-import pymongo
 import requests
-from pymongo import MongoClient
+from requests.adapters import HTTPAdapter
+
+from domus_analytica.indexes import TRADING_API_INDEXES, TRADING_API_PROGRESS_INDEXES
+from domus_analytica.metrics import QUEUE_DEPTH, record_write, track_request
+from domus_analytica.mongo import get_database
+from domus_analytica.rate_limit import RateLimiter
 
 log = logging.getLogger(__name__)
 
+API_URL = "https://www.reinfolib.mlit.go.jp/ex-api/external/XIT001"
+AREA_CODES = [f"{x+1:02d}" for x in range(47)]
+
 
 @click.option(
     "--reinfolib-api-key",
@@ -40,43 +50,169 @@ log = logging.getLogger(__name__)
     type=str,
     help="MongoDB collection for saving data",
 )
+@click.option(
+    "--start-year",
+    default=2010,
+    type=int,
+    show_default=True,
+    help="First year to download",
+)
+@click.option(
+    "--end-year",
+    default=2023,
+    type=int,
+    show_default=True,
+    help="Last year to download",
+)
+@click.option(
+    "--concurrency",
+    default=4,
+    type=int,
+    show_default=True,
+    help="Requests sent concurrently",
+)
+@click.option(
+    "--rate-limit",
+    default=2.0,
+    type=float,
+    show_default=True,
+    help="Max requests per second",
+)
+@click.option(
+    "--max-retries",
+    default=5,
+    type=click.IntRange(min=0),
+    show_default=True,
+    help="Retries for each (year, area) before giving up",
+)
+@click.option(
+    "--refresh-days",
+    default=30,
+    type=int,
+    show_default=True,
+    help="Data of recent 2 years downloaded before this many days are downloaded again",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Download all (year, area) again even if they were downloaded",
+)
 def download_trading_record(
-    reinfolib_api_key: str, mongo_uri: str, mongo_db: str, mongo_coll: str
+    reinfolib_api_key: str,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    start_year: int,
+    end_year: int,
+    concurrency: int,
+    rate_limit: float,
+    max_retries: int,
+    refresh_days: int,
+    force: bool,
 ):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
-    coll.create_index([("param_year", pymongo.ASCENDING)])
-    coll.create_index([("param_area", pymongo.ASCENDING)])
-    coll.delete_many({})
+    db = get_database(mongo_uri, mongo_db)
+    coll = db.get_collection(mongo_coll)
+    coll.create_indexes(TRADING_API_INDEXES)
+    # One document per finished (year, area), used to resume downloading
+    progress_coll = db.get_collection(f"{mongo_coll}_progress")
+    progress_coll.create_indexes(TRADING_API_PROGRESS_INDEXES)
 
-    def download_data(area_code: str, year: int):
-        resp = requests.get(
-            "https://www.reinfolib.mlit.go.jp/ex-api/external/XIT001",
-            params={"year": f"{year:04d}", "area": area_code},
-            headers={"Ocp-Apim-Subscription-Key": reinfolib_api_key},
-        )
-        resp.raise_for_status()
-        statues = resp.json()["status"]
-        if statues != "OK":
-            raise ValueError(f"Response status is not OK but {statues}")
+    session = requests.session()
+    session.headers.update({"Ocp-Apim-Subscription-Key": reinfolib_api_key})
+    session.mount("https://", HTTPAdapter(pool_maxsize=concurrency))
+    limiter = RateLimiter(rate_limit)
+
+    def is_stale(progress: dict) -> bool:
+        # Records of past years are fixed, but recent ones are still updated quarterly
+        if progress["year"] < datetime.now().year - 1:
+            return False
+        return progress["complete_time"] < datetime.now() - timedelta(days=refresh_days)
+
+    def pending_cells() -> List[Tuple[int, str]]:
+        cells = [(y, a) for y in range(start_year, end_year + 1) for a in AREA_CODES]
+        if force:
+            return cells
+        finished = {
+            (p["year"], p["area"])
+            for p in progress_coll.find(
+                {"year": {"$gte": start_year, "$lte": end_year}}
+            )
+            if not is_stale(p)
+        }
+        return [c for c in cells if c not in finished]
 
-        return coll.insert_many(
-            (
-                dict(param_year=year, param_area=area_code, **doc)
-                for doc in resp.json()["data"]
+    def download_data(year: int, area_code: str) -> List[dict]:
+        limiter.acquire()
+        with track_request("reinfolib"):
+            resp = session.get(
+                API_URL, params={"year": f"{year:04d}", "area": area_code}, timeout=60
             )
-        ).acknowledged
+            resp.raise_for_status()
+        body = resp.json()
+        if body["status"] != "OK":
+            raise ValueError(f"Response status is not OK but {body['status']}")
+        return body["data"]
 
-    def retry_download(area_code: str, year: int):
-        ex = Exception("Unknown error")
-        for i in range(10):
+    def retry_download(year: int, area_code: str) -> int:
+        last_exception: Optional[Exception] = None
+        # The first attempt and max_retries retries
+        for i in range(max_retries + 1):
             try:
-                return download_data(area_code=area_code, year=year)
+                data = download_data(year, area_code)
+                break
             except Exception as ex:
-                log.error("Failed to download data", exc_info=ex)
-                time.sleep(5)
-        raise ex
+                last_exception = ex
+                log.warning(
+                    f"Failed to download area={area_code} year={year} on attempt {i + 1}",
+                    exc_info=ex,
+                )
+                if i < max_retries:
+                    time.sleep(min(2**i, 60))
+        else:
+            raise last_exception
 
-    for y in range(2010, 2024):
-        for a in (f"{x+1:02d}" for x in range(47)):
-            log.info(f"Downloading data for area={a} year={y}")
-            retry_download(a, y)
+        # Replace data of this (year, area) only
+        coll.delete_many({"param_year": year, "param_area": area_code})
+        if data:
+            start = time.perf_counter()
+            coll.insert_many(
+                (dict(param_year=year, param_area=area_code, **doc) for doc in data),
+                ordered=False,
+            )
+            record_write(coll.name, len(data), time.perf_counter() - start)
+        progress_coll.replace_one(
+            {"_id": f"{year}-{area_code}"},
+            {
+                "year": year,
+                "area": area_code,
+                "count": len(data),
+                "complete_time": datetime.now(),
+            },
+            upsert=True,
+        )
+        return len(data)
+
+    cells = pending_cells()
+    log.info(f"{len(cells)} (year, area) to download")
+    failed = []
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = {executor.submit(retry_download, y, a): (y, a) for y, a in cells}
+        QUEUE_DEPTH.set(len(futures), queue="reinfolib")
+        for i, future in enumerate(as_completed(futures)):
+            QUEUE_DEPTH.set(len(futures) - i - 1, queue="reinfolib")
+            year, area_code = futures[future]
+            try:
+                count = future.result()
+                log.info(
+                    f"[{i + 1}/{len(cells)}] {count} records downloaded "
+                    f"for area={area_code} year={year}"
+                )
+            except Exception as ex:
+                failed.append((year, area_code))
+                log.error(
+                    f"Gave up downloading area={area_code} year={year}", exc_info=ex
+                )
+    if failed:
+        raise click.ClickException(
+            f"{len(failed)} (year, area) failed, run again to resume: {failed}"
+        )
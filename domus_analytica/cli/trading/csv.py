@@ -2,15 +2,19 @@
 不動産価格記録データを導入する
 """
 
-import codecs
 import logging
-from _csv import QUOTE_ALL
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Tuple
 
 import click
-import numpy as np
 import pandas as pd
-from pymongo import MongoClient
+
+from domus_analytica.metrics import record_write
+from domus_analytica.mongo import get_database
+from domus_analytica.trading import parse_number, parse_quarter, parse_year
 
 log = logging.getLogger(__name__)
 FIELDS = [  # Thanks for ChatGPT!
@@ -47,6 +51,60 @@ FIELDS = [  # Thanks for ChatGPT!
 ]
 
 
+# Fields parsed to numbers, text like "2,000㎡以上" is parsed to the number in it
+NUMBER_FIELDS = [
+    "total_transaction_price",
+    "price_per_tsubo",
+    "area_in_sqm",
+    "price_per_sqm",
+    "frontage",
+    "floor_area_in_sqm",
+    "road_width_in_meters",
+    "coverage_ratio",
+    "floor_area_ratio",
+]
+
+
+def normalize_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.rename(columns={field["field"]: field["unix_name"] for field in FIELDS})
+    for field in NUMBER_FIELDS:
+        if field in df.columns:
+            df[field] = parse_number(df[field])
+    if "year_built" in df.columns:
+        df["year_built"] = parse_year(df["year_built"])
+    if "transaction_period" in df.columns:
+        df["transaction_quarter"] = parse_quarter(df["transaction_period"])
+    return df
+
+
+def import_csv_file(
+    path: Path, mongo_uri: str, mongo_db: str, mongo_coll: str, chunk_size: int
+) -> Tuple[int, float]:
+    """
+    Import one CSV file, it runs in a worker process
+    :return: rows imported and seconds elapsed
+    """
+    start = time.perf_counter()
+    coll = get_database(mongo_uri, mongo_db).get_collection(mongo_coll)
+    rows = 0
+    with pd.read_csv(
+        path,
+        encoding="cp932",
+        dtype="string",
+        on_bad_lines="skip",
+        chunksize=chunk_size,
+    ) as reader:
+        for chunk in reader:
+            chunk = normalize_chunk(chunk)
+            records = chunk.astype(object).where(chunk.notna(), None).to_dict("records")
+            coll.insert_many(
+                [{k: v for k, v in r.items() if v is not None} for r in records],
+                ordered=False,
+            )
+            rows += len(records)
+    return rows, time.perf_counter() - start
+
+
 @click.option(
     "--file",
     "-f",
@@ -74,8 +132,28 @@ FIELDS = [  # Thanks for ChatGPT!
     type=str,
     help="MongoDB collection for saving data",
 )
-def import_trading_record(file: str, mongo_uri: str, mongo_db: str, mongo_coll: str):
-    coll = MongoClient(mongo_uri).get_database(mongo_db).get_collection(mongo_coll)
+@click.option(
+    "--chunk-size",
+    default=50000,
+    type=int,
+    show_default=True,
+    help="Rows read and inserted per batch",
+)
+@click.option(
+    "--workers",
+    default=os.cpu_count(),
+    type=int,
+    help="Files imported in parallel, default to the count of CPUs",
+)
+def import_trading_record(
+    file: str,
+    mongo_uri: str,
+    mongo_db: str,
+    mongo_coll: str,
+    chunk_size: int,
+    workers: int,
+):
+    coll = get_database(mongo_uri, mongo_db).get_collection(mongo_coll)
     coll.delete_many({})
 
     _path = Path(file)
@@ -86,23 +164,26 @@ def import_trading_record(file: str, mongo_uri: str, mongo_db: str, mongo_coll:
     else:
         raise ValueError(f"Can't handle file/path {file}")
 
-    def csv_reader(path: Path):
-        with codecs.open(str(path), "rb", "cp932") as fp:
-            # noinspection PyTypeChecker
-            df = (
-                pd.read_csv(
-                    fp,
-                    on_bad_lines="skip",
-                )
-                .rename(
-                    columns={field["field"]: field["unix_name"] for field in FIELDS}
-                )
-                .replace([np.nan], [None])
+    start = time.perf_counter()
+    total_rows = 0
+    with ProcessPoolExecutor(min(workers, len(paths)) or 1) as executor:
+        futures = {
+            executor.submit(
+                import_csv_file, p, mongo_uri, mongo_db, mongo_coll, chunk_size
+            ): p
+            for p in paths
+        }
+        for future in as_completed(futures):
+            rows, elapsed = future.result()
+            total_rows += rows
+            # Files are imported in worker processes, record them as a whole
+            record_write(mongo_coll, rows, elapsed)
+            log.info(
+                f"Imported {rows} rows from {futures[future]} "
+                f"in {elapsed:.1f}s ({rows / max(elapsed, 1e-6):.0f} rows/s)"
             )
-        for _, row in df.iterrows():
-            yield {k: v for k, v in row.to_dict().items() if v is not None}
-
-    for p in paths:
-        log.info(f"Importing CSV file: {p}")
-        if not coll.insert_many(csv_reader(p)).acknowledged:
-            log.warning(f"Failed to insert CSV file: {p}")
+    elapsed = time.perf_counter() - start
+    log.info(
+        f"Imported {total_rows} rows from {len(paths)} files "
+        f"in {elapsed:.1f}s ({total_rows / max(elapsed, 1e-6):.0f} rows/s)"
+    )
@@ -0,0 +1,80 @@
+"""
+不動産価格記録データを集計する
+"""
+
+import logging
+from typing import Optional, Tuple
+
+import click
+
+from domus_analytica.mongo import get_database
+from domus_analytica.trading_rollup import (
+    DEFAULT_PROPERTY_TYPES,
+    DEFAULT_ROLLUP_COLLECTION,
+    TradingRollupBuilder,
+    TradingRollupStore,
+)
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--mongo-uri",
+    required=True,
+    type=str,
+    help="MongoDB URI to connect to MongoDB database",
+    envvar="MONGO_URI",
+)
+@click.option(
+    "--mongo-db",
+    default="domus",
+    type=str,
+    help="MongoDB database for saving data",
+    envvar="MONGO_DB_NAME",
+)
+@click.option(
+    "--csv-coll",
+    default="japan_trading",
+    type=str,
+    help="MongoDB collection imported by import-trading-csv, empty to skip it",
+)
+@click.option(
+    "--api-coll",
+    default=None,
+    type=str,
+    help="MongoDB collection imported by import-trading-api, e.g. japan_trading_api",
+)
+@click.option(
+    "--rollup-coll",
+    default=DEFAULT_ROLLUP_COLLECTION,
+    type=str,
+    help="MongoDB collection for saving rollups",
+)
+@click.option(
+    "--type",
+    "-t",
+    "property_types",
+    multiple=True,
+    default=DEFAULT_PROPERTY_TYPES,
+    show_default=True,
+    help="種類 of transactions to aggregate",
+)
+@click.option("--rebuild", is_flag=True, help="Rebuild rollups of all years")
+def build_trading_rollup(
+    mongo_uri: str,
+    mongo_db: str,
+    csv_coll: str,
+    api_coll: Optional[str],
+    rollup_coll: str,
+    property_types: Tuple[str, ...],
+    rebuild: bool,
+):
+    db = get_database(mongo_uri, mongo_db)
+    builder = TradingRollupBuilder(
+        TradingRollupStore(db, rollup_coll),
+        csv_coll=db.get_collection(csv_coll) if csv_coll else None,
+        api_coll=db.get_collection(api_coll) if api_coll else None,
+        property_types=list(property_types),
+    )
+    refreshed = builder.refresh(rebuild=rebuild)
+    log.info(f"Rollups of {len(refreshed)} years refreshed: {refreshed}")
@@ -0,0 +1,108 @@
+import json
+import logging
+from typing import Optional
+
+import click
+from bson import json_util
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--filter",
+    "suumo_filter",
+    default="{}",
+    type=str,
+    show_default=True,
+    help='Filter of suumo_details in MongoDB extended JSON, e.g. {"search_time": {"$date": "2024-04-01T14:46:31.449Z"}}',
+)
+@click.option(
+    "--cache-dir",
+    default="data/feature_cache",
+    type=str,
+    show_default=True,
+    help="Directory for caching feature matrices",
+)
+@click.option(
+    "--refresh-cache",
+    is_flag=True,
+    help="Rebuild the feature matrix even if it's cached",
+)
+@click.option(
+    "--model-dir",
+    default="models",
+    type=str,
+    show_default=True,
+    help="Directory for saving model artifacts",
+)
+@click.option("--n-estimators", default=6, type=int, show_default=True)
+@click.option("--max-depth", default=7, type=int, show_default=True)
+@click.option("--learning-rate", default=0.3, type=float, show_default=True)
+@click.option(
+    "--early-stopping-rounds",
+    default=None,
+    type=int,
+    help="Stop training if RMSE of validation set doesn't improve",
+)
+@click.option(
+    "--params-file",
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+    help="JSON of XGBoost parameters and num_boost_round (e.g. best.json of tune), overrides the options above",
+)
+@click.option(
+    "--nthread",
+    default=None,
+    type=int,
+    help="Threads for training, use all cores if not set",
+)
+def train(
+    suumo_filter: str,
+    cache_dir: str,
+    refresh_cache: bool,
+    model_dir: str,
+    n_estimators: int,
+    max_depth: int,
+    learning_rate: float,
+    early_stopping_rounds: Optional[int],
+    params_file: Optional[str],
+    nthread: Optional[int],
+):
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.model import (
+        DEFAULT_PARAMS,
+        build_feature_matrix,
+        data_version,
+        save_model_artifact,
+        train_model,
+    )
+
+    config = DomusSettings()
+    suumo_filter_obj = json_util.loads(suumo_filter)
+    matrix = build_feature_matrix(
+        config, suumo_filter_obj, cache_dir=cache_dir, refresh=refresh_cache
+    )
+    log.info(f"Training with {len(matrix.y)} rows and {len(matrix.features)} features")
+    params = dict(DEFAULT_PARAMS, max_depth=max_depth, learning_rate=learning_rate)
+    if params_file is not None:
+        with open(params_file, "r") as fp:
+            params.update(json.load(fp))
+        n_estimators = params.pop("num_boost_round", n_estimators)
+    booster, metrics = train_model(
+        matrix,
+        params=params,
+        num_boost_round=n_estimators,
+        early_stopping_rounds=early_stopping_rounds,
+        nthread=nthread,
+    )
+    for name, m in metrics.items():
+        log.info(f"Metrics of {name}: {m}")
+    artifact_dir = save_model_artifact(
+        booster,
+        matrix,
+        metrics,
+        dict(params, num_boost_round=n_estimators),
+        model_dir,
+        data_version_id=data_version(config, suumo_filter_obj),
+    )
+    log.info(f"Model saved to {artifact_dir}")
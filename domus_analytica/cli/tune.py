@@ -0,0 +1,84 @@
+import json
+import logging
+from pathlib import Path
+
+import click
+from bson import json_util
+
+log = logging.getLogger(__name__)
+
+
+@click.option(
+    "--filter",
+    "suumo_filter",
+    default="{}",
+    type=str,
+    show_default=True,
+    help="Filter of suumo_details in MongoDB extended JSON",
+)
+@click.option(
+    "--cache-dir",
+    default="data/feature_cache",
+    type=str,
+    show_default=True,
+    help="Directory for caching feature matrices",
+)
+@click.option(
+    "--study-dir",
+    default="data/tuning",
+    type=str,
+    show_default=True,
+    help="Directory for trials, run with the same directory to resume",
+)
+@click.option("--trials", default=50, type=int, show_default=True)
+@click.option("--folds", default=5, type=int, show_default=True)
+@click.option(
+    "--workers",
+    default=2,
+    type=int,
+    show_default=True,
+    help="Trials run in parallel processes",
+)
+@click.option("--max-rounds", default=1000, type=int, show_default=True)
+@click.option("--early-stopping-rounds", default=20, type=int, show_default=True)
+@click.option("--seed", default=0, type=int, show_default=True)
+def tune(
+    suumo_filter: str,
+    cache_dir: str,
+    study_dir: str,
+    trials: int,
+    folds: int,
+    workers: int,
+    max_rounds: int,
+    early_stopping_rounds: int,
+    seed: int,
+):
+    from domus_analytica.config import DomusSettings
+    from domus_analytica.model import build_feature_matrix
+    from domus_analytica.tuning import HyperparameterSearch, best_trial
+
+    matrix = build_feature_matrix(
+        DomusSettings(), json_util.loads(suumo_filter), cache_dir=cache_dir
+    )
+    search = HyperparameterSearch(
+        study_dir,
+        folds=folds,
+        workers=workers,
+        num_boost_round=max_rounds,
+        early_stopping_rounds=early_stopping_rounds,
+        seed=seed,
+    )
+    best = best_trial(search.run(matrix, trials))
+    if best is None:
+        raise click.ClickException("No trial finished")
+    best_path = Path(study_dir) / "best.json"
+    with open(best_path, "w") as fp:
+        json.dump(
+            dict(best.params, num_boost_round=best.best_rounds),
+            fp,
+            indent=2,
+        )
+    log.info(
+        f"Best trial {best.trial_id} with CV RMSE={best.rmse:.4f}, params saved to {best_path}, "
+        f"train with: domus-analytica train --params-file {best_path}"
+    )
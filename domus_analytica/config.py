@@ -1,8 +1,51 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
+from domus_analytica.listing_history import DEFAULT_LISTING_COLLECTION
+from domus_analytica.poi_store import DEFAULT_POI_COLLECTION, PoiStorageLayout
+
+DEFAULT_SUUMO_COLLECTION = "suumo_details"
+
+
+class MongoSettings(BaseSettings):
+    """
+    Options of the shared client, set by environment variables, e.g. MONGO_MAX_POOL_SIZE=100
+    """
 
-class DomusSettings(BaseSettings):
+    mongo_max_pool_size: int = 50
+    mongo_min_pool_size: int = 0
+    # In the order of preference, unavailable ones are skipped
+    mongo_compressors: str = "zstd,snappy,zlib"
+    mongo_connect_timeout_ms: int = 10000
+    mongo_server_selection_timeout_ms: int = 30000
+    mongo_socket_timeout_ms: Optional[int] = None
+    # Documents per batch of large cursors
+    mongo_batch_size: int = 1000
+
+
+class DomusSettings(MongoSettings):
     mongo_uri: str
     mongo_db_name: str
     google_api_key: str
     reinfolib_api_key: str
+    # Listings read by the pipeline, suumo_listings for the current documents of the history store
+    suumo_collection: str = DEFAULT_SUUMO_COLLECTION
+    # Whether suumo_collection is a listing history store, updated in place and selected by last_changed,
+    # only suumo_listings is if not set
+    suumo_listing_history: Optional[bool] = None
+    poi_storage_layout: PoiStorageLayout = PoiStorageLayout.SHARED
+    poi_collection: str = DEFAULT_POI_COLLECTION
+    # Directory written by `gis-import export-snapshot`, used instead of the POI collections if set
+    poi_snapshot_dir: Optional[str] = None
+    # Directory written by `gis-import export-raster`, answers the nearest queries of its categories if set
+    poi_raster_dir: Optional[str] = None
+    # Geocode 住所 of the listings without GPS (results are cached), for train, score and enrich alike
+    # so the features of every entry point match the ones the model was trained on
+    geocode_missing_gps: bool = False
+
+    @property
+    def reads_listing_history(self) -> bool:
+        if self.suumo_listing_history is not None:
+            return self.suumo_listing_history
+        return self.suumo_collection == DEFAULT_LISTING_COLLECTION
@@ -1,236 +1,384 @@
+import json
+import logging
 import re
-from typing import Optional
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
-import pymongo
+from pymongo.database import Database
 
 from domus_analytica.config import DomusSettings
+from domus_analytica.geocoding import DEFAULT_GEOCODE_CACHE_COLLECTION, GeocodingService
 from domus_analytica.geopoint import GeoPoint
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_index import PoiIndex
+from domus_analytica.poi_features import (
+    FEATURE_SPECS,
+    PoiFeatureSpec,
+    fetch_nearby,
+    spec_features,
+)
+from domus_analytica.poi_raster import PoiRasters, RasterPoiStore
+from domus_analytica.poi_snapshot import PoiSnapshot
+from domus_analytica.poi_store import PoiStore
+from domus_analytica.profiling import get_profiler
+from domus_analytica.trading_rollup import (
+    ComparableSalesSummary,
+    TradingRollupStore,
+    add_comparable_sales_features,
+)
+
+log = logging.getLogger(__name__)
 
 
 def extract_info_to_table(config: DomusSettings, suumo_filter: dict) -> pd.DataFrame:
     """
     The spider only did the basic information extraction, we need to convert them to usable values
-    :param config: DomusSettings instance
+    :param config: DomusSettings instance, listings without GPS are geocoded if geocode_missing_gps is set
     :param suumo_filter: To filter the data you want to use in suumo_details
     :return:
     """
-    domus_db = pymongo.MongoClient(config.mongo_uri).get_database(config.mongo_db_name)
-    suumo_details = domus_db.get_collection("suumo_details")
-    japan_gis_poi = domus_db.get_collection("japan_gis_poi")
-
-    def build_poi_filter(
-        category: str, point: GeoPoint, max_distance: Optional[float] = None
-    ) -> dict:
-        _near = {
-            "$geometry": {
-                "type": "Point",
-                "coordinates": [
-                    point.longitude,
-                    point.latitude,
-                ],
-            },
-        }
-        if max_distance:
-            _near["$maxDistance"] = max_distance
-        return {
-            "category": category,
-            "loc": {"$near": _near},
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    return extract_listings(config, suumo_filter, open_poi_store(config, domus_db))
+
+
+def open_poi_store(
+    config: DomusSettings, domus_db: Database
+) -> Union[PoiStore, PoiSnapshot, RasterPoiStore]:
+    """
+    POI for GIS features as configured, open it once for repeated extractions
+    """
+    poi_store: Union[PoiStore, PoiSnapshot, RasterPoiStore] = (
+        PoiSnapshot(config.poi_snapshot_dir)
+        if config.poi_snapshot_dir
+        else PoiStore(
+            domus_db,
+            layout=config.poi_storage_layout,
+            base_collection=config.poi_collection,
+        )
+    )
+    if config.poi_raster_dir:
+        poi_store = RasterPoiStore(poi_store, PoiRasters(config.poi_raster_dir))
+    return poi_store
+
+
+def poi_source_version(config: DomusSettings, domus_db: Database) -> dict:
+    """
+    Identify the POI open_poi_store reads, by the creation of the snapshot and the raster
+    or by the last import of each category
+    """
+
+    def created(path: str) -> str:
+        with open(Path(path) / "manifest.json", "r") as fp:
+            return json.load(fp)["create_time"]
+
+    version = (
+        {"snapshot": created(config.poi_snapshot_dir)}
+        if config.poi_snapshot_dir
+        else {
+            "categories": PoiStore(
+                domus_db,
+                layout=config.poi_storage_layout,
+                base_collection=config.poi_collection,
+            ).update_times()
         }
+    )
+    if config.poi_raster_dir:
+        version["raster"] = created(config.poi_raster_dir)
+    return version
+
+
+def extract_listings(
+    config: DomusSettings,
+    suumo_filter: dict,
+    poi_store: Union[PoiStore, PoiSnapshot, RasterPoiStore],
+    comps: Optional[ComparableSalesSummary] = None,
+    failed: Optional[List] = None,
+) -> pd.DataFrame:
+    """
+    extract_info_to_table with the POI and comparable sales loaded by the caller,
+    for the ones extracting many batches (score, enrich)
+    :param poi_store: result of open_poi_store
+    :param comps: summarized comparable sales, loaded from the rollups for this call if None
+    :param failed: skip the listings failed to parse and append their _id to it, raise if None
+    :return: rows of the listings
+    """
+    profiler = get_profiler()
+    with profiler.stage("extract"):
+        return _extract_listings(config, suumo_filter, poi_store, comps, failed)
+
+
+def _extract_listings(
+    config: DomusSettings,
+    suumo_filter: dict,
+    poi_store: Union[PoiStore, PoiSnapshot, RasterPoiStore],
+    comps: Optional[ComparableSalesSummary],
+    failed: Optional[List],
+) -> pd.DataFrame:
+    profiler = get_profiler()
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    suumo_details = domus_db.get_collection(config.suumo_collection)
+    poi_store = profiler.wrap_poi_store(poi_store)
+
+    geocoded_locations: Dict[str, GeoPoint] = {}
+    if config.geocode_missing_gps:
+        # Resolve all GPS-less listings in one batch, so the loop below only does dict lookups
+        geocoder = GeocodingService(
+            config.google_api_key,
+            domus_db.get_collection(DEFAULT_GEOCODE_CACHE_COLLECTION),
+        )
+        with profiler.stage("geocode"):
+            geocoded_locations = geocoder.locate_many(
+                d["content"]
+                for doc in suumo_details.find(
+                    dict(suumo_filter, gps={"$exists": False}),
+                    projection={"content_details": True},
+                )
+                for d in doc["content_details"]
+                if d["type"] == "住所"
+            )
+        log.info(
+            f"{len(geocoded_locations)} listings without GPS geocoded, "
+            f"{geocoder.api_requests} requests sent to Google Maps"
+        )
 
     table_data = []
 
-    for doc in suumo_details.find(suumo_filter):
-        # Extract fields from doc
-        id_url = doc["search_details"]["url"]
-        result_doc = {"id": id_url}
-        content_details = {d["type"]: d["content"] for d in doc["content_details"]}
+    cursor = suumo_details.find(suumo_filter, batch_size=config.mongo_batch_size)
+    while True:
+        with profiler.stage("cursor"):
+            doc = next(cursor, None)
+        if doc is None:
+            break
+        start = time.perf_counter()
+        try:
+            result_doc = _extract_listing(doc, poi_store, geocoded_locations)
+        except Exception as ex:
+            if failed is None:
+                raise
+            log.warning(f"Listing {doc['_id']} skipped: {ex!r}")
+            failed.append(doc["_id"])
+            continue
+        table_data.append(result_doc)
+        profiler.record_document(doc["_id"], time.perf_counter() - start)
+
+    with profiler.stage("dataframe"):
+        table = pd.DataFrame(table_data)
+    with profiler.stage("comparable_sales"):
+        if comps is None:
+            return add_comparable_sales_features(table, TradingRollupStore(domus_db))
+        return comps.join(table)
 
-        def get_first(regexp: str) -> Optional[str]:
-            for d in doc["content_details"]:
-                if re.match(regexp, d["type"]) is not None:
-                    return d["content"]
-            return None
 
-        result_doc["name"] = content_details["物件名"]
-        result_doc["address"] = content_details["住所"].split("\n")[0]
+def _extract_listing(
+    doc: dict, poi_store, geocoded_locations: Dict[str, GeoPoint]
+) -> dict:
+    profiler = get_profiler()
+    with profiler.stage("parse"):
+        result_doc = parse_listing(doc)
+    result_doc["doc_id"] = doc["_id"]
+    address = next(d["content"] for d in doc["content_details"] if d["type"] == "住所")
+    if "gps" in doc:
+        this_location = GeoPoint.parse_obj(doc["gps"])
+        result_doc["location_source"] = "suumo"
+    elif address in geocoded_locations:
+        this_location = geocoded_locations[address]
+        result_doc["location_source"] = "geocode"
+    else:
+        this_location = None
 
-        if "価格" in content_details:
-            result_doc["price"] = float(
-                re.findall("([+-]?([0-9]*[.])?[0-9]+)万円", content_details["価格"])[0][
-                    0
-                ]
+    if this_location is not None:
+        with profiler.stage("gis"):
+            result_doc.update(gis_features(poi_store, this_location))
+    return result_doc
+
+
+def parse_listing(doc: dict) -> dict:
+    """
+    Convert the texts of a SUUMO detail page to values
+    :param doc: document in suumo_details (or parsed by SuumoSpider.parse_detail_page with search_details)
+    :return: listing attributes without GIS features
+    """
+    # Extract fields from doc
+    id_url = doc["search_details"]["url"]
+    result_doc = {"id": id_url}
+    content_details = {d["type"]: d["content"] for d in doc["content_details"]}
+
+    def get_first(regexp: str) -> Optional[str]:
+        for d in doc["content_details"]:
+            if re.match(regexp, d["type"]) is not None:
+                return d["content"]
+        return None
+
+    result_doc["name"] = content_details["物件名"]
+    result_doc["address"] = content_details["住所"].split("\n")[0]
+
+    access = get_first(".*?交通.*?")
+    if access:
+        station_names = re.findall("「(.+?)」", access)
+        if station_names:
+            result_doc["nearest_station_name"] = station_names[0]
+
+    if "価格" in content_details:
+        result_doc["price"] = float(
+            re.findall("([+-]?([0-9]*[.])?[0-9]+)万円", content_details["価格"])[0][0]
+        )
+
+    if "専有面積" in content_details:
+        sr = re.findall("([+-]?([0-9]*[.])?[0-9]+)(m2|㎡)", content_details["専有面積"])
+        if sr:
+            result_doc["exclusive_area"] = float(sr[0][0])
+        else:
+            raise ValueError(
+                "Can't get area from {}".format(content_details["専有面積"])
             )
+    else:
+        log.warning(f"専有面積 can not be found in content_details of {id_url}")
 
-        if "専有面積" in content_details:
-            sr = re.findall(
-                "([+-]?([0-9]*[.])?[0-9]+)(m2|㎡)", content_details["専有面積"]
+    if "その他面積" in content_details:
+        result_doc["common_area"] = sum(
+            float(sr[0])
+            for sr in re.findall(
+                "([+-]?([0-9]*[.])?[0-9]+)(m2|㎡)", content_details["その他面積"]
             )
-            if sr:
-                result_doc["exclusive_area"] = float(sr[0][0])
+        )
+    else:
+        log.warning(f"その他面積 can not be found in content_details of {id_url}")
+
+    completion_date = get_first(".*?(完成時期|築年月).*?")
+    if completion_date:
+        try:
+            cd = re.findall(r"(\d{4})年(\d+)月", completion_date)[0]
+            result_doc["completion_date"] = f"{int(cd[0])}-{int(cd[1]):02d}-01"
+        except Exception as ex:
+            log.error(f"Can't get time from {completion_date} in {content_details}")
+            raise ex
+
+    layout = content_details.get("間取り")
+    if layout:
+        result_doc["layout_main"] = re.findall(r"(\d(L|D|K)+)", layout)[0][0]
+        storage_room = re.findall(r"\+(\d{0,1})S", layout)
+        if len(storage_room) > 0:
+            if storage_room[0] == "":
+                result_doc["layout_storage_room"] = 1
             else:
-                raise ValueError(
-                    "Can't get area from {}".format(content_details["専有面積"])
-                )
+                result_doc["layout_storage_room"] = int(storage_room[0])
         else:
-            print(f"専有面積 can not be found in content_details of {id_url}")
+            result_doc["layout_storage_room"] = 0
 
-        if "その他面積" in content_details:
-            result_doc["common_area"] = sum(
-                float(sr[0])
-                for sr in re.findall(
-                    "([+-]?([0-9]*[.])?[0-9]+)(m2|㎡)", content_details["その他面積"]
-                )
-            )
+    direction = content_details.get("向き")
+    if direction:
+        result_doc["direction"] = direction
+
+    result_doc["pet"] = re.match("ペット", doc["search_details"]["title"]) is not None
+    the_floor = content_details.get("所在階", get_first("所在階"))
+    if the_floor:
+        result_doc["floor"] = int(re.findall("(\d+)階", the_floor)[0])
+
+    total_floors = get_first(".*?階建.*?")
+    if total_floors:
+        try:
+            result_doc["total_floors"] = int(re.findall("(\d+)階建", total_floors)[0])
+        except Exception as ex:
+            log.error(f"Can't parse {total_floors}")
+            raise ex
+
+    build_type = get_first(".*?構造.*?")
+    if build_type:
+        if build_type.find("木造") >= 0:
+            result_doc["build_type"] = "wood"
+        elif build_type.find("RC") >= 0:
+            result_doc["build_type"] = "RC"
         else:
-            print(f"その他面積 can not be found in content_details of {id_url}")
-
-        completion_date = get_first(".*?(完成時期|築年月).*?")
-        if completion_date:
-            try:
-                cd = re.findall(r"(\d{4})年(\d+)月", completion_date)[0]
-                result_doc["completion_date"] = f"{int(cd[0])}-{int(cd[1]):02d}-01"
-            except Exception as ex:
-                print(f"Can't get time from {completion_date} in {content_details}")
-                raise ex
-
-        layout = content_details.get("間取り")
-        if layout:
-            result_doc["layout_main"] = re.findall(r"(\d(L|D|K)+)", layout)[0][0]
-            storage_room = re.findall(r"\+(\d{0,1})S", layout)
-            if len(storage_room) > 0:
-                if storage_room[0] == "":
-                    result_doc["layout_storage_room"] = 1
-                else:
-                    result_doc["layout_storage_room"] = int(storage_room[0])
-            else:
-                result_doc["layout_storage_room"] = 0
+            result_doc["build_type"] = "unknown"
 
-        direction = content_details.get("向き")
-        if direction:
-            result_doc["direction"] = direction
+    def get_monthly_fee(key):
+        text = content_details[key]
+        total_value = 0
+        for r in re.findall("((\d+)万){0,1}(\d+)円／月", text):
+            total_value += float(r[2])
+            if r[1] != "":
+                total_value += 10000 * float(r[1])
+        return total_value
 
-        result_doc["pet"] = (
-            re.match("ペット", doc["search_details"]["title"]) is not None
-        )
-        the_floor = content_details.get("所在階", get_first("所在階"))
-        if the_floor:
-            result_doc["floor"] = int(re.findall("(\d+)階", the_floor)[0])
-
-        total_floors = get_first(".*?階建.*?")
-        if total_floors:
-            try:
-                result_doc["total_floors"] = int(
-                    re.findall("(\d+)階建", total_floors)[0]
-                )
-            except Exception as ex:
-                print(f"Can't parse {total_floors}")
-                raise ex
-
-        build_type = get_first(".*?構造.*?")
-        if build_type:
-            if build_type.find("木造") >= 0:
-                result_doc["build_type"] = "wood"
-            elif build_type.find("RC") >= 0:
-                result_doc["build_type"] = "RC"
-            else:
-                result_doc["build_type"] = "unknown"
-
-        if "gps" in doc:
-            # Nearest Station
-            this_location = GeoPoint.parse_obj(doc["gps"])
-
-            result_doc["min_distance_to_mafia"] = (
-                this_location
-                - GeoPoint.from_geo_json_object(
-                    japan_gis_poi.find_one(build_poi_filter("mafia", this_location))[
-                        "loc"
-                    ]
-                )
-            )
+    result_doc["monthly_fee_manage"] = get_monthly_fee("管理費")
+    result_doc["monthly_fee_repair"] = get_monthly_fee("修繕積立金")
+    result_doc["monthly_fee_repair_fund"] = get_monthly_fee("修繕積立基金")
+    result_doc["monthly_fee_others"] = get_monthly_fee("諸費用")
+    result_doc["monthly_fee_total"] = sum(
+        [
+            result_doc["monthly_fee_manage"],
+            result_doc["monthly_fee_repair"],
+            result_doc["monthly_fee_repair_fund"],
+            result_doc["monthly_fee_others"],
+        ]
+    )
+    return result_doc
 
-            result_doc["min_distance_to_cemetery"] = (
-                this_location
-                - GeoPoint.from_geo_json_object(
-                    japan_gis_poi.find_one(
-                        build_poi_filter("google_cemetery", this_location)
-                    )["loc"]
-                )
-            )
 
-            # find nearest station and passenger count
-            nearest_station = japan_gis_poi.find_one(
-                build_poi_filter("station_passengers", this_location, 2000)
-            )
-            if nearest_station and "passengers_count_2021" in nearest_station["data"]:
-                result_doc["nearest_station_distance"] = (
-                    this_location
-                    - GeoPoint.from_geo_json_object(nearest_station["loc"])
-                )
-                result_doc["nearest_station_passengers"] = nearest_station["data"][
-                    "passengers_count_2021"
-                ]
-                if (
-                    "passengers_count_2019" in nearest_station["data"]
-                    and nearest_station["data"]["passengers_count_2019"] > 0
-                ):
-                    result_doc["nearest_station_covid_ratio"] = (
-                        nearest_station["data"]["passengers_count_2021"]
-                        / nearest_station["data"]["passengers_count_2019"]
-                    )
-            # Estimate population density
-            population_raw = np.array(
-                [
-                    doc["data"]["total_population"]
-                    for doc in japan_gis_poi.find(
-                        build_poi_filter("population", this_location, 1000)
-                    )
-                ]
-            )
-            result_doc["population_estimation_mean"] = population_raw.mean()
-            result_doc["population_estimation_median"] = np.median(population_raw)
-            # Bus stops and routes
-            bus_stops = list(
-                japan_gis_poi.find(build_poi_filter("bus_stop", this_location, 1000))
-            )
+def gis_features(
+    poi_store: Union[PoiStore, PoiIndex, PoiSnapshot, RasterPoiStore],
+    location: GeoPoint,
+    specs: List[PoiFeatureSpec] = FEATURE_SPECS,
+) -> dict:
+    """
+    Features from POI around the location, one query per category
+    :param poi_store: PoiStore, PoiIndex loaded in memory, PoiSnapshot, or any of them wrapped by RasterPoiStore
+    :param location: location of the listing
+    :param specs: radii and k-nearest of each category, one spec per category
+    :return: GIS features
+    """
+    nearby = {spec.category: fetch_nearby(poi_store, location, spec) for spec in specs}
+    result_doc = {}
+    for spec in specs:
+        result_doc.update(spec_features(nearby[spec.category], spec))
 
-            result_doc["bus_stops_distance_min"] = (
-                min(
-                    this_location - GeoPoint.from_geo_json_object(bus_stop["loc"])
-                    for bus_stop in bus_stops
-                )
-                if bus_stops
-                else None
-            )
-            result_doc["bus_stop_count"] = len(bus_stops)
-            result_doc["bus_route_count"] = sum(
-                sum(len(rs) for rs in bus_stop["data"]["routes"])
-                for bus_stop in bus_stops
-            )
+    def nearest_distance(category: str) -> Optional[float]:
+        docs = nearby[category].documents
+        if not docs:
+            return None
+        return location - GeoPoint.from_geo_json_object(docs[0]["loc"])
 
-        def get_monthly_fee(key):
-            text = content_details[key]
-            total_value = 0
-            for r in re.findall("((\d+)万){0,1}(\d+)円／月", text):
-                total_value += float(r[2])
-                if r[1] != "":
-                    total_value += 10000 * float(r[1])
-            return total_value
-
-        result_doc["monthly_fee_manage"] = get_monthly_fee("管理費")
-        result_doc["monthly_fee_repair"] = get_monthly_fee("修繕積立金")
-        result_doc["monthly_fee_repair_fund"] = get_monthly_fee("修繕積立基金")
-        result_doc["monthly_fee_others"] = get_monthly_fee("諸費用")
-        result_doc["monthly_fee_total"] = sum(
-            [
-                result_doc["monthly_fee_manage"],
-                result_doc["monthly_fee_repair"],
-                result_doc["monthly_fee_repair_fund"],
-                result_doc["monthly_fee_others"],
+    if "mafia" in nearby:
+        result_doc["min_distance_to_mafia"] = nearest_distance("mafia")
+    if "google_cemetery" in nearby:
+        result_doc["min_distance_to_cemetery"] = nearest_distance("google_cemetery")
+
+    # Nearest station within 2000m and passenger count
+    stations = nearby.get("station_passengers")
+    if stations and stations.within(2000):
+        nearest_station = stations.documents[0]
+        if "passengers_count_2021" in nearest_station["data"]:
+            result_doc["nearest_station_distance"] = nearest_distance(
+                "station_passengers"
+            )
+            result_doc["nearest_station_passengers"] = nearest_station["data"][
+                "passengers_count_2021"
             ]
+            if (
+                "passengers_count_2019" in nearest_station["data"]
+                and nearest_station["data"]["passengers_count_2019"] > 0
+            ):
+                result_doc["nearest_station_covid_ratio"] = (
+                    nearest_station["data"]["passengers_count_2021"]
+                    / nearest_station["data"]["passengers_count_2019"]
+                )
+    # Estimate population density
+    if "population" in nearby:
+        population = nearby["population"]
+        population_raw = population.weights("total_population")[
+            : population.within(1000)
+        ]
+        result_doc["population_estimation_mean"] = population_raw.mean()
+        result_doc["population_estimation_median"] = np.median(population_raw)
+    # Bus stops and routes
+    if "bus_stop" in nearby:
+        bus_stops = nearby["bus_stop"]
+        result_doc["bus_stops_distance_min"] = (
+            nearest_distance("bus_stop") if bus_stops.within(1000) else None
         )
-
-        table_data.append(result_doc)
-
-    return pd.DataFrame(table_data)
+        result_doc["bus_stop_count"] = bus_stops.within(1000)
+        result_doc["bus_route_count"] = int(bus_stops.weight_sum("route_count", 1000))
+    return result_doc
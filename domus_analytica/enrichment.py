@@ -0,0 +1,413 @@
+"""
+特徴量抽出の分散処理（MongoDBのジョブキュー）
+
+A coordinator splits the listings without features into chunks in ``enrichment_jobs``.
+Workers on any number of hosts claim chunks with an atomic ``find_one_and_update`` lease,
+extract their features and upsert the rows into ``suumo_features``.
+A chunk whose lease expired (its worker crashed or hung) is claimed again by another worker,
+so a crash loses at most the chunk in progress.
+"""
+
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+import pymongo
+from pydantic import BaseModel
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from domus_analytica.config import DomusSettings
+from domus_analytica.data_clean import extract_listings, open_poi_store
+from domus_analytica.indexes import ENRICHMENT_JOB_INDEXES, SUUMO_FEATURE_INDEXES
+from domus_analytica.metrics import record_write
+from domus_analytica.model import FEATURE_VERSION, ModelArtifact, data_preprocessing
+from domus_analytica.mongo import get_database
+from domus_analytica.scoring import ScoreReport, score_updates
+from domus_analytica.trading_rollup import ComparableSalesSummary, TradingRollupStore
+
+log = logging.getLogger(__name__)
+
+DEFAULT_JOB_COLLECTION = "enrichment_jobs"
+DEFAULT_FEATURE_COLLECTION = "suumo_features"
+# Listings compared with suumo_features and enrichment_jobs in one query by enqueue
+ENQUEUE_SCAN_SIZE = 5000
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class WorkerReport(BaseModel):
+    jobs: int = 0
+    listings: int = 0
+    # Listings failed to parse, recorded in failed_ids of their job
+    failed_listings: int = 0
+    failed_jobs: int = 0
+    lost_leases: int = 0
+    score: ScoreReport = ScoreReport()
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _batches(items: List, size: int) -> Iterable[List]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def feature_documents(df: pd.DataFrame) -> List[dict]:
+    """
+    Rows of extract_info_to_table as documents, missing values are None
+    """
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict("records")
+
+
+def write_features(
+    features_coll: Collection, df: pd.DataFrame, enrich_time: datetime
+) -> int:
+    """
+    Upsert rows of extract_info_to_table, keyed by the _id of suumo_details
+    :return: count of the rows written
+    """
+    operations = [
+        ReplaceOne(
+            {"_id": doc.pop("doc_id")},
+            dict(doc, feature_version=FEATURE_VERSION, enrich_time=enrich_time),
+            upsert=True,
+        )
+        for doc in feature_documents(df)
+    ]
+    if operations:
+        start = time.perf_counter()
+        features_coll.bulk_write(operations, ordered=False)
+        record_write(features_coll.name, len(operations), time.perf_counter() - start)
+    return len(operations)
+
+
+class EnrichmentQueue:
+    def __init__(
+        self,
+        db: Database,
+        job_collection: str = DEFAULT_JOB_COLLECTION,
+        feature_collection: str = DEFAULT_FEATURE_COLLECTION,
+    ):
+        self.jobs = db.get_collection(job_collection)
+        self.features = db.get_collection(feature_collection)
+
+    def ensure_indexes(self):
+        self.jobs.create_indexes(ENRICHMENT_JOB_INDEXES)
+        self.features.create_indexes(SUUMO_FEATURE_INDEXES)
+
+    def _unfinished(self, ids: List) -> set:
+        done = {
+            d["_id"]
+            for d in self.features.find(
+                {"_id": {"$in": ids}, "feature_version": FEATURE_VERSION},
+                projection={"_id": True},
+            )
+        }
+        queued = {
+            i
+            for job in self.jobs.find(
+                {
+                    "ids": {"$in": ids},
+                    "status": {
+                        "$in": [JobStatus.PENDING.value, JobStatus.LEASED.value]
+                    },
+                },
+                projection={"ids": True},
+            )
+            for i in job["ids"]
+        }
+        return done | queued
+
+    def add(
+        self,
+        ids: List,
+        chunk_size: int = 500,
+        error: Optional[str] = None,
+        created_time: Optional[datetime] = None,
+        score: bool = False,
+    ) -> int:
+        """
+        Add pending jobs for the listings as they are, without checking features and jobs
+        :param error: why they're added, recorded in the jobs
+        :param score: the listings need scoring as well, done by workers with a model
+        :return: count of the jobs added
+        """
+        created_time = created_time or datetime.now()
+        jobs = [
+            {
+                "ids": chunk,
+                "status": JobStatus.PENDING.value,
+                "attempts": 0,
+                "created_time": created_time,
+                "lease_owner": None,
+                "lease_expires": None,
+            }
+            for chunk in _batches(ids, chunk_size)
+        ]
+        for job in jobs:
+            if error is not None:
+                job["error"] = error
+            if score:
+                job["score"] = True
+        if jobs:
+            self.jobs.insert_many(jobs, ordered=True)
+        return len(jobs)
+
+    def enqueue(
+        self, suumo_details: Collection, suumo_filter: dict, chunk_size: int = 500
+    ) -> int:
+        """
+        Add jobs for the listings matched by the filter, skipping the ones with features of
+        the current version and the ones already in unfinished jobs.
+        The listings are streamed in _id order and compared with both collections per scan,
+        so memory doesn't grow with the inventory
+        :return: count of the jobs added
+        """
+        now = datetime.now()
+        report = {"jobs": 0, "listings": 0, "skipped": 0}
+        pending: List = []
+
+        def flush(scan: List, last: bool):
+            unfinished = self._unfinished(scan) if scan else set()
+            fresh = [i for i in scan if i not in unfinished]
+            report["skipped"] += len(scan) - len(fresh)
+            pending.extend(fresh)
+            # Only full chunks until the last scan, the rest is carried to the next one
+            count = len(pending) if last else len(pending) // chunk_size * chunk_size
+            if not count:
+                return
+            report["jobs"] += self.add(pending[:count], chunk_size, created_time=now)
+            report["listings"] += count
+            del pending[:count]
+
+        scan: List = []
+        for doc in suumo_details.find(
+            suumo_filter, projection={"_id": True}, batch_size=ENQUEUE_SCAN_SIZE
+        ).sort("_id", pymongo.ASCENDING):
+            scan.append(doc["_id"])
+            if len(scan) >= ENQUEUE_SCAN_SIZE:
+                flush(scan, last=False)
+                scan = []
+        flush(scan, last=True)
+        log.info(
+            f"{report['listings']} listings enqueued in {report['jobs']} jobs, "
+            f"{report['skipped']} already enriched or queued"
+        )
+        return report["jobs"]
+
+    def claim(
+        self, worker_id: str, lease: timedelta, max_attempts: int = 3
+    ) -> Optional[dict]:
+        """
+        Lease the oldest pending job, or one whose lease expired
+        :return: the job, None if there is nothing to do
+        """
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": JobStatus.PENDING.value},
+                    {"status": JobStatus.LEASED.value, "lease_expires": {"$lt": now}},
+                ],
+                "attempts": {"$lt": max_attempts},
+            },
+            {
+                "$set": {
+                    "status": JobStatus.LEASED.value,
+                    "lease_owner": worker_id,
+                    "lease_expires": now + lease,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+    def complete(
+        self, job: dict, worker_id: str, failed_ids: Optional[List] = None
+    ) -> bool:
+        """
+        :param failed_ids: listings of the job failed to parse, the job is done without them
+            and `enqueue` picks them up again as they have no features
+        :return: False if the lease was lost to another worker, the work is idempotent anyway
+        """
+        return (
+            self.jobs.update_one(
+                {"_id": job["_id"], "lease_owner": worker_id},
+                {
+                    "$set": {
+                        "status": JobStatus.DONE.value,
+                        "finish_time": datetime.now(),
+                        "lease_expires": None,
+                        "failed_ids": failed_ids or [],
+                    }
+                },
+            ).matched_count
+            > 0
+        )
+
+    def release(
+        self, job: dict, worker_id: str, error: str, max_attempts: int = 3
+    ) -> bool:
+        """
+        Give a failed job back to the queue, or mark it failed after max_attempts
+        :return: False if the lease was lost to another worker
+        """
+        status = (
+            JobStatus.FAILED if job["attempts"] >= max_attempts else JobStatus.PENDING
+        )
+        return (
+            self.jobs.update_one(
+                {"_id": job["_id"], "lease_owner": worker_id},
+                {
+                    "$set": {
+                        "status": status.value,
+                        "error": error,
+                        "lease_owner": None,
+                        "lease_expires": None,
+                    }
+                },
+            ).matched_count
+            > 0
+        )
+
+    def fail_exhausted(self, max_attempts: int = 3) -> int:
+        """
+        Mark jobs whose lease expired on the last attempt as failed, their workers crashed every time
+        """
+        return self.jobs.update_many(
+            {
+                "status": JobStatus.LEASED.value,
+                "lease_expires": {"$lt": datetime.now()},
+                "attempts": {"$gte": max_attempts},
+            },
+            {"$set": {"status": JobStatus.FAILED.value, "error": "lease expired"}},
+        ).modified_count
+
+    def retry_failed(self) -> int:
+        return self.jobs.update_many(
+            {"status": JobStatus.FAILED.value},
+            {"$set": {"status": JobStatus.PENDING.value, "attempts": 0}},
+        ).modified_count
+
+    def status(self) -> Dict[str, dict]:
+        """
+        :return: status -> count of jobs, listings and listings failed to parse
+        """
+        return {
+            r["_id"]: {
+                "jobs": r["jobs"],
+                "listings": r["listings"],
+                "failed_listings": r["failed_listings"],
+            }
+            for r in self.jobs.aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": "$status",
+                            "jobs": {"$sum": 1},
+                            "listings": {"$sum": {"$size": "$ids"}},
+                            "failed_listings": {
+                                "$sum": {"$size": {"$ifNull": ["$failed_ids", []]}}
+                            },
+                        }
+                    }
+                ]
+            )
+        }
+
+
+def run_worker(
+    config: DomusSettings,
+    queue: EnrichmentQueue,
+    worker_id: str,
+    lease: timedelta = timedelta(minutes=10),
+    max_attempts: int = 3,
+    max_jobs: Optional[int] = None,
+    poll_interval: Optional[float] = None,
+    artifact: Optional[ModelArtifact] = None,
+) -> WorkerReport:
+    """
+    Claim and process jobs until the queue is empty
+    :param lease: a job not completed in this period is claimed by another worker, keep it
+        well above the time of one chunk
+    :param max_jobs: stop after this count of jobs, no limitation if None
+    :param poll_interval: wait for new jobs with this interval in seconds instead of stopping
+    :param artifact: the model to score the listings of every job with, only features are written if None
+    :return: counts of the jobs and listings processed
+    """
+    report = WorkerReport()
+    # Loaded once for all jobs, restart polling workers after the trading rollup is rebuilt
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    suumo_details = domus_db.get_collection(config.suumo_collection)
+    poi_store = open_poi_store(config, domus_db)
+    comps = ComparableSalesSummary.load(TradingRollupStore(domus_db))
+    while max_jobs is None or report.jobs + report.failed_jobs < max_jobs:
+        job = queue.claim(worker_id, lease, max_attempts)
+        if job is None:
+            if poll_interval is None:
+                break
+            time.sleep(poll_interval)
+            continue
+        start = time.perf_counter()
+        # An unparseable listing doesn't fail the other listings of the job
+        failed: List = []
+        try:
+            df = extract_listings(
+                config, {"_id": {"$in": job["ids"]}}, poi_store, comps, failed=failed
+            )
+            now = datetime.now()
+            written = write_features(queue.features, df, now)
+            if artifact is not None and len(df):
+                report.score.selected += len(df)
+                updates = score_updates(
+                    artifact, data_preprocessing(df), now, report.score
+                )
+                if updates:
+                    write_start = time.perf_counter()
+                    suumo_details.bulk_write(updates, ordered=False)
+                    record_write(
+                        suumo_details.name,
+                        len(updates),
+                        time.perf_counter() - write_start,
+                    )
+                report.score.scored += len(updates)
+            elif job.get("score"):
+                log.warning(
+                    f"Listings of job {job['_id']} need scoring, "
+                    f"run `score` or a worker with --model"
+                )
+        except Exception as ex:
+            log.error(
+                f"Job {job['_id']} failed on attempt {job['attempts']}", exc_info=ex
+            )
+            if not queue.release(job, worker_id, repr(ex), max_attempts):
+                report.lost_leases += 1
+            report.failed_jobs += 1
+            continue
+        if not queue.complete(job, worker_id, failed):
+            log.warning(f"Lease of job {job['_id']} expired before it was completed")
+            report.lost_leases += 1
+        report.jobs += 1
+        report.listings += written
+        report.failed_listings += len(failed)
+        log.info(
+            f"Job {job['_id']}: {written} of {len(job['ids'])} listings enriched, "
+            f"{len(failed)} failed in {time.perf_counter() - start:.1f}s"
+        )
+    return report
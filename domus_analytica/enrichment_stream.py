@@ -0,0 +1,295 @@
+"""
+変更ストリームによる特徴量抽出と評価
+
+Tails the change stream of suumo_details, collects the inserted and updated listings into
+micro-batches, then extracts their features into ``suumo_features`` and scores them within seconds.
+The resume token is saved in ``enrichment_stream_state`` after every batch, so a restarted
+daemon continues after the last processed event. Listings failed to extract, and every listing
+of a batch failed as a whole, are put in ``enrichment_jobs`` for ``enrich work`` and the stream
+moves on. Change streams need a replica set, a single node one is enough.
+"""
+
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+from domus_analytica.config import DomusSettings
+from domus_analytica.data_clean import extract_listings, open_poi_store
+from domus_analytica.enrichment import (
+    DEFAULT_FEATURE_COLLECTION,
+    EnrichmentQueue,
+    write_features,
+)
+from domus_analytica.indexes import SUUMO_FEATURE_INDEXES
+from domus_analytica.metrics import record_write
+from domus_analytica.model import ModelArtifact, data_preprocessing
+from domus_analytica.scoring import SCORE_FIELDS, ScoreReport, score_updates
+from domus_analytica.trading_rollup import ComparableSalesSummary, TradingRollupStore
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STREAM_STATE_COLLECTION = "enrichment_stream_state"
+# Updates of only these fields don't change the features: the write back of scoring,
+# and the crawl bookkeeping of the listing history for unchanged and removed listings
+IGNORED_FIELDS = frozenset(SCORE_FIELDS) | {
+    "search_url",
+    "search_args",
+    "search_key",
+    "rank_order",
+    "search_time",
+    "last_seen",
+    "last_changed",
+    "status",
+}
+# Save the resume token of an idle stream at this interval, so it doesn't fall off the oplog
+IDLE_CHECKPOINT_SECONDS = 30.0
+# ChangeStreamHistoryLost and ChangeStreamFatalError, the token is no longer in the oplog
+HISTORY_LOST_CODES = (280, 286)
+# The $changeStream stage is only supported on replica sets
+REPLICA_SET_REQUIRED_CODES = (40573,)
+
+PIPELINE = [
+    {"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}},
+    # The listing is read again by extract_listings, don't ship the full documents
+    {
+        "$project": {
+            "operationType": True,
+            "documentKey": True,
+            "updateDescription": True,
+        }
+    },
+]
+
+
+class StreamReport(BaseModel):
+    events: int = 0
+    ignored: int = 0
+    batches: int = 0
+    enriched: int = 0
+    deleted: int = 0
+    # Listings put in the job queue after their extraction or their batch failed
+    failed: int = 0
+    score: ScoreReport = ScoreReport()
+
+
+def is_listing_change(event: dict) -> bool:
+    """
+    :return: False for updates which only touch IGNORED_FIELDS
+    """
+    if event["operationType"] != "update":
+        return True
+    description = event.get("updateDescription") or {}
+    fields = list(description.get("updatedFields") or {}) + list(
+        description.get("removedFields") or []
+    )
+    return any(f.split(".", 1)[0] not in IGNORED_FIELDS for f in fields) or bool(
+        description.get("truncatedArrays")
+    )
+
+
+def change_stream_error(ex: OperationFailure) -> Optional[str]:
+    """
+    :return: an explanation of the errors needing action of the operator, None for others
+    """
+    if ex.code in HISTORY_LOST_CODES:
+        return (
+            "The saved resume token is no longer in the oplog, restart with --reset "
+            "and run `enrich enqueue` to catch up with the missed listings"
+        )
+    if ex.code in REPLICA_SET_REQUIRED_CODES:
+        return "Change streams need a replica set, a single node one is enough"
+    return None
+
+
+class ResumeTokenStore:
+    def __init__(self, db: Database, collection: str = DEFAULT_STREAM_STATE_COLLECTION):
+        self.coll = db.get_collection(collection)
+
+    def load(self, stream_id: str) -> Optional[dict]:
+        state = self.coll.find_one({"_id": stream_id})
+        return state["resume_token"] if state else None
+
+    def save(self, stream_id: str, token: dict):
+        self.coll.replace_one(
+            {"_id": stream_id},
+            {"resume_token": token, "update_time": datetime.now()},
+            upsert=True,
+        )
+
+    def reset(self, stream_id: str) -> bool:
+        return self.coll.delete_one({"_id": stream_id}).deleted_count > 0
+
+
+class StreamEnricher:
+    def __init__(
+        self,
+        config: DomusSettings,
+        db: Database,
+        artifact: Optional[ModelArtifact] = None,
+        feature_collection: str = DEFAULT_FEATURE_COLLECTION,
+        state_collection: str = DEFAULT_STREAM_STATE_COLLECTION,
+    ):
+        """
+        :param artifact: the model to score with, only features are written if None
+        """
+        self.config = config
+        self.suumo_details = db.get_collection(config.suumo_collection)
+        self.features = db.get_collection(feature_collection)
+        self.tokens = ResumeTokenStore(db, state_collection)
+        self.queue = EnrichmentQueue(db, feature_collection=feature_collection)
+        self.artifact = artifact
+        self.report = StreamReport()
+        # Loaded once for all batches, restart the daemon after the trading rollup is rebuilt
+        self.poi_store = open_poi_store(config, db)
+        self.comps = ComparableSalesSummary.load(TradingRollupStore(db))
+
+    @property
+    def stream_id(self) -> str:
+        return self.suumo_details.name
+
+    def requeue(self, ids: List, error: str):
+        """
+        Put listings in the job queue, so `enrich work` retries them instead of the stream,
+        the jobs are marked to be scored when the stream scores, by workers with --model
+        """
+        if not ids:
+            return
+        self.queue.add(ids, error=error, score=self.artifact is not None)
+        self.report.failed += len(ids)
+        log.warning(
+            f"{len(ids)} listings put in {self.queue.jobs.name} for `enrich work`: {error}"
+        )
+
+    def process(self, changes: Dict[object, str]):
+        """
+        Enrich and score one batch, the listings failed to extract are requeued
+        :param changes: _id of the listing -> the last operationType of it in the batch
+        """
+        start = time.perf_counter()
+        upserted = [i for i, op in changes.items() if op != "delete"]
+        deleted = [i for i, op in changes.items() if op == "delete"]
+        now = datetime.now()
+        written = scored = 0
+        # Before the extraction, which is more likely to fail
+        if deleted:
+            self.report.deleted += self.features.delete_many(
+                {"_id": {"$in": deleted}}
+            ).deleted_count
+        failed: List = []
+        if upserted:
+            df = extract_listings(
+                self.config,
+                {"_id": {"$in": upserted}},
+                self.poi_store,
+                self.comps,
+                failed=failed,
+            )
+            written = write_features(self.features, df, now)
+            if self.artifact is not None and len(df):
+                updates = score_updates(
+                    self.artifact, data_preprocessing(df), now, self.report.score
+                )
+                if updates:
+                    write_start = time.perf_counter()
+                    self.suumo_details.bulk_write(updates, ordered=False)
+                    record_write(
+                        self.suumo_details.name,
+                        len(updates),
+                        time.perf_counter() - write_start,
+                    )
+                scored = len(updates)
+        self.requeue(failed, "extraction failed in the change stream")
+        self.report.batches += 1
+        self.report.enriched += written
+        self.report.score.scored += scored
+        self.report.score.selected += len(upserted)
+        log.info(
+            f"{len(changes)} changed listings: {written} enriched, {scored} scored, "
+            f"{len(deleted)} deleted, {len(failed)} failed "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+    def process_or_requeue(self, changes: Dict[object, str]):
+        """
+        Process a batch, or requeue its listings when it fails as a whole,
+        so one bad batch doesn't stop the stream. The stream stops if requeueing fails
+        as well, e.g. MongoDB is down, and the batch is replayed from the saved token on restart
+        """
+        try:
+            self.process(changes)
+        except Exception as ex:
+            log.error(f"Batch of {len(changes)} changed listings failed", exc_info=ex)
+            self.requeue([i for i, op in changes.items() if op != "delete"], repr(ex))
+            self.report.batches += 1
+
+    def _open(self, collection: Collection, token: Optional[dict], max_wait: float):
+        return collection.watch(
+            PIPELINE,
+            resume_after=token,
+            # Wake up often enough to flush a batch on time when no more events arrive
+            max_await_time_ms=max(10, int(min(max_wait, 1.0) * 1000)),
+        )
+
+    def run(
+        self,
+        max_batch: int = 200,
+        max_wait: float = 2.0,
+        max_batches: Optional[int] = None,
+    ) -> StreamReport:
+        """
+        Process the changes until interrupted
+        :param max_batch: a batch is processed when it has this count of listings
+        :param max_wait: or when its first event waited this many seconds
+        :param max_batches: stop after this count of batches, no limitation if None
+        :return: counts of the events and listings
+        """
+        self.features.create_indexes(SUUMO_FEATURE_INDEXES)
+        token = self.tokens.load(self.stream_id)
+        if token is None:
+            log.info(
+                f"No resume token of {self.stream_id}, starting from now, "
+                f"run `enrich enqueue` for the listings inserted before"
+            )
+        else:
+            log.info(f"Resuming the change stream of {self.stream_id}")
+        pending: Dict[object, str] = {}
+        first_event = last_save = time.monotonic()
+        saved_token = token
+        with self._open(self.suumo_details, token, max_wait) as stream:
+            while stream.alive and (
+                max_batches is None or self.report.batches < max_batches
+            ):
+                event = stream.try_next()
+                if event is not None:
+                    self.report.events += 1
+                    if is_listing_change(event):
+                        if not pending:
+                            first_event = time.monotonic()
+                        pending[event["documentKey"]["_id"]] = event["operationType"]
+                    else:
+                        self.report.ignored += 1
+                now = time.monotonic()
+                if pending and (
+                    len(pending) >= max_batch or now - first_event >= max_wait
+                ):
+                    self.process_or_requeue(pending)
+                    pending = {}
+                    # Only after the batch is written or requeued, a crash in between replays it
+                    saved_token = stream.resume_token
+                    self.tokens.save(self.stream_id, saved_token)
+                    last_save = now
+                elif (
+                    not pending
+                    and stream.resume_token != saved_token
+                    and now - last_save >= IDLE_CHECKPOINT_SECONDS
+                ):
+                    saved_token = stream.resume_token
+                    self.tokens.save(self.stream_id, saved_token)
+                    last_save = now
+        return self.report
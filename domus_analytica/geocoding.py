@@ -0,0 +1,149 @@
+"""
+住所からGPS座標への変換とキャッシュ
+"""
+
+import logging
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.metrics import CACHE_LOOKUPS, track_request
+
+if TYPE_CHECKING:
+    import googlemaps
+
+log = logging.getLogger(__name__)
+
+DEFAULT_GEOCODE_CACHE_COLLECTION = "geocode_cache"
+# Addresses failed to geocode are retried after this period
+DEFAULT_NEGATIVE_TTL = timedelta(days=30)
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalize address so that the same place written in different ways shares the cache
+    :param address: raw address, e.g. 東京都港区六本木７－８－４
+    :return: normalized address, e.g. 東京都港区六本木7-8-4
+    """
+    address = unicodedata.normalize("NFKC", address.split("\n")[0])
+    address = re.sub(r"(?<=\d)[‐‑‒–—―ー−](?=\d)", "-", address)
+    address = re.sub(r"(\d)丁目", r"\1-", address)
+    return re.sub(r"\s+", "", address).rstrip("-")
+
+
+class GeocodingService:
+    def __init__(
+        self,
+        api_key: str,
+        cache: Collection,
+        concurrency: int = 4,
+        negative_ttl: timedelta = DEFAULT_NEGATIVE_TTL,
+        language: str = "ja",
+    ):
+        """
+        Geocode addresses with Google Maps, every response (including empty ones) is cached in MongoDB
+        :param api_key: Google API key, only used when cache missed
+        :param cache: MongoDB collection for caching
+        :param concurrency: max requests sent concurrently
+        :param negative_ttl: addresses failed to geocode will be retried after this period
+        :param language: language of results
+        """
+        self.api_key = api_key
+        self.cache = cache
+        self.concurrency = concurrency
+        self.negative_ttl = negative_ttl
+        self.language = language
+        self.api_requests = 0
+        self._client: Optional["googlemaps.Client"] = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> "googlemaps.Client":
+        with self._lock:
+            if self._client is None:
+                # Only needed when the cache missed
+                import googlemaps
+
+                self._client = googlemaps.Client(key=self.api_key)
+            return self._client
+
+    def _is_valid(self, cached: dict) -> bool:
+        return (
+            cached["found"]
+            or cached["create_time"] + self.negative_ttl > datetime.now()
+        )
+
+    def _request(self, address: str) -> Optional[List[dict]]:
+        with self._lock:
+            self.api_requests += 1
+        try:
+            with track_request("google_geocoding"):
+                return self.client.geocode(
+                    address=address, language=self.language, region=self.language
+                )
+        except Exception as ex:
+            # Don't cache transient errors, they will be retried next time
+            log.error(f"Failed to geocode {address}", exc_info=ex)
+            return None
+
+    def geocode_many(self, addresses: Iterable[str]) -> Dict[str, List[dict]]:
+        """
+        Geocode addresses, only addresses not in cache are sent to Google Maps
+        :param addresses: raw addresses
+        :return: raw address -> geocode results (empty if not found)
+        """
+        normalized = {a: normalize_address(a) for a in set(addresses)}
+        results: Dict[str, List[dict]] = {}
+        for cached in self.cache.find({"_id": {"$in": list(set(normalized.values()))}}):
+            if self._is_valid(cached):
+                results[cached["_id"]] = cached["results"]
+
+        missing = sorted(set(normalized.values()) - results.keys())
+        CACHE_LOOKUPS.inc(len(results), cache="geocode", result="hit")
+        CACHE_LOOKUPS.inc(len(missing), cache="geocode", result="miss")
+        if missing:
+            log.info(f"Geocoding {len(missing)} addresses missed in cache")
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                responses = {
+                    address: response
+                    for address, response in zip(
+                        missing, executor.map(self._request, missing)
+                    )
+                    if response is not None
+                }
+            now = datetime.now()
+            if responses:
+                self.cache.bulk_write(
+                    [
+                        ReplaceOne(
+                            {"_id": address},
+                            {
+                                "results": response,
+                                "found": len(response) > 0,
+                                "create_time": now,
+                            },
+                            upsert=True,
+                        )
+                        for address, response in responses.items()
+                    ],
+                    ordered=False,
+                )
+            results.update(responses)
+        return {raw: results.get(n, []) for raw, n in normalized.items()}
+
+    def locate_many(self, addresses: Iterable[str]) -> Dict[str, GeoPoint]:
+        """
+        :return: raw address -> location of the first result, addresses not found are omitted
+        """
+        return {
+            address: GeoPoint.from_lat_lng(**results[0]["geometry"]["location"])
+            for address, results in self.geocode_many(addresses).items()
+            if results
+        }
@@ -0,0 +1,447 @@
+"""
+全コレクションのインデックス定義
+
+Every index the code relies on is declared here, `domus-analytica ensure-indexes` builds
+them and explains the canonical queries of the code, failing if any of them would scan a
+whole collection. Importers create the indexes of the collections they write as well.
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import pymongo
+from bson import ObjectId
+from pydantic import BaseModel
+from pymongo import IndexModel
+from pymongo.database import Database
+
+from domus_analytica.geocoding import DEFAULT_NEGATIVE_TTL
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStorageLayout, PoiStore
+
+log = logging.getLogger(__name__)
+
+# Listings are selected by the crawl (search_time) and scanned / paged in _id order
+SUUMO_DETAILS_INDEXES = [
+    IndexModel([("search_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+]
+SUUMO_SEARCH_INDEXES = [
+    IndexModel([("search_time", pymongo.ASCENDING), ("rank_order", pymongo.ASCENDING)]),
+]
+# The same as the ones GridFS creates on its first write, declared so that reads
+# of a bucket nobody wrote to in this deployment don't scan
+GRIDFS_FILES_INDEXES = [
+    IndexModel([("filename", pymongo.ASCENDING), ("uploadDate", pymongo.ASCENDING)]),
+]
+GRIDFS_CHUNKS_INDEXES = [
+    IndexModel(
+        [("files_id", pymongo.ASCENDING), ("n", pymongo.ASCENDING)], unique=True
+    ),
+]
+# Empty results are only valid for DEFAULT_NEGATIVE_TTL, let the server drop them
+GEOCODE_CACHE_INDEXES = [
+    IndexModel(
+        [("create_time", pymongo.ASCENDING)],
+        name="create_time_ttl_not_found",
+        expireAfterSeconds=int(DEFAULT_NEGATIVE_TTL.total_seconds()),
+        partialFilterExpression={"found": False},
+    ),
+]
+# One current document per listing URL, see ListingHistoryStore
+LISTING_INDEXES = [
+    IndexModel([("url", pymongo.ASCENDING)], unique=True),
+    IndexModel([("search_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+    IndexModel(
+        [
+            ("search_key", pymongo.ASCENDING),
+            ("status", pymongo.ASCENDING),
+            ("last_seen", pymongo.ASCENDING),
+        ]
+    ),
+    IndexModel([("status", pymongo.ASCENDING), ("last_changed", pymongo.ASCENDING)]),
+    # score --incremental, see changed_after
+    IndexModel([("last_changed", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+]
+LISTING_CHANGE_INDEXES = [
+    IndexModel([("url", pymongo.ASCENDING), ("time", pymongo.ASCENDING)]),
+    IndexModel([("time", pymongo.ASCENDING)]),
+]
+# Jobs of distributed feature extraction, see EnrichmentQueue
+ENRICHMENT_JOB_INDEXES = [
+    IndexModel(
+        [
+            ("status", pymongo.ASCENDING),
+            ("created_time", pymongo.ASCENDING),
+            ("_id", pymongo.ASCENDING),
+        ]
+    ),
+    # Listings already queued, see EnrichmentQueue.enqueue
+    IndexModel([("ids", pymongo.ASCENDING), ("status", pymongo.ASCENDING)]),
+]
+# Rows of extract_info_to_table keyed by the _id of suumo_details
+SUUMO_FEATURE_INDEXES = [
+    IndexModel([("feature_version", pymongo.ASCENDING)]),
+]
+TRADING_CSV_INDEXES = [
+    IndexModel([("transaction_quarter", pymongo.ASCENDING)]),
+]
+TRADING_API_INDEXES = [
+    IndexModel([("param_year", pymongo.ASCENDING), ("param_area", pymongo.ASCENDING)]),
+    IndexModel([("param_area", pymongo.ASCENDING)]),
+]
+TRADING_API_PROGRESS_INDEXES = [
+    IndexModel([("year", pymongo.ASCENDING)]),
+]
+TRADING_ROLLUP_INDEXES = [
+    IndexModel(
+        [
+            ("level", pymongo.ASCENDING),
+            ("key", pymongo.ASCENDING),
+            ("structure", pymongo.ASCENDING),
+            ("quarter", pymongo.ASCENDING),
+        ],
+        unique=True,
+    ),
+    IndexModel([("quarter", pymongo.ASCENDING)]),
+]
+
+
+class CollectionNames(BaseModel):
+    suumo_details: str = "suumo_details"
+    suumo_search: str = "suumo_search"
+    suumo_listings: str = "suumo_listings"
+    suumo_features: str = "suumo_features"
+    enrichment_jobs: str = "enrichment_jobs"
+    gridfs_bucket: str = "fs"
+    geocode_cache: str = "geocode_cache"
+    trading_csv: str = "japan_trading"
+    trading_api: str = "japan_trading_api"
+    trading_rollup: str = "japan_trading_rollup"
+
+
+def declared_indexes(names: CollectionNames) -> Dict[str, List[IndexModel]]:
+    """
+    :return: collection name -> indexes, POI indexes are managed by PoiStore
+    """
+    return {
+        names.suumo_details: SUUMO_DETAILS_INDEXES,
+        names.suumo_search: SUUMO_SEARCH_INDEXES,
+        names.suumo_listings: LISTING_INDEXES,
+        f"{names.suumo_listings}_changes": LISTING_CHANGE_INDEXES,
+        names.suumo_features: SUUMO_FEATURE_INDEXES,
+        names.enrichment_jobs: ENRICHMENT_JOB_INDEXES,
+        f"{names.gridfs_bucket}.files": GRIDFS_FILES_INDEXES,
+        f"{names.gridfs_bucket}.chunks": GRIDFS_CHUNKS_INDEXES,
+        names.geocode_cache: GEOCODE_CACHE_INDEXES,
+        names.trading_csv: TRADING_CSV_INDEXES,
+        names.trading_api: TRADING_API_INDEXES,
+        f"{names.trading_api}_progress": TRADING_API_PROGRESS_INDEXES,
+        names.trading_rollup: TRADING_ROLLUP_INDEXES,
+    }
+
+
+def poi_categories(poi_store: PoiStore) -> List[str]:
+    """
+    Categories whose collection exists, collections of the split layout aren't created for nothing
+    """
+    if poi_store.layout != PoiStorageLayout.SPLIT:
+        return list(POI_CATEGORIES)
+    existing = set(poi_store.db.list_collection_names())
+    return [c for c in POI_CATEGORIES if poi_store.collection(c).name in existing]
+
+
+def build_indexes(
+    db: Database, names: CollectionNames, poi_store: PoiStore
+) -> Dict[str, List[str]]:
+    """
+    Create every declared index, existing ones are left as they are
+    :return: collection name -> index names
+    """
+    result = {}
+    for collection, indexes in declared_indexes(names).items():
+        result[collection] = db.get_collection(collection).create_indexes(indexes)
+        log.info(f"Indexes of {collection}: {result[collection]}")
+    for category in poi_categories(poi_store):
+        poi_store.ensure_index(category)
+        poi_store.ensure_key_index(category)
+        log.info(f"Indexes of POI category {category} ensured")
+    return result
+
+
+class CanonicalQuery(BaseModel):
+    name: str
+    collection: str
+    filter: dict
+    sort: Optional[dict] = None
+    limit: Optional[int] = None
+    hint: Optional[str] = None
+
+    def command(self) -> dict:
+        command = {"find": self.collection, "filter": self.filter}
+        if self.sort:
+            command["sort"] = self.sort
+        if self.limit:
+            command["limit"] = self.limit
+        if self.hint:
+            command["hint"] = self.hint
+        return command
+
+
+class QueryPlan(BaseModel):
+    query: str
+    collection: str
+    stages: List[str]
+    indexes: List[str]
+
+    @property
+    def collection_scan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+
+def canonical_queries(
+    names: CollectionNames, poi_store: PoiStore
+) -> List[CanonicalQuery]:
+    """
+    Queries issued by the code, with placeholder values since plans don't depend on them
+    """
+    search_time = datetime.now()
+    object_id = ObjectId()
+    queries = [
+        CanonicalQuery(
+            name="extract_info_to_table",
+            collection=names.suumo_details,
+            filter={"search_time": search_time},
+        ),
+        CanonicalQuery(
+            name="extract_info_to_table: listings without GPS",
+            collection=names.suumo_details,
+            filter={"search_time": search_time, "gps": {"$exists": False}},
+        ),
+        CanonicalQuery(
+            name="data_version: latest listing",
+            collection=names.suumo_details,
+            filter={"search_time": search_time},
+            sort={"_id": pymongo.DESCENDING},
+            limit=1,
+        ),
+        CanonicalQuery(
+            name="score: listings after the last run",
+            collection=names.suumo_details,
+            filter={
+                "$and": [{"search_time": search_time}, {"_id": {"$gt": object_id}}]
+            },
+            sort={"_id": pymongo.ASCENDING},
+        ),
+        CanonicalQuery(
+            name="score: batch of listings",
+            collection=names.suumo_details,
+            filter={"_id": {"$in": [object_id]}},
+        ),
+        CanonicalQuery(
+            name="suumo_search by crawl",
+            collection=names.suumo_search,
+            filter={"search_time": search_time},
+            sort={"rank_order": pymongo.ASCENDING},
+        ),
+        CanonicalQuery(
+            name="listing history: listings of a batch",
+            collection=names.suumo_listings,
+            filter={"url": {"$in": ["/ms/chuko/tokyo/sc_minato/nc_00000000/"]}},
+        ),
+        CanonicalQuery(
+            name="listing history: removed from a search",
+            collection=names.suumo_listings,
+            filter={
+                "search_key": "0" * 40,
+                "status": "active",
+                "last_seen": {"$lt": search_time},
+            },
+        ),
+        CanonicalQuery(
+            name="score: listings changed after the last run",
+            collection=names.suumo_listings,
+            filter={
+                "$and": [
+                    {"status": "active"},
+                    {
+                        "$or": [
+                            {"last_changed": {"$gt": search_time}},
+                            {"last_changed": search_time, "_id": {"$gt": object_id}},
+                        ]
+                    },
+                ]
+            },
+            sort={"last_changed": pymongo.ASCENDING, "_id": pymongo.ASCENDING},
+        ),
+        CanonicalQuery(
+            name="listing history: current inventory",
+            collection=names.suumo_listings,
+            filter={"status": "active"},
+        ),
+        CanonicalQuery(
+            name="listing history: listings of a crawl",
+            collection=names.suumo_listings,
+            filter={"search_time": search_time},
+        ),
+        CanonicalQuery(
+            name="listing history: changes of a listing",
+            collection=f"{names.suumo_listings}_changes",
+            filter={"url": "/ms/chuko/tokyo/sc_minato/nc_00000000/"},
+            sort={"time": pymongo.ASCENDING},
+        ),
+        CanonicalQuery(
+            name="listing history: price drops",
+            collection=f"{names.suumo_listings}_changes",
+            filter={
+                "time": {"$gte": search_time},
+                "kind": "changed",
+                "$expr": {"$lt": ["$price", "$previous_price"]},
+            },
+            sort={"time": pymongo.DESCENDING},
+        ),
+        CanonicalQuery(
+            name="enrichment: claim a job",
+            collection=names.enrichment_jobs,
+            filter={
+                "$or": [
+                    {"status": "pending"},
+                    {"status": "leased", "lease_expires": {"$lt": search_time}},
+                ],
+                "attempts": {"$lt": 3},
+            },
+            sort={"created_time": pymongo.ASCENDING, "_id": pymongo.ASCENDING},
+            limit=1,
+        ),
+        CanonicalQuery(
+            name="enrichment: queued listings of a scan",
+            collection=names.enrichment_jobs,
+            filter={
+                "ids": {"$in": [object_id]},
+                "status": {"$in": ["pending", "leased"]},
+            },
+        ),
+        CanonicalQuery(
+            name="enrichment: enriched listings of a scan",
+            collection=names.suumo_features,
+            filter={"_id": {"$in": [object_id]}, "feature_version": "2"},
+        ),
+        CanonicalQuery(
+            name="page cache",
+            collection=f"{names.gridfs_bucket}.files",
+            filter={"filename": "https://suumo.jp/"},
+        ),
+        CanonicalQuery(
+            name="geocode cache",
+            collection=names.geocode_cache,
+            filter={"_id": {"$in": ["東京都港区六本木7-8-4"]}},
+        ),
+        CanonicalQuery(
+            name="trading rollup: CSV records of a year",
+            collection=names.trading_csv,
+            filter={
+                "transaction_quarter": {"$gte": 20230, "$lt": 20240},
+                "type": {"$in": ["中古マンション等"]},
+            },
+        ),
+        CanonicalQuery(
+            name="trading rollup: API records of a year",
+            collection=names.trading_api,
+            filter={"param_year": 2023, "Type": {"$in": ["中古マンション等"]}},
+        ),
+        CanonicalQuery(
+            name="import-trading-api: replace a cell",
+            collection=names.trading_api,
+            filter={"param_year": 2023, "param_area": "13"},
+        ),
+        CanonicalQuery(
+            name="import-trading-api: progress",
+            collection=f"{names.trading_api}_progress",
+            filter={"year": {"$gte": 2005, "$lte": 2023}},
+        ),
+        CanonicalQuery(
+            name="comparable_sales",
+            collection=names.trading_rollup,
+            filter={
+                "level": "city",
+                "key": "13103",
+                "structure": "*",
+                "quarter": {"$gte": 20221, "$lte": 20234},
+            },
+        ),
+        CanonicalQuery(
+            name="trading rollup: latest quarter",
+            collection=names.trading_rollup,
+            filter={},
+            sort={"quarter": pymongo.DESCENDING},
+            limit=1,
+        ),
+        CanonicalQuery(
+            name="trading rollup: replace a year",
+            collection=names.trading_rollup,
+            filter={"quarter": {"$gte": 20230, "$lt": 20240}},
+        ),
+    ]
+    point = GeoPoint(latitude=35.6812, longitude=139.7671)
+    for category in poi_categories(poi_store):
+        queries.append(
+            CanonicalQuery(
+                name=f"find_near {category}",
+                collection=poi_store.collection(category).name,
+                filter=poi_store.near_filter(category, point, 1000),
+                hint=poi_store.index_name(category),
+            )
+        )
+        queries.append(
+            CanonicalQuery(
+                name=f"upsert_category {category}: keys",
+                collection=poi_store.collection(category).name,
+                filter=dict(
+                    poi_store.category_filter(category), poi_key={"$exists": True}
+                ),
+            )
+        )
+    return queries
+
+
+def plan_stages(plan: dict) -> Iterable[dict]:
+    """
+    Walk every stage of an explained plan, including the input stages and SBE query plans
+    """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def explain_query(db: Database, query: CanonicalQuery) -> QueryPlan:
+    explained = db.command("explain", query.command(), verbosity="queryPlanner")
+    stages = list(plan_stages(explained["queryPlanner"]["winningPlan"]))
+    return QueryPlan(
+        query=query.name,
+        collection=query.collection,
+        stages=[s["stage"] for s in stages],
+        indexes=[s["indexName"] for s in stages if "indexName" in s],
+    )
+
+
+def check_queries(db: Database, queries: Iterable[CanonicalQuery]) -> List[QueryPlan]:
+    """
+    Explain the queries without running them
+    :return: plans of the queries, check collection_scan of them
+    """
+    plans = []
+    for query in queries:
+        plan = explain_query(db, query)
+        if plan.collection_scan:
+            log.error(
+                f"{plan.query} scans {plan.collection}: {' <- '.join(plan.stages)}"
+            )
+        else:
+            log.info(f"{plan.query} on {plan.collection}: {' <- '.join(plan.stages)}")
+        plans.append(plan)
+    return plans
@@ -0,0 +1,345 @@
+"""
+物件の履歴（現在の状態と変更記録）
+
+Instead of a full snapshot per crawl, the history store keeps one current document per
+listing URL in ``suumo_listings`` and writes a record to ``suumo_listings_changes`` only when
+a listing is new, changed, removed from its search or listed again. Current documents have
+the same fields as ``suumo_details`` snapshots, so the feature pipeline can read them with
+``SUUMO_COLLECTION=suumo_listings``.
+"""
+
+import logging
+import re
+import time
+from datetime import datetime
+from enum import Enum
+from typing import Dict, Iterable, List, Optional
+
+from pydantic import BaseModel
+from pymongo import InsertOne, UpdateMany, UpdateOne
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+
+from domus_analytica.indexes import LISTING_CHANGE_INDEXES, LISTING_INDEXES
+from domus_analytica.metrics import record_write
+from domus_analytica.poi_store import content_hash
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LISTING_COLLECTION = "suumo_listings"
+# Fields of a crawled listing compared between crawls, the others describe the crawl
+TRACKED_FIELDS = ["content_details", "gps", "nearby_places", "search_details"]
+
+
+class ListingStatus(str, Enum):
+    ACTIVE = "active"
+    REMOVED = "removed"
+
+
+class ChangeKind(str, Enum):
+    NEW = "new"
+    CHANGED = "changed"
+    REMOVED = "removed"
+    RELISTED = "relisted"
+
+
+class CrawlReport(BaseModel):
+    new: int = 0
+    changed: int = 0
+    unchanged: int = 0
+    relisted: int = 0
+    removed: int = 0
+
+    def add(self, other: "CrawlReport"):
+        for field in CrawlReport.model_fields:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+
+def listing_price(doc: dict) -> Optional[float]:
+    """
+    :return: price (万円) in the same way as parse_listing, None if not found
+    """
+    for d in doc.get("content_details", []):
+        if d["type"] == "価格":
+            found = re.findall("([+-]?([0-9]*[.])?[0-9]+)万円", d["content"])
+            return float(found[0][0]) if found else None
+    return None
+
+
+def search_key(search_url: Optional[str], search_args: Optional[dict]) -> str:
+    """
+    Identify a search, SUUMO keeps every criterion in the query string and the path is shared
+    :param search_url: path of the search URL
+    :param search_args: parsed query string, name -> values
+    """
+    return content_hash(
+        {
+            "search_url": search_url,
+            "search_args": {
+                k: sorted(v) for k, v in sorted((search_args or {}).items())
+            },
+        }
+    )
+
+
+def tracked_hash(doc: dict) -> str:
+    return content_hash({f: doc.get(f) for f in TRACKED_FIELDS})
+
+
+def details_diff(old: dict, new: dict) -> Dict[str, list]:
+    """
+    Compare two versions of a listing
+    :return: name -> [old value, new value], names are types of content_details (e.g. 価格),
+        title, properties, gps and nearby_places
+    """
+    diff = {}
+    old_details = {d["type"]: d["content"] for d in old.get("content_details", [])}
+    new_details = {d["type"]: d["content"] for d in new.get("content_details", [])}
+    for key in sorted(old_details.keys() | new_details.keys()):
+        if old_details.get(key) != new_details.get(key):
+            diff[key] = [old_details.get(key), new_details.get(key)]
+    old_search = old.get("search_details") or {}
+    new_search = new.get("search_details") or {}
+    for key in ("title", "properties"):
+        if old_search.get(key) != new_search.get(key):
+            diff[key] = [old_search.get(key), new_search.get(key)]
+    for key in ("gps", "nearby_places"):
+        if old.get(key) != new.get(key):
+            diff[key] = [old.get(key), new.get(key)]
+    return diff
+
+
+class ListingHistoryStore:
+    def __init__(self, db: Database, collection: str = DEFAULT_LISTING_COLLECTION):
+        self.coll = db.get_collection(collection)
+        self.changes_coll = db.get_collection(f"{collection}_changes")
+
+    def ensure_indexes(self):
+        self.coll.create_indexes(LISTING_INDEXES)
+        self.changes_coll.create_indexes(LISTING_CHANGE_INDEXES)
+
+    def record_many(self, docs: Iterable[dict], search_time: datetime) -> CrawlReport:
+        """
+        Record listings seen in a crawl, only new and changed ones are written in full
+        :param docs: parsed detail pages with search_details and the fields of the crawl
+            (search_url, search_args, rank_order, create_time), as inserted to suumo_details
+        :param search_time: time the crawl started
+        :return: counts of the listings
+        """
+        docs = {doc["search_details"]["url"]: doc for doc in docs}
+        report = CrawlReport()
+        if not docs:
+            return report
+        existing = {
+            doc["url"]: doc
+            for doc in self.coll.find(
+                {"url": {"$in": list(docs.keys())}},
+                projection={
+                    f: True
+                    for f in TRACKED_FIELDS + ["url", "status", "content_hash", "price"]
+                },
+            )
+        }
+        operations = []
+        changes = []
+        for url, doc in docs.items():
+            doc_hash = tracked_hash(doc)
+            price = listing_price(doc)
+            seen = {
+                "search_url": doc.get("search_url"),
+                "search_args": doc.get("search_args"),
+                "search_key": search_key(doc.get("search_url"), doc.get("search_args")),
+                "rank_order": doc.get("rank_order"),
+                "search_time": search_time,
+                "last_seen": search_time,
+                "status": ListingStatus.ACTIVE.value,
+            }
+            current = existing.get(url)
+            if current is None:
+                kind = ChangeKind.NEW
+                diff = {}
+            elif current["content_hash"] != doc_hash:
+                kind = ChangeKind.CHANGED
+                diff = details_diff(current, doc)
+            elif current.get("status") == ListingStatus.REMOVED.value:
+                kind = ChangeKind.RELISTED
+                diff = {}
+            else:
+                kind = None
+                diff = {}
+
+            if kind is None:
+                operations.append(UpdateOne({"url": url}, {"$set": seen}))
+                report.unchanged += 1
+                continue
+            update = {"$set": dict(seen, last_changed=search_time)}
+            if kind in (ChangeKind.NEW, ChangeKind.CHANGED):
+                update["$set"].update(
+                    {f: doc[f] for f in TRACKED_FIELDS if f in doc},
+                    content_hash=doc_hash,
+                    price=price,
+                    create_time=doc.get("create_time", search_time),
+                )
+                missing = [f for f in TRACKED_FIELDS if f not in doc]
+                if missing and current is not None:
+                    update["$unset"] = {f: "" for f in missing}
+                update["$setOnInsert"] = {"first_seen": search_time}
+            operations.append(UpdateOne({"url": url}, update, upsert=True))
+            changes.append(
+                InsertOne(
+                    {
+                        "url": url,
+                        "time": search_time,
+                        "kind": kind.value,
+                        "changes": diff,
+                        "price": price,
+                        "previous_price": current.get("price") if current else None,
+                    }
+                )
+            )
+            setattr(report, kind.value, getattr(report, kind.value) + 1)
+
+        start = time.perf_counter()
+        self.coll.bulk_write(operations, ordered=False)
+        record_write(self.coll.name, len(operations), time.perf_counter() - start)
+        if changes:
+            start = time.perf_counter()
+            self.changes_coll.bulk_write(changes, ordered=False)
+            record_write(
+                self.changes_coll.name, len(changes), time.perf_counter() - start
+            )
+        return report
+
+    def record(self, doc: dict, search_time: datetime) -> CrawlReport:
+        return self.record_many([doc], search_time)
+
+    def mark_removed(self, key: str, search_time: datetime) -> int:
+        """
+        Mark the listings of a search not seen in its crawl as removed,
+        call it only when the crawl read every page of the search
+        :param key: search_key of the search
+        :return: count of the listings removed
+        """
+        query = {
+            "search_key": key,
+            "status": ListingStatus.ACTIVE.value,
+            "last_seen": {"$lt": search_time},
+        }
+        removed = list(
+            self.coll.find(query, projection={"_id": False, "url": True, "price": True})
+        )
+        if not removed:
+            return 0
+        self.coll.bulk_write(
+            [
+                UpdateMany(
+                    query,
+                    {
+                        "$set": {
+                            "status": ListingStatus.REMOVED.value,
+                            "last_changed": search_time,
+                        }
+                    },
+                )
+            ]
+        )
+        self.changes_coll.insert_many(
+            [
+                {
+                    "url": doc["url"],
+                    "time": search_time,
+                    "kind": ChangeKind.REMOVED.value,
+                    "changes": {},
+                    "price": doc.get("price"),
+                    "previous_price": doc.get("price"),
+                }
+                for doc in removed
+            ],
+            ordered=False,
+        )
+        return len(removed)
+
+    def current_inventory(
+        self, query: Optional[dict] = None, projection: Optional[dict] = None
+    ) -> Cursor:
+        """
+        Listings still on sale
+        :param query: extra filter, e.g. {"search_key": search_key(search_url, search_args)}
+        """
+        return self.coll.find(
+            dict(query or {}, status=ListingStatus.ACTIVE.value), projection=projection
+        )
+
+    def history(self, url: str) -> List[dict]:
+        """
+        :return: change records of the listing, oldest first
+        """
+        return list(
+            self.changes_coll.find({"url": url}, projection={"_id": False}).sort(
+                "time", 1
+            )
+        )
+
+    def price_history(self, url: str) -> List[dict]:
+        """
+        :return: [{"time": ..., "price": ...}] for every change of the price, oldest first
+        """
+        result = []
+        for change in self.history(url):
+            if change["kind"] == ChangeKind.REMOVED.value:
+                continue
+            if not result or result[-1]["price"] != change["price"]:
+                result.append({"time": change["time"], "price": change["price"]})
+        return result
+
+    def price_drops(self, since: datetime) -> Cursor:
+        """
+        Change records lowering the price since the time, newest first
+        """
+        return self.changes_coll.find(
+            {
+                "time": {"$gte": since},
+                "kind": ChangeKind.CHANGED.value,
+                "$expr": {"$lt": ["$price", "$previous_price"]},
+            },
+            projection={"_id": False},
+        ).sort("time", -1)
+
+
+def backfill(
+    store: ListingHistoryStore, suumo_details: Cursor, batch_size: int = 1000
+) -> CrawlReport:
+    """
+    Replay snapshots of suumo_details into the history store
+    :param suumo_details: snapshots sorted by search_time
+    :param batch_size: listings recorded per batch
+    :return: total counts of all crawls
+    """
+    total = CrawlReport()
+
+    def finish_crawl(search_time: datetime, search_keys: set):
+        for key in search_keys:
+            total.removed += store.mark_removed(key, search_time)
+        log.info(f"Crawl at {search_time} replayed, {total}")
+
+    batch: List[dict] = []
+    search_time = None
+    search_keys: set = set()
+    for doc in suumo_details:
+        if doc["search_time"] != search_time:
+            if batch:
+                total.add(store.record_many(batch, search_time))
+                batch = []
+            if search_time is not None:
+                finish_crawl(search_time, search_keys)
+            search_time, search_keys = doc["search_time"], set()
+        search_keys.add(search_key(doc.get("search_url"), doc.get("search_args")))
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            total.add(store.record_many(batch, search_time))
+            batch = []
+    if batch:
+        total.add(store.record_many(batch, search_time))
+    if search_time is not None:
+        finish_crawl(search_time, search_keys)
+    return total
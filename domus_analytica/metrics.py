@@ -0,0 +1,338 @@
+"""
+コマンド共通のメトリクス
+
+Counters, gauges and histograms shared by every command of the process. They are always
+recorded (a lock and a dict update each), and only exposed when asked:
+`domus-analytica --metrics-port 9100 <command>` serves them in Prometheus text format,
+`--metrics-summary <file>` writes them as JSON when the command exits.
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(
+                f"{self.name} expects labels {self.label_names} but got {tuple(labels)}"
+            )
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def samples(self) -> Iterable[Tuple[str, LabelValues, Tuple[str, ...], float]]:
+        """
+        :return: (suffix, label values, extra label names and values, value)
+        """
+        raise NotImplementedError("Please implement samples")
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, extra, value in self.samples():
+            names = self.label_names + tuple(extra[0::2])
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, values + tuple(extra[1::2]))} "
+                f"{_format_value(value)}"
+            )
+        return lines
+
+    def summary(self) -> List[dict]:
+        raise NotImplementedError("Please implement summary")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help, label_names)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [("", k, (), v) for k, v in sorted(self.values.items())]
+
+    def summary(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"labels": dict(zip(self.label_names, k)), "value": v}
+                for k, v in sorted(self.values.items())
+            ]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(buckets)
+        # label values -> (counts per bucket and +Inf, sum)
+        self.values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    result.append(
+                        ("_bucket", key, ("le", _format_value(bound)), cumulative)
+                    )
+                result.append(("_sum", key, (), total))
+                result.append(("_count", key, (), cumulative))
+        return result
+
+    def summary(self) -> List[dict]:
+        with self._lock:
+            return [
+                {
+                    "labels": dict(zip(self.label_names, k)),
+                    "count": sum(counts),
+                    "sum": total,
+                    "mean": total / sum(counts) if sum(counts) else None,
+                    "buckets": {
+                        _format_value(b): c
+                        for b, c in zip(self.buckets + (float("inf"),), counts)
+                        if c
+                    },
+                }
+                for k, (counts, total) in sorted(self.values.items())
+            ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.start_time = datetime.now()
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self.metrics.setdefault(metric.name, metric)
+        if type(existing) is not type(metric):
+            raise ValueError(f"{metric.name} is registered as a {existing.type}")
+        return existing
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, label_names))
+
+    def gauge(self, name: str, help: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def render(self) -> str:
+        """
+        :return: metrics in Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "".join(f"{line}\n" for m in metrics for line in m.render())
+
+    def summary(self) -> dict:
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return {
+            "start_time": self.start_time.isoformat(),
+            "end_time": datetime.now().isoformat(),
+            "metrics": {
+                m.name: {"type": m.type, "help": m.help, "values": m.summary()}
+                for m in metrics
+            },
+        }
+
+    def write_summary(self, path: str):
+        with open(path, "w") as fp:
+            json.dump(self.summary(), fp, indent=2, ensure_ascii=False)
+        log.info(f"Metrics summary written to {path}")
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "domus_http_requests_total",
+    "HTTP requests sent to external services by status, error for exceptions",
+    ["target", "status"],
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "domus_http_request_seconds",
+    "Latency of HTTP requests sent to external services",
+    ["target"],
+)
+CACHE_LOOKUPS = REGISTRY.counter(
+    "domus_cache_lookups_total",
+    "Lookups of response caches, result is hit or miss",
+    ["cache", "result"],
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "domus_parse_seconds",
+    "Time of parsing pages and files",
+    ["kind"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+MONGO_WRITE_BATCHES = REGISTRY.counter(
+    "domus_mongo_write_batches_total",
+    "Write operations (insert_one, insert_many, bulk_write) sent to MongoDB",
+    ["collection"],
+)
+MONGO_DOCUMENTS_WRITTEN = REGISTRY.counter(
+    "domus_mongo_documents_written_total",
+    "Documents written to MongoDB",
+    ["collection"],
+)
+MONGO_WRITE_SECONDS = REGISTRY.histogram(
+    "domus_mongo_write_seconds",
+    "Latency of MongoDB write operations",
+    ["collection"],
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "domus_queue_depth",
+    "Tasks submitted but not finished yet",
+    ["queue"],
+)
+
+
+def record_write(collection: str, documents: int, seconds: float):
+    """
+    Record one write operation to MongoDB
+    :param collection: name of the collection
+    :param documents: documents written by the operation
+    :param seconds: time of the operation
+    """
+    MONGO_WRITE_BATCHES.inc(collection=collection)
+    MONGO_DOCUMENTS_WRITTEN.inc(documents, collection=collection)
+    MONGO_WRITE_SECONDS.observe(seconds, collection=collection)
+
+
+@contextmanager
+def track_request(target: str):
+    """
+    Time and count a request sent by a client library, status is ok or error
+    """
+    status = "error"
+    try:
+        with HTTP_REQUEST_SECONDS.time(target=target):
+            yield
+        status = "ok"
+    finally:
+        HTTP_REQUESTS.inc(target=target, status=status)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        log.debug(format % args)
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serve /metrics in a daemon thread
+    :return: the server, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    log.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+
+def stop_metrics(server: Optional[ThreadingHTTPServer]):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,512 @@
+"""
+物件価格モデルの学習
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+from datetime import datetime
+from itertools import chain
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pymongo
+import xgboost as xgb
+from bson import json_util
+from pydantic import BaseModel
+from sklearn.metrics import (
+    mean_absolute_percentage_error,
+    mean_squared_error,
+    r2_score,
+)
+from sklearn.model_selection import train_test_split
+
+from domus_analytica.config import DEFAULT_SUUMO_COLLECTION, DomusSettings
+from domus_analytica.data_clean import extract_info_to_table, poi_source_version
+from domus_analytica.mongo import get_database
+from domus_analytica.trading_rollup import TradingRollupStore
+
+log = logging.getLogger(__name__)
+
+# Bump it when data_preprocessing or FEATURES changed, so that cached matrices are rebuilt
+FEATURE_VERSION = "2"
+FEATURE_PREFIXES = ["direction_", "layout_main_", "build_type_"]
+FEATURES = [
+    # GIS data from MongoDB
+    "nearest_station_distance",
+    "nearest_station_passengers",
+    "nearest_station_covid_ratio",
+    "population_estimation_mean",
+    "population_estimation_median",
+    "bus_stop_count",
+    "bus_route_count",
+    "bus_stops_distance_min",
+    "bus_route_pre_stop",
+    "min_distance_to_cemetery",
+    # More radii and k-nearest from the same POI queries, see poi_features.FEATURE_SPECS
+    "station_count_500m",
+    "station_count_1000m",
+    "station_count_2000m",
+    "station_passengers_sum_500m",
+    "station_passengers_sum_1000m",
+    "station_passengers_sum_2000m",
+    "station_distance_2nn",
+    "station_distance_3nn",
+    "population_total_population_sum_500m",
+    "population_total_population_sum_1000m",
+    "bus_stop_count_300m",
+    "bus_stop_count_500m",
+    "bus_stop_route_sum_300m",
+    "bus_stop_route_sum_500m",
+    "bus_stop_distance_3nn",
+    # Comparable sales
+    "comps_city_price_median",
+    "comps_city_volume",
+    "comps_city_trend",
+    "comps_station_price_median",
+    "comps_station_volume",
+    "comps_station_trend",
+    # Listing
+    "floor",
+    "total_floors",
+    "floor_ratio",
+    "common_area",
+    "layout_storage_room",
+    "exclusive_area",
+    "completion_date_number",
+    "monthly_fee_total",
+]
+TARGET = "unit_price"
+# Rows of the training table checked for the parity of the row by row preprocessing
+PARITY_SAMPLE_SIZE = 200
+DEFAULT_PARAMS = {
+    "objective": "reg:squarederror",
+    "eval_metric": "rmse",
+    "tree_method": "hist",
+    "max_depth": 7,
+    "learning_rate": 0.3,
+}
+
+
+def _number(value) -> float:
+    if value is None or value is pd.NA:
+        return math.nan
+    return float(value)
+
+
+def _divide(a: float, b: float) -> float:
+    """
+    Same as the division of float columns, x / 0 is ±inf and 0 / 0 is NaN
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return float(np.float64(a) / np.float64(b))
+
+
+def _direction_mapping(s: str) -> str:
+    return s.replace("東", "E").replace("南", "S").replace("西", "W").replace("北", "N")
+
+
+def preprocess_record(record: dict) -> dict:
+    """
+    Derive features of one listing for the valuation service, which can't afford DataFrame
+    operations per request, the same as data_preprocessing does for a table
+    :param record: a row of extract_info_to_table
+    :return: the row with derived features, categories are one-hot encoded
+    """
+    result = dict(record)
+    exclusive_area = _number(record.get("exclusive_area"))
+    if "price" in record:
+        result["unit_price"] = _divide(_number(record["price"]), exclusive_area)
+    completion_date = record.get("completion_date")
+    result["completion_date_number"] = (
+        (pd.Timestamp(completion_date) - pd.Timestamp("1970-01-01")).days / 365.25
+        + 1970
+        if isinstance(completion_date, str)
+        else math.nan
+    )
+    result["bus_route_pre_stop"] = _number(record.get("bus_route_count")) / (
+        _number(record.get("bus_stop_count")) + 0.01
+    )
+    result["floor_ratio"] = _divide(
+        _number(record.get("floor")), _number(record.get("total_floors"))
+    )
+    for column in ("direction", "layout_main", "build_type"):
+        value = result.pop(column, None)
+        if isinstance(value, str):
+            if column == "direction":
+                value = _direction_mapping(value)
+            result[f"{column}_{value}"] = 1.0
+    return result
+
+
+def data_preprocessing(data: pd.DataFrame) -> pd.DataFrame:
+    data = data.reindex(
+        columns=data.columns.union(
+            [
+                "exclusive_area",
+                "completion_date",
+                "bus_route_count",
+                "bus_stop_count",
+                "floor",
+                "total_floors",
+            ],
+            sort=False,
+        )
+    )
+    if "price" in data.columns:
+        data["unit_price"] = data["price"] / data["exclusive_area"]
+    data["completion_date_number"] = (
+        pd.to_datetime(data["completion_date"]) - pd.Timestamp("1970-01-01")
+    ).dt.days / 365.25 + 1970
+    data["bus_route_pre_stop"] = data["bus_route_count"] / (
+        data["bus_stop_count"] + 0.01
+    )
+    data["floor_ratio"] = data["floor"] * 1.0 / data["total_floors"]
+
+    if "direction" in data.columns:
+        data["direction"] = data["direction"].map(
+            _direction_mapping, na_action="ignore"
+        )
+    # A small batch for scoring may not have all of these columns
+    return pd.get_dummies(
+        data,
+        columns=[
+            c for c in ("direction", "layout_main", "build_type") if c in data.columns
+        ],
+        dtype="float32",
+    )
+
+
+def preprocessing_mismatches(data: pd.DataFrame, tolerance: float = 1e-6) -> List[str]:
+    """
+    Compare the feature vectors of data_preprocessing and preprocess_record
+    :param data: rows of extract_info_to_table, a small sample is enough
+    :return: "<row> <feature>: <table> != <record>" for every differing value
+    """
+    table = data_preprocessing(data)
+    features = feature_columns(table)
+    matrix = design_matrix(table, features)
+    mismatches = []
+    for i, record in enumerate(data.to_dict("records")):
+        vector = feature_vector(preprocess_record(record), features)[0]
+        for feature, a, b in zip(features, matrix[i], vector):
+            if not (
+                (np.isnan(a) and np.isnan(b))
+                or a == b
+                or abs(a - b) <= tolerance * max(abs(a), abs(b))
+            ):
+                mismatches.append(f"{i} {feature}: {a} != {b}")
+    return mismatches
+
+
+def finite_or_none(value) -> Optional[float]:
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def feature_columns(df: pd.DataFrame) -> List[str]:
+    return sorted(
+        set(
+            chain(
+                (c for c in FEATURES if c in df.columns),
+                *(
+                    [col for col in df.columns if col.startswith(prefix)]
+                    for prefix in FEATURE_PREFIXES
+                ),
+            )
+        )
+    )
+
+
+def design_matrix(df: pd.DataFrame, features: List[str]) -> np.ndarray:
+    """
+    Build float32 matrix with the columns in features, missing columns are filled with NaN
+    (dummy columns are filled with 0)
+    """
+    matrix = df.reindex(columns=features).astype("float32")
+    dummy_columns = [
+        c for c in features if any(c.startswith(p) for p in FEATURE_PREFIXES)
+    ]
+    matrix[dummy_columns] = matrix[dummy_columns].fillna(0.0)
+    return matrix.to_numpy()
+
+
+def feature_vector(record: dict, features: List[str]) -> np.ndarray:
+    """
+    design_matrix of a single preprocessed record, without building a DataFrame
+    """
+    return np.array(
+        [
+            [
+                record.get(
+                    f,
+                    0.0 if any(f.startswith(p) for p in FEATURE_PREFIXES) else math.nan,
+                )
+                for f in features
+            ]
+        ],
+        dtype="float32",
+    )
+
+
+def data_version(config: DomusSettings, suumo_filter: dict) -> str:
+    """
+    Identify the listings selected by the filter, by count and the latest ObjectId,
+    and the latest change for the history store whose documents are updated in place,
+    along with the POI and the trading rollups their features are joined with
+    """
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    suumo_details = domus_db.get_collection(config.suumo_collection)
+    count = suumo_details.count_documents(suumo_filter)
+    latest = suumo_details.find_one(
+        suumo_filter, projection={"_id": True}, sort=[("_id", pymongo.DESCENDING)]
+    )
+    version = {
+        "filter": suumo_filter,
+        "count": count,
+        "latest": latest["_id"] if latest else None,
+    }
+    if config.suumo_collection != DEFAULT_SUUMO_COLLECTION:
+        version["collection"] = config.suumo_collection
+    if config.reads_listing_history:
+        changed = suumo_details.find_one(
+            suumo_filter,
+            projection={"last_changed": True},
+            sort=[("last_changed", pymongo.DESCENDING)],
+        )
+        version["last_changed"] = changed.get("last_changed") if changed else None
+    if config.geocode_missing_gps:
+        # GPS-less listings get GIS features as well
+        version["geocode_missing_gps"] = True
+    version["poi"] = poi_source_version(config, domus_db)
+    version["trading_rollup"] = list(
+        TradingRollupStore(domus_db).state_coll.find(sort=[("_id", pymongo.ASCENDING)])
+    )
+    digest = hashlib.sha1(json_util.dumps(version, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+class FeatureMatrix(BaseModel, arbitrary_types_allowed=True):
+    ids: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    exclusive_area: np.ndarray
+    features: List[str]
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            ids=self.ids,
+            x=self.x,
+            y=self.y,
+            exclusive_area=self.exclusive_area,
+            features=np.array(self.features),
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: Path) -> "FeatureMatrix":
+        with np.load(path, allow_pickle=False) as data:
+            return FeatureMatrix(
+                ids=data["ids"],
+                x=data["x"],
+                y=data["y"],
+                exclusive_area=data["exclusive_area"],
+                features=data["features"].tolist(),
+            )
+
+
+def build_feature_matrix(
+    config: DomusSettings,
+    suumo_filter: dict,
+    cache_dir: Optional[str] = "data/feature_cache",
+    refresh: bool = False,
+) -> FeatureMatrix:
+    """
+    Build the training matrix, it's cached by the version of data and features
+    :param config: DomusSettings instance
+    :param suumo_filter: filter of suumo_details for training
+    :param cache_dir: directory for cached matrices, None to disable the cache
+    :param refresh: rebuild the matrix even if it's cached
+    :return: feature matrix
+    """
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = (
+            Path(cache_dir)
+            / f"features-v{FEATURE_VERSION}-{data_version(config, suumo_filter)}.npz"
+        )
+        if not refresh and cache_path.is_file():
+            log.info(f"Loading cached feature matrix from {cache_path}")
+            return FeatureMatrix.load(cache_path)
+
+    log.info("Building feature matrix from MongoDB")
+    raw = extract_info_to_table(config, suumo_filter)
+    # The valuation service derives the features row by row, they must not diverge
+    mismatches = preprocessing_mismatches(
+        raw.sample(min(len(raw), PARITY_SAMPLE_SIZE), random_state=0)
+    )
+    if mismatches:
+        log.warning(
+            f"{len(mismatches)} features differ between data_preprocessing and preprocess_record, "
+            f"e.g. {mismatches[:5]}"
+        )
+    df = data_preprocessing(raw)
+    df = df[np.isfinite(df[TARGET].astype(float))]
+    features = feature_columns(df)
+    matrix = FeatureMatrix(
+        ids=df["id"].to_numpy(dtype=str),
+        x=design_matrix(df, features),
+        y=df[TARGET].to_numpy(dtype="float32"),
+        exclusive_area=df["exclusive_area"].to_numpy(dtype="float32"),
+        features=features,
+    )
+    if cache_path is not None:
+        matrix.save(cache_path)
+        log.info(f"Feature matrix saved to {cache_path}")
+    return matrix
+
+
+def split_indices(
+    size: int, test_ratio: float = 0.1, val_ratio: float = 0.1, random_state: int = 123
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    indices = np.arange(size)
+    train_idx, test_idx = train_test_split(
+        indices, test_size=test_ratio, random_state=random_state
+    )
+    train_idx, val_idx = train_test_split(
+        train_idx, test_size=(val_ratio / (1 - test_ratio)), random_state=random_state
+    )
+    return train_idx, val_idx, test_idx
+
+
+def evaluate(
+    booster: xgb.Booster, matrix: FeatureMatrix, indices: np.ndarray
+) -> Dict[str, float]:
+    prediction = booster.inplace_predict(matrix.x[indices])
+    y = matrix.y[indices]
+    area = matrix.exclusive_area[indices]
+    return {
+        "r2": float(r2_score(y, prediction)),
+        "unit_price_rmse": math.sqrt(mean_squared_error(y, prediction)),
+        "total_price_rmse": math.sqrt(mean_squared_error(y * area, prediction * area)),
+        "total_price_mape": float(
+            mean_absolute_percentage_error(y * area, prediction * area)
+        ),
+    }
+
+
+def train_model(
+    matrix: FeatureMatrix,
+    params: Optional[dict] = None,
+    num_boost_round: int = 6,
+    early_stopping_rounds: Optional[int] = None,
+    nthread: Optional[int] = None,
+) -> Tuple[xgb.Booster, Dict[str, Dict[str, float]]]:
+    """
+    Train XGBoost with histogram trees
+    :param nthread: threads for training, use all cores if not set
+    :return: booster and metrics of train/val/test set
+    """
+    train_idx, val_idx, test_idx = split_indices(len(matrix.y))
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    if nthread is not None:
+        params["nthread"] = nthread
+    dtrain = xgb.QuantileDMatrix(
+        matrix.x[train_idx], matrix.y[train_idx], feature_names=matrix.features
+    )
+    dval = xgb.DMatrix(
+        matrix.x[val_idx], matrix.y[val_idx], feature_names=matrix.features
+    )
+    booster = xgb.train(
+        params,
+        dtrain,
+        num_boost_round=num_boost_round,
+        evals=[(dval, "val")],
+        early_stopping_rounds=early_stopping_rounds,
+        verbose_eval=False,
+    )
+    metrics = {
+        name: evaluate(booster, matrix, idx)
+        for name, idx in (("train", train_idx), ("val", val_idx), ("test", test_idx))
+    }
+    return booster, metrics
+
+
+def save_model_artifact(
+    booster: xgb.Booster,
+    matrix: FeatureMatrix,
+    metrics: Dict[str, Dict[str, float]],
+    params: dict,
+    model_dir: str,
+    data_version_id: Optional[str] = None,
+) -> Path:
+    """
+    Save the model with metadata to model_dir/<version>/
+    :return: directory of the artifact
+    """
+    version = datetime.now().strftime("%Y%m%d-%H%M%S")
+    artifact_dir = Path(model_dir) / version
+    artifact_dir.mkdir(parents=True, exist_ok=False)
+    booster.save_model(artifact_dir / "model.ubj")
+    with open(artifact_dir / "metadata.json", "w") as fp:
+        json.dump(
+            {
+                "version": version,
+                "feature_version": FEATURE_VERSION,
+                "data_version": data_version_id,
+                "features": matrix.features,
+                "target": TARGET,
+                "params": params,
+                "rows": len(matrix.y),
+                "metrics": metrics,
+                "create_time": datetime.now().isoformat(),
+            },
+            fp,
+            indent=2,
+            ensure_ascii=False,
+        )
+    return artifact_dir
+
+
+class ModelArtifact(BaseModel, arbitrary_types_allowed=True):
+    booster: xgb.Booster
+    metadata: dict
+
+    @property
+    def features(self) -> List[str]:
+        return self.metadata["features"]
+
+    @property
+    def version(self) -> str:
+        return self.metadata["version"]
+
+    @staticmethod
+    def load(path: str) -> "ModelArtifact":
+        """
+        :param path: artifact directory, or model_dir to load the latest one
+        """
+        artifact_dir = Path(path)
+        if not (artifact_dir / "metadata.json").is_file():
+            versions = sorted(
+                p for p in artifact_dir.iterdir() if (p / "metadata.json").is_file()
+            )
+            if not versions:
+                raise ValueError(f"No model found in {path}")
+            artifact_dir = versions[-1]
+        booster = xgb.Booster()
+        booster.load_model(artifact_dir / "model.ubj")
+        with open(artifact_dir / "metadata.json", "r") as fp:
+            return ModelArtifact(booster=booster, metadata=json.load(fp))
+
+    def predict_unit_price(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        :param df: preprocessed listing table
+        """
+        return self.booster.inplace_predict(design_matrix(df, self.features))
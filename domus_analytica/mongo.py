@@ -0,0 +1,111 @@
+"""
+MongoDBクライアントの共有
+
+One pooled client per URI per process. Commands and helpers get databases from here
+instead of creating their own MongoClient, so connections (and their TLS handshakes)
+are reused within a process.
+"""
+
+import importlib.util
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from pymongo import MongoClient
+    from pymongo.database import Database
+
+    from domus_analytica.config import MongoSettings
+
+log = logging.getLogger(__name__)
+
+# Compressor name -> module required by pymongo, zlib is always available
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+
+def available_compressors(compressors: str) -> List[str]:
+    result = []
+    for name in (c.strip() for c in compressors.split(",")):
+        if not name:
+            continue
+        if name not in COMPRESSOR_MODULES:
+            raise ValueError(f"Unknown compressor {name}")
+        module = COMPRESSOR_MODULES[name]
+        if module is None or importlib.util.find_spec(module) is not None:
+            result.append(name)
+        else:
+            log.info(
+                f"Compressor {name} skipped since {module} is not installed, "
+                f"install the compression extra to enable it"
+            )
+    return result
+
+
+def client_options(settings: "MongoSettings") -> dict:
+    options = dict(
+        maxPoolSize=settings.mongo_max_pool_size,
+        minPoolSize=settings.mongo_min_pool_size,
+        connectTimeoutMS=settings.mongo_connect_timeout_ms,
+        serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+        socketTimeoutMS=settings.mongo_socket_timeout_ms,
+    )
+    compressors = available_compressors(settings.mongo_compressors)
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+
+_clients: Dict[str, "MongoClient"] = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Sockets and monitor threads of the parent's clients are unusable in a forked child,
+    # drop them so the child creates its own
+    global _lock
+    _clients.clear()
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_client(uri: str, settings: Optional["MongoSettings"] = None) -> "MongoClient":
+    """
+    :param uri: MongoDB URI
+    :param settings: options for creating the client, read from environment variables if not set,
+        ignored if the client of the URI was created
+    :return: the shared client of the URI
+    """
+    # Imported here since every command imports this module, even for --help
+    from pymongo import MongoClient
+
+    from domus_analytica.config import MongoSettings
+    from domus_analytica.profiling import get_profiler
+
+    with _lock:
+        client = _clients.get(uri)
+        if client is None:
+            options = client_options(settings or MongoSettings())
+            log.debug(f"Creating MongoDB client with {options}")
+            profiler = get_profiler()
+            if profiler.enabled:
+                options["event_listeners"] = [profiler.listener]
+            client = MongoClient(uri, **options)
+            _clients[uri] = client
+        return client
+
+
+def get_database(
+    uri: str, db_name: str, settings: Optional["MongoSettings"] = None
+) -> "Database":
+    return get_client(uri, settings).get_database(db_name)
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,367 @@
+"""
+Google Places API の検索と応答キャッシュ
+"""
+
+import hashlib
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from googlemaps.exceptions import ApiError
+from pydantic import BaseModel
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.metrics import CACHE_LOOKUPS, QUEUE_DEPTH, track_request
+
+log = logging.getLogger(__name__)
+
+# Nearby search returns at most 3 pages of 20 results
+PLACES_PAGE_SIZE = 20
+PLACES_RESULT_CAP = 60
+PLACES_MAX_RADIUS = 50000
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class PlacesResponseCache:
+    """
+    Raw responses of Places API saved as JSON files, keyed by the request parameters
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: Dict[str, Any]) -> Path:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.json"
+
+    def get(self, key: Dict[str, Any]) -> Optional[dict]:
+        path = self._path(key)
+        if path.is_file():
+            with open(path, "r") as fp:
+                return json.load(fp)
+        return None
+
+    def set(self, key: Dict[str, Any], value: dict):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(dict(key=key, **value), fp, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+class CachedPlacesClient:
+    def __init__(
+        self,
+        client,
+        cache: PlacesResponseCache,
+        quota: Optional[int] = None,
+        page_token_delay: float = 2.0,
+        page_token_retries: int = 5,
+    ):
+        """
+        Nearby search with response caching and request budget
+        :param client: googlemaps.Client or OfflinePlacesClient
+        :param cache: cache of raw responses
+        :param quota: max count of requests sent to the API, None for no limitation
+        :param page_token_delay: seconds to wait before next_page_token becomes valid
+        :param page_token_retries: retries for a page token which is not valid yet
+        """
+        self.client = client
+        self.cache = cache
+        self.quota = quota
+        self.page_token_delay = page_token_delay
+        self.page_token_retries = page_token_retries
+        self.api_requests = 0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+
+    def _acquire_quota(self):
+        with self._lock:
+            if self.quota is not None and self.api_requests >= self.quota:
+                raise QuotaExceeded(f"Quota of {self.quota} requests exhausted")
+            self.api_requests += 1
+
+    def _next_page(self, page_token: str) -> dict:
+        for i in range(self.page_token_retries):
+            time.sleep(self.page_token_delay if i == 0 else self.page_token_delay / 2)
+            self._acquire_quota()
+            try:
+                with track_request("google_places"):
+                    return self.client.places_nearby(page_token=page_token)
+            except ApiError as ex:
+                if ex.status != "INVALID_REQUEST":
+                    raise ex
+                log.debug(f"Page token is not ready yet, retry {i + 1}")
+        raise ValueError("Page token is still invalid after retried")
+
+    def nearby(
+        self, location: GeoPoint, radius: int, place_type: str, language: str = "ja"
+    ) -> List[dict]:
+        """
+        Search places around the location, all pages are fetched
+        :return: raw responses of every page
+        """
+        key = {
+            "location": [round(location.latitude, 7), round(location.longitude, 7)],
+            "radius": radius,
+            "type": place_type,
+            "language": language,
+        }
+        cached = self.cache.get(key)
+        CACHE_LOOKUPS.inc(
+            cache="places_response", result="miss" if cached is None else "hit"
+        )
+        if cached is not None:
+            with self._lock:
+                self.cache_hits += 1
+            return cached["pages"]
+
+        self._acquire_quota()
+        with track_request("google_places"):
+            result = self.client.places_nearby(
+                location=(location.latitude, location.longitude),
+                radius=radius,
+                type=place_type,
+                language=language,
+            )
+        pages = [result]
+        while "next_page_token" in result:
+            result = self._next_page(result["next_page_token"])
+            pages.append(result)
+        self.cache.set(key, {"pages": pages})
+        return pages
+
+
+class SweepCell(BaseModel):
+    min_longitude: float
+    min_latitude: float
+    max_longitude: float
+    max_latitude: float
+    depth: int = 0
+
+    @property
+    def center(self) -> GeoPoint:
+        return GeoPoint(
+            latitude=(self.min_latitude + self.max_latitude) / 2,
+            longitude=(self.min_longitude + self.max_longitude) / 2,
+        )
+
+    @property
+    def radius(self) -> int:
+        """
+        Radius (m) of the circumscribed circle
+        """
+        corner = GeoPoint(latitude=self.max_latitude, longitude=self.max_longitude)
+        return int(math.ceil((self.center - corner) * 1000))
+
+    def split(self) -> List["SweepCell"]:
+        center = self.center
+        return [
+            SweepCell(
+                min_longitude=lng0,
+                min_latitude=lat0,
+                max_longitude=lng1,
+                max_latitude=lat1,
+                depth=self.depth + 1,
+            )
+            for lng0, lng1 in (
+                (self.min_longitude, center.longitude),
+                (center.longitude, self.max_longitude),
+            )
+            for lat0, lat1 in (
+                (self.min_latitude, center.latitude),
+                (center.latitude, self.max_latitude),
+            )
+        ]
+
+    @staticmethod
+    def parse_bbox(bbox: str) -> "SweepCell":
+        min_lng, min_lat, max_lng, max_lat = (float(x) for x in bbox.split(","))
+        if min_lng >= max_lng or min_lat >= max_lat:
+            raise ValueError(f"Invalid bounding box: {bbox}")
+        return SweepCell(
+            min_longitude=min_lng,
+            min_latitude=min_lat,
+            max_longitude=max_lng,
+            max_latitude=max_lat,
+        )
+
+
+class SweepReport(BaseModel):
+    cells_queried: int = 0
+    cells_split: int = 0
+    cells_skipped: int = 0
+    places_found: int = 0
+
+
+class QuadtreeSweep:
+    def __init__(
+        self,
+        client: CachedPlacesClient,
+        place_type: str,
+        min_radius: int = 300,
+        concurrency: int = 4,
+        language: str = "ja",
+    ):
+        """
+        Sweep a bounding box with nearby search, cells are split only if the result cap is hit
+        :param client: cached places client
+        :param place_type: place type, see https://developers.google.com/places/supported_types
+        :param min_radius: cells smaller than this radius (m) will not be split
+        :param concurrency: cells queried concurrently
+        :param language: language of results
+        """
+        self.client = client
+        self.place_type = place_type
+        self.min_radius = min_radius
+        self.concurrency = concurrency
+        self.language = language
+        self.report = SweepReport()
+
+    def initial_cells(self, bbox: SweepCell) -> List[SweepCell]:
+        cells = [bbox]
+        while any(c.radius > PLACES_MAX_RADIUS for c in cells):
+            cells = [child for c in cells for child in c.split()]
+        return cells
+
+    def _query(self, cell: SweepCell) -> Tuple[SweepCell, List[dict]]:
+        pages = self.client.nearby(
+            cell.center, cell.radius, self.place_type, language=self.language
+        )
+        return cell, [place for page in pages for place in page.get("results", [])]
+
+    def sweep(self, bbox: SweepCell) -> Iterable[dict]:
+        """
+        Yield places as soon as the cells are queried, places may be duplicated in overlapping cells
+        """
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = {
+                executor.submit(self._query, cell) for cell in self.initial_cells(bbox)
+            }
+            while futures:
+                QUEUE_DEPTH.set(len(futures), queue="places_sweep")
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        cell, places = future.result()
+                    except QuotaExceeded:
+                        self.report.cells_skipped += 1
+                        continue
+                    self.report.cells_queried += 1
+                    self.report.places_found += len(places)
+                    if (
+                        len(places) >= PLACES_RESULT_CAP
+                        and cell.radius > self.min_radius
+                    ):
+                        log.debug(f"Result cap hit at depth {cell.depth}, splitting")
+                        self.report.cells_split += 1
+                        futures |= {
+                            executor.submit(self._query, child)
+                            for child in cell.split()
+                        }
+                    yield from places
+        QUEUE_DEPTH.set(0, queue="places_sweep")
+        if self.report.cells_skipped > 0:
+            log.warning(
+                f"{self.report.cells_skipped} cells skipped since quota exhausted"
+            )
+
+
+class OfflinePlacesClient:
+    """
+    Stub of googlemaps.Client.places_nearby for testing without network access
+    """
+
+    def __init__(
+        self,
+        places: List[dict],
+        token_delay: float = 0.0,
+        latency: float = 0.0,
+    ):
+        self.places = places
+        self.token_delay = token_delay
+        self.latency = latency
+        self.requests = 0
+        self._tokens: Dict[str, Tuple[List[dict], int, float]] = {}
+        self._token_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def places_nearby(
+        self,
+        location: Optional[Tuple[float, float]] = None,
+        radius: Optional[int] = None,
+        type: Optional[str] = None,
+        language: Optional[str] = None,
+        page_token: Optional[str] = None,
+    ) -> dict:
+        with self._lock:
+            self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if page_token:
+            with self._lock:
+                if page_token not in self._tokens:
+                    raise ApiError("INVALID_REQUEST", "Unknown page token")
+                matches, page, valid_after = self._tokens[page_token]
+            if time.time() < valid_after:
+                raise ApiError("INVALID_REQUEST", "Page token is not valid yet")
+        else:
+            center = GeoPoint(latitude=location[0], longitude=location[1])
+            matches = sorted(
+                (
+                    (center - GeoPoint.from_lat_lng(**p["geometry"]["location"]), p)
+                    for p in self.places
+                    if type is None or type in p["types"]
+                ),
+                key=lambda x: x[0],
+            )
+            matches = [p for d, p in matches if d * 1000 <= radius][:PLACES_RESULT_CAP]
+            page = 0
+
+        result = {
+            "status": "OK" if matches else "ZERO_RESULTS",
+            "results": matches[page * PLACES_PAGE_SIZE : (page + 1) * PLACES_PAGE_SIZE],
+        }
+        if (page + 1) * PLACES_PAGE_SIZE < len(matches):
+            with self._lock:
+                token = f"token-{next(self._token_ids)}"
+                self._tokens[token] = (
+                    matches,
+                    page + 1,
+                    time.time() + self.token_delay,
+                )
+            result["next_page_token"] = token
+        return result
+
+    @staticmethod
+    def random_places(
+        bbox: SweepCell, count: int, place_type: str, seed: int = 0
+    ) -> List[dict]:
+        rand = random.Random(seed)
+        return [
+            {
+                "place_id": f"stub-{place_type}-{i}",
+                "name": f"{place_type} {i}",
+                "types": [place_type],
+                "geometry": {
+                    "location": {
+                        "lat": rand.uniform(bbox.min_latitude, bbox.max_latitude),
+                        "lng": rand.uniform(bbox.min_longitude, bbox.max_longitude),
+                    }
+                },
+            }
+            for i in range(count)
+        ]
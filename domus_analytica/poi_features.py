@@ -0,0 +1,178 @@
+"""
+POI周辺の特徴量（複数半径・k近傍）
+
+Each category declares its radii and k-nearest values. The POI of a category are fetched
+with one query at the largest radius (or the largest k when there is no radius), and every
+count, k-th distance and weighted sum is derived from that sorted result.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.poi_snapshot import route_count, spherical_distance
+
+
+class PoiFeatureSpec(BaseModel):
+    category: str
+    # Prefix of the feature names
+    name: str
+    # Count (and weighted sum) within each radius in meters
+    radii: List[int] = []
+    # Distance (km) to the k-th nearest, searched within the largest radius if any
+    nearest_k: List[int] = []
+    # Field of data summed within each radius
+    weight_field: Optional[str] = None
+    weight_name: Optional[str] = None
+
+    @property
+    def max_distance(self) -> Optional[int]:
+        return max(self.radii) if self.radii else None
+
+    @property
+    def limit(self) -> int:
+        return 0 if self.radii else max(self.nearest_k, default=1)
+
+    def feature_names(self) -> List[str]:
+        names = [f"{self.name}_count_{r}m" for r in self.radii]
+        if self.weight_field:
+            names += [
+                f"{self.name}_{self.weight_name or self.weight_field}_sum_{r}m"
+                for r in self.radii
+            ]
+        names += [f"{self.name}_distance_{k}nn" for k in self.nearest_k]
+        return names
+
+
+# One spec per category, the radii include the ones of the features in FEATURES of model.py
+FEATURE_SPECS = [
+    PoiFeatureSpec(category="mafia", name="mafia", nearest_k=[1]),
+    PoiFeatureSpec(category="google_cemetery", name="cemetery", nearest_k=[1]),
+    PoiFeatureSpec(
+        category="station_passengers",
+        name="station",
+        radii=[500, 1000, 2000],
+        nearest_k=[1, 2, 3],
+        weight_field="passengers_count_2021",
+        weight_name="passengers",
+    ),
+    PoiFeatureSpec(
+        category="population",
+        name="population",
+        radii=[500, 1000],
+        weight_field="total_population",
+    ),
+    PoiFeatureSpec(
+        category="bus_stop",
+        name="bus_stop",
+        radii=[300, 500, 1000],
+        nearest_k=[1, 3],
+        weight_field="route_count",
+        weight_name="route",
+    ),
+]
+
+
+def data_value(doc: dict, field: str) -> float:
+    """
+    :return: the field of data, NaN if missing, route_count is counted from routes if needed
+    """
+    data = doc["data"]
+    if field in data:
+        value = data[field]
+    elif field == "route_count" and "routes" in data:
+        # Snapshots keep the count only, documents in MongoDB keep the routes
+        value = route_count(data["routes"])
+    else:
+        return float("nan")
+    return float(value) if value is not None else float("nan")
+
+
+class NearbyPoi:
+    def __init__(
+        self, location: GeoPoint, documents: List[dict], max_distance: Optional[float]
+    ):
+        """
+        POI of a category around a location sorted by distance
+        :param documents: result of find_near
+        :param max_distance: radius of the query in meters, None if unbounded
+        """
+        coordinates = np.array(
+            [d["loc"]["coordinates"] for d in documents], dtype="float64"
+        ).reshape(-1, 2)
+        distances = spherical_distance(
+            location.longitude, location.latitude, coordinates[:, 0], coordinates[:, 1]
+        )
+        order = np.argsort(distances, kind="stable")
+        self.location = location
+        self.documents = [documents[i] for i in order]
+        # In meters
+        self.distances = distances[order]
+        self.max_distance = max_distance
+        self._weights: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def within(self, radius: float) -> int:
+        """
+        :return: count of POI within the radius in meters
+        """
+        if self.max_distance is not None and radius >= self.max_distance:
+            # Already filtered by the query, don't recount the ones on the boundary
+            return len(self.documents)
+        return int(np.searchsorted(self.distances, radius, side="right"))
+
+    def kth_distance(self, k: int) -> Optional[float]:
+        """
+        :return: distance to the k-th nearest in km, None if there are less than k
+        """
+        if len(self.documents) < k:
+            return None
+        return float(self.distances[k - 1]) / 1000
+
+    def weights(self, field: str) -> np.ndarray:
+        if field not in self._weights:
+            self._weights[field] = np.array(
+                [data_value(d, field) for d in self.documents], dtype="float64"
+            )
+        return self._weights[field]
+
+    def weight_sum(self, field: str, radius: float) -> float:
+        """
+        :return: sum of the field within the radius, missing values are skipped
+        """
+        return float(np.nansum(self.weights(field)[: self.within(radius)]))
+
+
+def fetch_nearby(poi_store, location: GeoPoint, spec: PoiFeatureSpec) -> NearbyPoi:
+    """
+    The only query of the category for a location
+    :param poi_store: PoiStore, PoiIndex or PoiSnapshot
+    """
+    return NearbyPoi(
+        location,
+        list(
+            poi_store.find_near(
+                spec.category, location, spec.max_distance, limit=spec.limit
+            )
+        ),
+        spec.max_distance,
+    )
+
+
+def spec_features(nearby: NearbyPoi, spec: PoiFeatureSpec) -> dict:
+    result = {}
+    for r in spec.radii:
+        result[f"{spec.name}_count_{r}m"] = nearby.within(r)
+    if spec.weight_field:
+        weight_name = spec.weight_name or spec.weight_field
+        for r in spec.radii:
+            result[f"{spec.name}_{weight_name}_sum_{r}m"] = nearby.weight_sum(
+                spec.weight_field, r
+            )
+    for k in spec.nearest_k:
+        result[f"{spec.name}_distance_{k}nn"] = nearby.kth_distance(k)
+    return result
@@ -0,0 +1,102 @@
+"""
+メモリ上のPOI空間インデックス
+"""
+
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStore
+
+log = logging.getLogger(__name__)
+
+# Radius used by MongoDB for $near on 2dsphere indexes, in meters
+MONGO_EARTH_RADIUS = 6378100.0
+
+
+class PoiIndex:
+    def __init__(self, documents: Dict[str, List[dict]]):
+        """
+        Answer the same queries as PoiStore.find_near / find_nearest from memory,
+        so that a lookup costs microseconds instead of a MongoDB round trip
+        :param documents: category -> POI documents with loc (GeoJSON point) and data
+        """
+        self.documents = documents
+        self.trees: Dict[str, BallTree] = {}
+        for category, docs in documents.items():
+            if docs:
+                self.trees[category] = BallTree(
+                    np.radians(
+                        [
+                            [d["loc"]["coordinates"][1], d["loc"]["coordinates"][0]]
+                            for d in docs
+                        ]
+                    ),
+                    metric="haversine",
+                )
+
+    @staticmethod
+    def load(
+        poi_store: PoiStore,
+        categories: Iterable[str] = tuple(POI_CATEGORIES),
+        batch_size: int = 1000,
+    ) -> "PoiIndex":
+        """
+        Load POI of the categories from MongoDB
+        """
+        documents = {}
+        for category in categories:
+            documents[category] = list(
+                poi_store.collection(category).find(
+                    poi_store.category_filter(category),
+                    projection={"_id": False, "loc": True, "data": True},
+                    batch_size=batch_size,
+                )
+            )
+            log.info(f"{len(documents[category])} POI of {category} loaded")
+        return PoiIndex(documents)
+
+    def find_near(
+        self,
+        category: str,
+        point: GeoPoint,
+        max_distance: Optional[float] = None,
+        limit: int = 0,
+    ) -> List[dict]:
+        """
+        Find POI of the category sorted by the distance to the point
+        :param category: POI category
+        :param point: center point
+        :param max_distance: max distance in meters
+        :param limit: max count of documents, 0 for no limitation
+        :return: POI documents
+        """
+        tree = self.trees.get(category)
+        if tree is None:
+            return []
+        query = np.radians([[point.latitude, point.longitude]])
+        if max_distance:
+            indices, _ = tree.query_radius(
+                query,
+                max_distance / MONGO_EARTH_RADIUS,
+                return_distance=True,
+                sort_results=True,
+            )
+            indices = indices[0]
+            if limit:
+                indices = indices[:limit]
+        else:
+            k = min(limit or tree.data.shape[0], tree.data.shape[0])
+            indices = tree.query(query, k=k, return_distance=False)[0]
+        docs = self.documents[category]
+        return [docs[i] for i in indices]
+
+    def find_nearest(
+        self, category: str, point: GeoPoint, max_distance: Optional[float] = None
+    ) -> Optional[dict]:
+        for doc in self.find_near(category, point, max_distance, limit=1):
+            return doc
+        return None
@@ -0,0 +1,407 @@
+"""
+最寄りPOIまでの距離ラスタ（地域メッシュ単位）
+
+Layout of a raster directory::
+
+    manifest.json                      grid (mesh level, origin, cell size, shape) and categories
+    <category>/coords.npy              float64 (N, 2) of lon/lat of the POI
+    <category>/ids.npy                 str (N,) _id of the POI
+    <category>/nearest.npy             int32 (rows, columns) POI index nearest to every point of the cell,
+                                       -(k + 1) if the cell is ambiguous, see below
+    <category>/distance.npy            float32 (rows, columns) meters from the cell center to its nearest POI
+    <category>/candidate_starts.npy    int64 (ambiguous cells + 1) offsets of the k-th ambiguous cell in candidates
+    <category>/candidates.npy          int32 POI indices which can be the nearest to some point of an ambiguous cell
+
+The grid covers the same area as the snapshot grid, with cells of the 4th (500m) or 5th (250m)
+level of the JIS regional mesh. Each cell center is at most ``radius`` meters from any point of the cell,
+so when the second nearest POI of the center is more than ``2 * radius`` farther than the nearest one,
+the nearest one is the nearest to every point of the cell. Otherwise (near the boundaries of the
+Voronoi cells) every POI within ``nearest + 2 * radius`` of the center is kept as a candidate.
+A lookup is then an array index plus an exact distance to one POI, or to a few near the boundaries.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import jismesh.utils as ju
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.poi_features import FEATURE_SPECS
+from domus_analytica.poi_index import MONGO_EARTH_RADIUS
+from domus_analytica.poi_snapshot import (
+    GRID_CELL_DEGREES,
+    GRID_COLUMNS,
+    GRID_MIN_LAT,
+    GRID_MIN_LNG,
+    GRID_ROWS,
+    spherical_distance,
+)
+from domus_analytica.poi_store import PoiStore
+
+log = logging.getLogger(__name__)
+
+RASTER_FORMAT_VERSION = 1
+# Mesh size in meters -> level of jismesh
+MESH_LEVELS = {500: 4, 250: 5}
+# Categories only queried for the nearest one without a radius, e.g. min_distance_to_mafia
+RASTER_CATEGORIES = [
+    s.category for s in FEATURE_SPECS if not s.radii and s.nearest_k == [1]
+]
+# Candidates queried at once for the ambiguous cells, more are searched by radius
+AMBIGUOUS_NEIGHBOURS = 8
+# Margin of the cell radius in meters against rounding errors
+RADIUS_MARGIN = 1.0
+
+
+def unit_vectors(lng: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    """
+    Points on the unit sphere, the chord between them is monotonic with the spherical distance
+    """
+    lng, lat = np.radians(lng), np.radians(lat)
+    return np.stack(
+        [np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)], axis=-1
+    )
+
+
+def chord_to_meters(chord: np.ndarray) -> np.ndarray:
+    return 2 * MONGO_EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1.0))
+
+
+def meters_to_chord(meters: np.ndarray) -> np.ndarray:
+    return 2 * np.sin(np.minimum(meters / (2 * MONGO_EARTH_RADIUS), math.pi / 2))
+
+
+class RasterGrid:
+    def __init__(self, mesh: int = 500):
+        """
+        Cells of the JIS regional mesh of the level over the snapshot grid
+        :param mesh: cell size in meters, 500 or 250
+        """
+        if mesh not in MESH_LEVELS:
+            raise ValueError(
+                f"Mesh of {mesh}m is not supported, use one of {list(MESH_LEVELS)}"
+            )
+        self.mesh = mesh
+        self.level = MESH_LEVELS[mesh]
+        self.unit_lat = ju.unit_lat(self.level)
+        self.unit_lng = ju.unit_lon(self.level)
+        self.min_lat = GRID_MIN_LAT
+        self.min_lng = GRID_MIN_LNG
+        self.rows = int(round(GRID_ROWS * GRID_CELL_DEGREES / self.unit_lat))
+        self.columns = int(round(GRID_COLUMNS * GRID_CELL_DEGREES / self.unit_lng))
+        # The origin is on a corner of the 1st level mesh, so is every cell on a mesh
+        lat, lng = ju.to_meshpoint(
+            ju.to_meshcode(
+                self.min_lat + self.unit_lat / 2,
+                self.min_lng + self.unit_lng / 2,
+                self.level,
+            ),
+            0,
+            0,
+        )
+        assert math.isclose(lat, self.min_lat) and math.isclose(lng, self.min_lng)
+
+    def cell(self, lng: float, lat: float) -> Optional[Tuple[int, int]]:
+        """
+        :return: row and column of the cell, None if out of the grid
+        """
+        row = math.floor((lat - self.min_lat) / self.unit_lat)
+        column = math.floor((lng - self.min_lng) / self.unit_lng)
+        if 0 <= row < self.rows and 0 <= column < self.columns:
+            return row, column
+        return None
+
+    def center(self, row: int) -> Tuple[np.ndarray, float]:
+        """
+        :return: longitudes of the cell centers of the row, and their latitude
+        """
+        lngs = self.min_lng + (np.arange(self.columns) + 0.5) * self.unit_lng
+        return lngs, self.min_lat + (row + 0.5) * self.unit_lat
+
+    def radius(self, row: int) -> float:
+        """
+        Farthest distance from the center of a cell of the row to a point of the cell, in meters,
+        the corners closer to the equator are the farthest
+        """
+        lat = self.min_lat + (row + 0.5) * self.unit_lat
+        corners = spherical_distance(
+            0.0,
+            lat,
+            np.array([self.unit_lng / 2, self.unit_lng / 2]),
+            np.array([lat - self.unit_lat / 2, lat + self.unit_lat / 2]),
+        )
+        return float(corners.max()) + RADIUS_MARGIN
+
+    def manifest(self) -> dict:
+        return {
+            "mesh": self.mesh,
+            "level": self.level,
+            "min_lat": self.min_lat,
+            "min_lng": self.min_lng,
+            "unit_lat": self.unit_lat,
+            "unit_lng": self.unit_lng,
+            "rows": self.rows,
+            "columns": self.columns,
+        }
+
+
+def write_category(
+    path: Path, documents: Iterable[dict], grid: RasterGrid, block_rows: int = 128
+) -> dict:
+    """
+    Compute the nearest POI of every cell
+    :param path: directory of the category
+    :param documents: POI documents with _id and loc (GeoJSON point)
+    :param block_rows: rows of cells queried at once
+    :return: manifest of the category
+    """
+    coords: List[List[float]] = []
+    ids: List[str] = []
+    for doc in documents:
+        coords.append(doc["loc"]["coordinates"][:2])
+        ids.append(str(doc.get("_id", len(ids))))
+    coords_array = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "coords.npy", coords_array)
+    np.save(path / "ids.npy", np.array(ids, dtype=str))
+    count = len(coords_array)
+    if count == 0:
+        return {"count": 0, "ambiguous_cells": 0}
+
+    tree = KDTree(unit_vectors(coords_array[:, 0], coords_array[:, 1]))
+    nearest = np.lib.format.open_memmap(
+        path / "nearest.npy", mode="w+", dtype=np.int32, shape=(grid.rows, grid.columns)
+    )
+    distance = np.lib.format.open_memmap(
+        path / "distance.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(grid.rows, grid.columns),
+    )
+    candidates: List[np.ndarray] = []
+    sizes: List[np.ndarray] = []
+    ambiguous = 0
+    for first_row in range(0, grid.rows, block_rows):
+        rows = np.arange(first_row, min(first_row + block_rows, grid.rows))
+        lngs = grid.center(0)[0]
+        lats = grid.min_lat + (rows + 0.5) * grid.unit_lat
+        points = unit_vectors(np.tile(lngs, len(rows)), np.repeat(lats, grid.columns))
+        radii = np.repeat([grid.radius(r) for r in rows], grid.columns)
+        chords, indices = tree.query(points, k=min(2, count))
+        meters = chord_to_meters(chords)
+        block_nearest = indices[:, 0].astype(np.int32)
+        if count > 1:
+            unsure = np.flatnonzero(meters[:, 1] - meters[:, 0] <= 2 * radii)
+        else:
+            unsure = np.zeros(0, dtype=np.int64)
+        if len(unsure):
+            bounds = meters[unsure, 0] + 2 * radii[unsure]
+            k = min(AMBIGUOUS_NEIGHBOURS, count)
+            near_chords, near_indices = tree.query(points[unsure], k=k)
+            inside = chord_to_meters(near_chords) <= bounds[:, None]
+            block_sizes = inside.sum(axis=1)
+            block_candidates = near_indices[inside]
+            overflow = np.flatnonzero(inside[:, -1]) if k < count else []
+            if len(overflow):
+                # All k within the bound, there can be more
+                split = np.split(block_candidates, np.cumsum(block_sizes)[:-1])
+                for i in overflow:
+                    split[i] = tree.query_radius(
+                        points[unsure[i] : unsure[i] + 1], meters_to_chord(bounds[i])
+                    )[0]
+                block_sizes = np.array([len(c) for c in split])
+                block_candidates = np.concatenate(split)
+            block_nearest[unsure] = -(ambiguous + 1 + np.arange(len(unsure)))
+            candidates.append(block_candidates.astype(np.int32))
+            sizes.append(block_sizes.astype(np.int64))
+            ambiguous += len(unsure)
+        nearest[rows[0] : rows[-1] + 1] = block_nearest.reshape(len(rows), -1)
+        distance[rows[0] : rows[-1] + 1] = meters[:, 0].reshape(len(rows), -1)
+    nearest.flush()
+    distance.flush()
+    del nearest, distance
+    np.save(
+        path / "candidate_starts.npy",
+        np.concatenate([[0], np.cumsum(np.concatenate(sizes or [[]]))]).astype(
+            np.int64
+        ),
+    )
+    np.save(
+        path / "candidates.npy",
+        (
+            np.concatenate(candidates).astype(np.int32)
+            if candidates
+            else np.zeros(0, dtype=np.int32)
+        ),
+    )
+    return {"count": count, "ambiguous_cells": ambiguous}
+
+
+def export_rasters(
+    poi_store: PoiStore,
+    output: str,
+    categories: Iterable[str] = tuple(RASTER_CATEGORIES),
+    mesh: int = 500,
+    batch_size: int = 1000,
+) -> dict:
+    """
+    Build rasters of the categories, replacing the existing directory only when finished
+    :return: manifest
+    """
+    grid = RasterGrid(mesh)
+    output_path = Path(output)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    manifest = {
+        "format_version": RASTER_FORMAT_VERSION,
+        "create_time": datetime.now().isoformat(),
+        "grid": grid.manifest(),
+        "categories": {},
+    }
+    for category in categories:
+        manifest["categories"][category] = write_category(
+            tmp_path / category,
+            poi_store.collection(category).find(
+                poi_store.category_filter(category),
+                projection={"_id": True, "loc": True},
+                batch_size=batch_size,
+            ),
+            grid,
+        )
+        log.info(
+            f"Raster of {category} built: {manifest['categories'][category]['count']} POI, "
+            f"{manifest['categories'][category]['ambiguous_cells']} of {grid.rows * grid.columns} "
+            f"cells near boundaries"
+        )
+    with open(tmp_path / "manifest.json", "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    tmp_path.rename(output_path)
+    return manifest
+
+
+class RasterCategory:
+    def __init__(self, path: Path, manifest: dict, grid: RasterGrid):
+        def load(name: str) -> np.ndarray:
+            return np.load(path / name, mmap_mode="r")
+
+        self.grid = grid
+        self.coords = load("coords.npy")
+        self.ids = load("ids.npy")
+        self.empty = manifest["count"] == 0
+        if not self.empty:
+            self.nearest_cells = load("nearest.npy")
+            self.distance_cells = load("distance.npy")
+            self.candidate_starts = load("candidate_starts.npy")
+            self.candidates = load("candidates.npy")
+
+    def __len__(self) -> int:
+        return self.coords.shape[0]
+
+    def cell_candidates(self, row: int, column: int) -> np.ndarray:
+        value = int(self.nearest_cells[row, column])
+        if value >= 0:
+            return np.array([value])
+        k = -value - 1
+        return self.candidates[self.candidate_starts[k] : self.candidate_starts[k + 1]]
+
+    def nearest(self, point: GeoPoint) -> Optional[Tuple[int, float]]:
+        """
+        :return: index of the nearest POI and the exact distance in meters,
+            None if there is no POI or the point is out of the grid
+        """
+        cell = self.grid.cell(point.longitude, point.latitude)
+        if self.empty or cell is None:
+            return None
+        indices = self.cell_candidates(*cell)
+        distances = spherical_distance(
+            point.longitude,
+            point.latitude,
+            self.coords[indices, 0],
+            self.coords[indices, 1],
+        )
+        i = int(np.argmin(distances))
+        return int(indices[i]), float(distances[i])
+
+    def cell_distance(self, point: GeoPoint) -> Optional[float]:
+        """
+        :return: distance from the cell center to its nearest POI in meters, off by the cell radius at most
+        """
+        cell = self.grid.cell(point.longitude, point.latitude)
+        if self.empty or cell is None:
+            return None
+        return float(self.distance_cells[cell])
+
+    def document(self, i: int) -> dict:
+        return {
+            "_id": str(self.ids[i]),
+            "loc": {"type": "Point", "coordinates": self.coords[i].tolist()},
+            "data": {},
+        }
+
+
+class PoiRasters:
+    def __init__(self, path: str):
+        """
+        Open rasters written by export_rasters
+        :param path: raster directory
+        """
+        self.path = Path(path)
+        with open(self.path / "manifest.json", "r") as fp:
+            self.manifest = json.load(fp)
+        if self.manifest["format_version"] != RASTER_FORMAT_VERSION:
+            raise ValueError(
+                f"Raster format {self.manifest['format_version']} is not supported"
+            )
+        self.grid = RasterGrid(self.manifest["grid"]["mesh"])
+        self.categories = {
+            category: RasterCategory(self.path / category, manifest, self.grid)
+            for category, manifest in self.manifest["categories"].items()
+        }
+
+
+class RasterPoiStore:
+    """
+    Answers nearest queries of the categories in the rasters by a cell lookup,
+    wraps PoiStore, PoiIndex or PoiSnapshot for the other queries and the points out of the grid
+    """
+
+    def __init__(self, poi_store, rasters: PoiRasters):
+        self.poi_store = poi_store
+        self.rasters = rasters
+
+    def find_near(
+        self,
+        category: str,
+        point: GeoPoint,
+        max_distance: Optional[float] = None,
+        limit: int = 0,
+    ) -> List[dict]:
+        raster = self.rasters.categories.get(category)
+        if raster is None or limit != 1:
+            return list(self.poi_store.find_near(category, point, max_distance, limit))
+        if raster.empty:
+            return []
+        found = raster.nearest(point)
+        if found is None:
+            return list(self.poi_store.find_near(category, point, max_distance, limit))
+        index, distance = found
+        if max_distance is not None and distance > max_distance:
+            return []
+        return [raster.document(index)]
+
+    def find_nearest(
+        self, category: str, point: GeoPoint, max_distance: Optional[float] = None
+    ) -> Optional[dict]:
+        for doc in self.find_near(category, point, max_distance, limit=1):
+            return doc
+        return None
@@ -0,0 +1,339 @@
+"""
+POIのスナップショット（列指向・メモリマップ）
+
+Layout of a snapshot directory::
+
+    manifest.json                  categories with their columns and counts
+    <category>/coords.npy          float64 (N, 2) of lon/lat, sorted by grid cell
+    <category>/cell_keys.npy       int64 sorted keys of non-empty grid cells
+    <category>/cell_starts.npy     int64 (len(cell_keys) + 1) offsets of the cells in coords
+    <category>/int_<name>.npy      int64 attribute columns, MISSING_INT if absent
+    <category>/str_<name>.npy      int32 attribute columns, index of strings, -1 if absent
+    <category>/strings.bin         UTF-8 string table
+    <category>/string_offsets.npy  int64 (len(strings) + 1) offsets in strings.bin
+
+Every array is memory-mapped when opened, so opening is cheap and pages are shared
+by all processes reading the same snapshot.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.poi_index import MONGO_EARTH_RADIUS
+from domus_analytica.poi_store import POI_CATEGORIES, PoiStore
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+MISSING_INT = np.iinfo(np.int64).min
+# Grid covering Japan, points out of it are clipped to the border cells
+GRID_MIN_LNG = 122.0
+GRID_MIN_LAT = 20.0
+GRID_CELL_DEGREES = 0.01
+GRID_COLUMNS = 3200
+GRID_ROWS = 2600
+METERS_PER_DEGREE = math.pi * MONGO_EARTH_RADIUS / 180
+
+
+def grid_cells(lng: np.ndarray, lat: np.ndarray) -> np.ndarray:
+    column = np.clip(
+        ((lng - GRID_MIN_LNG) / GRID_CELL_DEGREES).astype(np.int64), 0, GRID_COLUMNS - 1
+    )
+    row = np.clip(
+        ((lat - GRID_MIN_LAT) / GRID_CELL_DEGREES).astype(np.int64), 0, GRID_ROWS - 1
+    )
+    return row * GRID_COLUMNS + column
+
+
+def spherical_distance(
+    lng: float, lat: float, lngs: np.ndarray, lats: np.ndarray
+) -> np.ndarray:
+    """
+    Haversine distance in meters, with the same radius as MongoDB $near
+    """
+    lng, lat, lngs, lats = map(np.radians, (lng, lat, lngs, lats))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    )
+    return 2 * MONGO_EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def route_count(routes) -> int:
+    return sum(len(rs) for rs in routes)
+
+
+def write_category(path: Path, documents: Iterable[dict]) -> dict:
+    """
+    Write POI documents of a category into columns
+    :param path: directory of the category
+    :param documents: POI documents with loc (GeoJSON point) and data
+    :return: manifest of the category
+    """
+    coords: List[List[float]] = []
+    rows: List[dict] = []
+    for doc in documents:
+        coords.append(doc["loc"]["coordinates"][:2])
+        row = {}
+        for key, value in doc.get("data", {}).items():
+            if key == "routes" and isinstance(value, list):
+                row["route_count"] = route_count(value)
+            elif isinstance(value, bool):
+                row[key] = int(value)
+            elif isinstance(value, (int, np.integer, str)):
+                row[key] = value
+        rows.append(row)
+
+    coords_array = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    cells = grid_cells(coords_array[:, 0], coords_array[:, 1])
+    order = np.argsort(cells, kind="stable")
+    cell_keys, cell_starts = np.unique(cells[order], return_index=True)
+
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "coords.npy", coords_array[order])
+    np.save(path / "cell_keys.npy", cell_keys)
+    np.save(path / "cell_starts.npy", np.append(cell_starts, len(order)))
+
+    # A key is an integer column only if every present value is an integer
+    kinds: Dict[str, str] = {}
+    for row in rows:
+        for key, value in row.items():
+            kind = "str" if isinstance(value, str) else "int"
+            if kinds.setdefault(key, kind) != kind:
+                kinds[key] = "mixed"
+    strings: Dict[str, int] = {}
+    for key, kind in sorted(kinds.items()):
+        if kind == "int":
+            column = np.array(
+                [rows[i].get(key, MISSING_INT) for i in order], dtype=np.int64
+            )
+        elif kind == "str":
+            column = np.array(
+                [
+                    (
+                        strings.setdefault(rows[i][key], len(strings))
+                        if key in rows[i]
+                        else -1
+                    )
+                    for i in order
+                ],
+                dtype=np.int32,
+            )
+        else:
+            log.warning(f"{key} of {path.name} skipped since its type is mixed")
+            continue
+        np.save(path / f"{kind}_{key}.npy", column)
+
+    encoded = [s.encode() for s in strings.keys()]
+    with open(path / "strings.bin", "wb") as fp:
+        fp.write(b"".join(encoded))
+    np.save(
+        path / "string_offsets.npy",
+        np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)]),
+    )
+    return {
+        "count": len(order),
+        "int_columns": sorted(k for k, v in kinds.items() if v == "int"),
+        "str_columns": sorted(k for k, v in kinds.items() if v == "str"),
+    }
+
+
+def export_snapshot(
+    poi_store: PoiStore,
+    output: str,
+    categories: Iterable[str] = tuple(POI_CATEGORIES),
+    batch_size: int = 1000,
+) -> dict:
+    """
+    Export POI to a snapshot directory, replacing the existing one only when finished
+    :return: manifest
+    """
+    output_path = Path(output)
+    tmp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "create_time": datetime.now().isoformat(),
+        "categories": {},
+    }
+    for category in categories:
+        manifest["categories"][category] = write_category(
+            tmp_path / category,
+            poi_store.collection(category).find(
+                poi_store.category_filter(category),
+                projection={"_id": False, "loc": True, "data": True},
+                batch_size=batch_size,
+            ),
+        )
+        log.info(
+            f"{manifest['categories'][category]['count']} POI of {category} exported"
+        )
+    with open(tmp_path / "manifest.json", "w") as fp:
+        json.dump(manifest, fp, indent=2)
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    tmp_path.rename(output_path)
+    return manifest
+
+
+class SnapshotCategory:
+    def __init__(self, path: Path, manifest: dict):
+        def load(name: str) -> np.ndarray:
+            return np.load(path / name, mmap_mode="r")
+
+        self.coords = load("coords.npy")
+        self.cell_keys = load("cell_keys.npy")
+        self.cell_starts = load("cell_starts.npy")
+        self.int_columns = {c: load(f"int_{c}.npy") for c in manifest["int_columns"]}
+        self.str_columns = {c: load(f"str_{c}.npy") for c in manifest["str_columns"]}
+        self.string_offsets = load("string_offsets.npy")
+        self.strings = (
+            np.memmap(path / "strings.bin", dtype=np.uint8, mode="r")
+            if self.string_offsets[-1] > 0
+            else np.zeros(0, dtype=np.uint8)
+        )
+
+    def __len__(self) -> int:
+        return self.coords.shape[0]
+
+    def string(self, index: int) -> str:
+        return bytes(
+            self.strings[self.string_offsets[index] : self.string_offsets[index + 1]]
+        ).decode()
+
+    def document(self, i: int) -> dict:
+        """
+        Rebuild a POI document in the shape of PoiStore, with the exported columns only
+        """
+        data = {}
+        for name, column in self.int_columns.items():
+            if column[i] != MISSING_INT:
+                data[name] = int(column[i])
+        for name, column in self.str_columns.items():
+            if column[i] >= 0:
+                data[name] = self.string(int(column[i]))
+        return {
+            "loc": {"type": "Point", "coordinates": self.coords[i].tolist()},
+            "data": data,
+        }
+
+    def candidates(self, point: GeoPoint, max_distance: float) -> np.ndarray:
+        """
+        Indices of points in the grid cells overlapping the circle
+        """
+        lat_span = max_distance / METERS_PER_DEGREE
+        # Widest at the latitude farthest from the equator
+        lng_span = lat_span / max(
+            math.cos(math.radians(min(abs(point.latitude) + lat_span, 90.0))), 0.01
+        )
+        first_row, last_row = (
+            grid_cells(
+                np.full(2, point.longitude),
+                np.array([point.latitude - lat_span, point.latitude + lat_span]),
+            )
+            // GRID_COLUMNS
+        )
+        first_column, last_column = (
+            grid_cells(
+                np.array([point.longitude - lng_span, point.longitude + lng_span]),
+                np.full(2, point.latitude),
+            )
+            % GRID_COLUMNS
+        )
+        # Cells of a row are contiguous in the sorted keys
+        row_keys = np.arange(first_row, last_row + 1) * GRID_COLUMNS
+        begins = np.searchsorted(self.cell_keys, row_keys + first_column, side="left")
+        ends = np.searchsorted(self.cell_keys, row_keys + last_column, side="right")
+        ranges = [
+            np.arange(self.cell_starts[b], self.cell_starts[e])
+            for b, e in zip(begins, ends)
+            if b < e
+        ]
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    def near(
+        self, point: GeoPoint, max_distance: Optional[float], limit: int
+    ) -> np.ndarray:
+        """
+        :return: indices sorted by distance
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        radius = max_distance or 1000.0
+        while True:
+            indices = self.candidates(point, radius)
+            distances = spherical_distance(
+                point.longitude,
+                point.latitude,
+                self.coords[indices, 0],
+                self.coords[indices, 1],
+            )
+            inside = distances <= radius
+            indices, distances = indices[inside], distances[inside]
+            # Without max_distance, grow the circle until it holds enough POI
+            if (
+                max_distance
+                or len(indices) >= (limit or len(self))
+                or radius > math.pi * MONGO_EARTH_RADIUS
+            ):
+                break
+            radius *= 4
+        order = np.argsort(distances, kind="stable")
+        if limit:
+            order = order[:limit]
+        return indices[order]
+
+
+class PoiSnapshot:
+    def __init__(self, path: str):
+        """
+        Open a snapshot written by export_snapshot, answering the same queries as PoiStore.find_near / find_nearest
+        :param path: snapshot directory
+        """
+        self.path = Path(path)
+        with open(self.path / "manifest.json", "r") as fp:
+            self.manifest = json.load(fp)
+        if self.manifest["format_version"] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Snapshot format {self.manifest['format_version']} is not supported"
+            )
+        self.categories = {
+            category: SnapshotCategory(self.path / category, manifest)
+            for category, manifest in self.manifest["categories"].items()
+        }
+
+    def find_near(
+        self,
+        category: str,
+        point: GeoPoint,
+        max_distance: Optional[float] = None,
+        limit: int = 0,
+    ) -> List[dict]:
+        """
+        Find POI of the category sorted by the distance to the point
+        :param category: POI category
+        :param point: center point
+        :param max_distance: max distance in meters
+        :param limit: max count of documents, 0 for no limitation
+        :return: POI documents
+        """
+        snapshot = self.categories.get(category)
+        if snapshot is None:
+            raise KeyError(f"{category} is not in the snapshot {self.path}")
+        return [snapshot.document(i) for i in snapshot.near(point, max_distance, limit)]
+
+    def find_nearest(
+        self, category: str, point: GeoPoint, max_distance: Optional[float] = None
+    ) -> Optional[dict]:
+        for doc in self.find_near(category, point, max_distance, limit=1):
+            return doc
+        return None
@@ -0,0 +1,304 @@
+"""
+GIS POIの保存レイアウト
+
+POI are stored in one of the following layouts:
+
+- ``shared``: every category lives in one collection with a compound ``(category, loc)`` index (legacy layout)
+- ``partial``: every category lives in one collection, each category has its own partial ``loc`` index
+- ``split``: every category lives in its own collection ``<base>_<category>`` with a plain ``loc`` index
+"""
+
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import pymongo
+from pydantic import BaseModel
+from pymongo import DeleteMany, InsertOne, ReplaceOne
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.metrics import record_write
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POI_COLLECTION = "japan_gis_poi"
+POI_CATEGORIES = [
+    "mafia",
+    "google_cemetery",
+    "station_passengers",
+    "population",
+    "bus_stop",
+]
+
+
+def content_hash(doc: dict) -> str:
+    return hashlib.sha1(
+        json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str).encode()
+    ).hexdigest()
+
+
+class UpsertReport(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    duplicated: int = 0
+
+
+class PoiStorageLayout(str, Enum):
+    SHARED = "shared"
+    PARTIAL = "partial"
+    SPLIT = "split"
+
+
+class PoiStore:
+    def __init__(
+        self,
+        db: Database,
+        layout: PoiStorageLayout = PoiStorageLayout.SHARED,
+        base_collection: str = DEFAULT_POI_COLLECTION,
+    ):
+        self.db = db
+        self.layout = PoiStorageLayout(layout)
+        self.base_collection = base_collection
+        # Last write of each category, a part of the version of cached feature matrices
+        self.state_coll = db.get_collection(f"{base_collection}_state")
+
+    def collection(self, category: str) -> Collection:
+        if self.layout == PoiStorageLayout.SPLIT:
+            return self.db.get_collection(f"{self.base_collection}_{category}")
+        return self.db.get_collection(self.base_collection)
+
+    def index_name(self, category: str) -> Optional[str]:
+        """
+        Name of the index serving $near queries of the category
+        :param category: POI category
+        :return: None if the index is picked by the planner
+        """
+        if self.layout == PoiStorageLayout.PARTIAL:
+            return f"loc_2dsphere_{category}"
+        return None
+
+    def ensure_index(self, category: str):
+        coll = self.collection(category)
+        if self.layout == PoiStorageLayout.SHARED:
+            coll.create_index(
+                [
+                    ("category", pymongo.ASCENDING),
+                    ("loc", pymongo.GEOSPHERE),
+                ]
+            )
+        elif self.layout == PoiStorageLayout.PARTIAL:
+            coll.create_index(
+                [("loc", pymongo.GEOSPHERE)],
+                name=self.index_name(category),
+                partialFilterExpression={"category": category},
+            )
+        else:
+            coll.create_index([("loc", pymongo.GEOSPHERE)])
+
+    def ensure_key_index(self, category: str):
+        coll = self.collection(category)
+        if self.layout == PoiStorageLayout.SPLIT:
+            coll.create_index(
+                [("poi_key", pymongo.ASCENDING)],
+                unique=True,
+                partialFilterExpression={"poi_key": {"$exists": True}},
+            )
+        else:
+            coll.create_index(
+                [("category", pymongo.ASCENDING), ("poi_key", pymongo.ASCENDING)],
+                unique=True,
+                partialFilterExpression={"poi_key": {"$exists": True}},
+            )
+
+    def category_filter(self, category: str) -> dict:
+        if self.layout == PoiStorageLayout.SPLIT:
+            return {}
+        return {"category": category}
+
+    def near_filter(
+        self, category: str, point: GeoPoint, max_distance: Optional[float] = None
+    ) -> dict:
+        _near = {
+            "$geometry": {
+                "type": "Point",
+                "coordinates": [
+                    point.longitude,
+                    point.latitude,
+                ],
+            },
+        }
+        if max_distance:
+            _near["$maxDistance"] = max_distance
+        return dict(self.category_filter(category), loc={"$near": _near})
+
+    def find_near(
+        self,
+        category: str,
+        point: GeoPoint,
+        max_distance: Optional[float] = None,
+        limit: int = 0,
+    ) -> Cursor:
+        """
+        Find POI of the category sorted by the distance to the point
+        :param category: POI category
+        :param point: center point
+        :param max_distance: max distance in meters
+        :param limit: max count of documents, 0 for no limitation
+        :return: cursor of POI documents
+        """
+        cursor = self.collection(category).find(
+            self.near_filter(category, point, max_distance), limit=limit
+        )
+        index_name = self.index_name(category)
+        if index_name:
+            cursor = cursor.hint(index_name)
+        return cursor
+
+    def find_nearest(
+        self, category: str, point: GeoPoint, max_distance: Optional[float] = None
+    ) -> Optional[dict]:
+        for doc in self.find_near(category, point, max_distance, limit=1):
+            return doc
+        return None
+
+    def replace_category(self, category: str, documents: Iterable[dict]) -> int:
+        """
+        Remove all POI of the category and insert new documents
+        :param category: POI category
+        :param documents: documents to insert, category field will be filled
+        :return: inserted count
+        """
+        coll = self.collection(category)
+        rows_deleted = coll.delete_many(self.category_filter(category)).deleted_count
+        log.info(f"{rows_deleted} documents of {category} were deleted")
+        return self.insert_many(category, documents)
+
+    def insert_many(self, category: str, documents: Iterable[dict]) -> int:
+        coll = self.collection(category)
+        inserted = 0
+        batch: List[dict] = []
+
+        def flush() -> int:
+            start = time.perf_counter()
+            count = len(coll.insert_many(batch, ordered=False).inserted_ids)
+            record_write(coll.name, count, time.perf_counter() - start)
+            return count
+
+        for doc in documents:
+            doc["category"] = category
+            batch.append(doc)
+            if len(batch) >= 10000:
+                inserted += flush()
+                batch = []
+        if batch:
+            inserted += flush()
+        self.touch(category)
+        return inserted
+
+    def touch(self, category: str):
+        self.state_coll.replace_one(
+            {"_id": category}, {"update_time": datetime.now()}, upsert=True
+        )
+
+    def update_times(self) -> Dict[str, datetime]:
+        """
+        :return: category -> time of the last import
+        """
+        return {s["_id"]: s["update_time"] for s in self.state_coll.find()}
+
+    def upsert_category(
+        self,
+        category: str,
+        documents: Iterable[dict],
+        key_func: Callable[[dict], str],
+        remove_missing: bool = True,
+        batch_size: int = 5000,
+    ) -> UpsertReport:
+        """
+        Write only new or changed POI, documents are matched by natural key and compared by content hash
+        :param category: POI category
+        :param documents: all documents of the category in the new dataset
+        :param key_func: function to build the natural key of a document
+        :param remove_missing: remove documents which are not in the new dataset
+        :param batch_size: operations per bulk write
+        :return: report of the counts
+        """
+        coll = self.collection(category)
+        self.ensure_key_index(category)
+        existing: Dict[str, str] = {
+            doc["poi_key"]: doc.get("content_hash")
+            for doc in coll.find(
+                dict(self.category_filter(category), poi_key={"$exists": True}),
+                projection={"_id": False, "poi_key": True, "content_hash": True},
+            )
+        }
+        log.info(f"{len(existing)} keyed documents of {category} found")
+
+        report = UpsertReport()
+        seen: Set[str] = set()
+        operations = []
+
+        def flush():
+            if operations:
+                start = time.perf_counter()
+                coll.bulk_write(operations, ordered=False)
+                record_write(coll.name, len(operations), time.perf_counter() - start)
+                operations.clear()
+
+        for doc in documents:
+            doc["category"] = category
+            key = key_func(doc)
+            if key in seen:
+                report.duplicated += 1
+                continue
+            seen.add(key)
+            doc_hash = content_hash(doc)
+            doc["poi_key"] = key
+            doc["content_hash"] = doc_hash
+            if key not in existing:
+                operations.append(InsertOne(doc))
+                report.inserted += 1
+            elif existing[key] != doc_hash:
+                operations.append(
+                    ReplaceOne(dict(self.category_filter(category), poi_key=key), doc)
+                )
+                report.updated += 1
+            else:
+                report.unchanged += 1
+            if len(operations) >= batch_size:
+                flush()
+
+        if remove_missing:
+            missing = [k for k in existing.keys() if k not in seen]
+            for i in range(0, len(missing), batch_size):
+                operations.append(
+                    DeleteMany(
+                        dict(
+                            self.category_filter(category),
+                            poi_key={"$in": missing[i : i + batch_size]},
+                        )
+                    )
+                )
+                flush()
+            report.removed = len(missing)
+            # Documents imported before upsert mode can't be matched, replace them
+            report.removed += coll.delete_many(
+                dict(self.category_filter(category), poi_key={"$exists": False})
+            ).deleted_count
+        flush()
+        self.touch(category)
+        log.info(
+            f"Upserted {category}: {report.inserted} inserted, {report.updated} updated, "
+            f"{report.unchanged} unchanged, {report.removed} removed, "
+            f"{report.duplicated} duplicated keys skipped"
+        )
+        return report
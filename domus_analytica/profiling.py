@@ -0,0 +1,259 @@
+"""
+処理段階ごとの計測とMongoDBクエリの計測
+
+Disabled by default, `domus-analytica --profile <command>` enables it for the run.
+When disabled, `stage()` returns a shared no-op context manager and no command listener
+is attached to MongoDB clients.
+"""
+
+import bisect
+import heapq
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, ContextManager, Dict, List, Tuple
+
+from pymongo import monitoring
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of latency buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+_NULL_CONTEXT = nullcontext()
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms: float):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        """
+        :return: upper bound of the bucket holding the quantile, max_ms for the last bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return round(min(bound, self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": {
+                (
+                    f"<={b}"
+                    if i < len(LATENCY_BUCKETS_MS)
+                    else f">{LATENCY_BUCKETS_MS[-1]}"
+                ): c
+                for i, (b, c) in enumerate(
+                    zip(LATENCY_BUCKETS_MS + [None], self.buckets)
+                )
+                if c
+            },
+        }
+
+
+def command_label(command_name: str, command: Any) -> str:
+    """
+    :return: "<command> <collection>", with ":<category>" when the filter has one
+    """
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        # getMore has the cursor id as its value
+        collection = command.get("collection", "")
+    label = f"{command_name} {collection}".strip()
+    query = command.get("filter") or command.get("query") or {}
+    if not query and command_name == "aggregate" and command.get("pipeline"):
+        query = next(iter(command["pipeline"][0].values()), {})
+        query = query.get("query", query) if isinstance(query, dict) else {}
+    category = query.get("category") if isinstance(query, dict) else None
+    if isinstance(category, str):
+        label += f":{category}"
+    return label
+
+
+class QueryListener(monitoring.CommandListener):
+    """
+    Records the latency of commands per label to the profiler
+    """
+
+    def __init__(self, profiler: "Profiler"):
+        self.profiler = profiler
+        self._pending: Dict[Tuple[Any, int], str] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = command_label(
+                event.command_name, event.command
+            )
+
+    def _finished(self, event, failed: bool):
+        with self._lock:
+            label = self._pending.pop((event.connection_id, event.request_id), None)
+        if label is not None:
+            self.profiler.record_query(label, event.duration_micros / 1000, failed)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finished(event, False)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finished(event, True)
+
+
+class ProfiledPoiStore:
+    """
+    Times find_near / find_nearest per category, wraps PoiStore, PoiIndex or PoiSnapshot
+    """
+
+    def __init__(self, poi_store, profiler: "Profiler"):
+        self.poi_store = poi_store
+        self.profiler = profiler
+
+    def find_near(self, category: str, *args, **kwargs):
+        with self.profiler.stage(f"poi:{category}"):
+            # Materialize cursors so that iterating them is timed as well
+            return list(self.poi_store.find_near(category, *args, **kwargs))
+
+    def find_nearest(self, category: str, *args, **kwargs):
+        with self.profiler.stage(f"poi:{category}"):
+            return self.poi_store.find_nearest(category, *args, **kwargs)
+
+
+class Profiler:
+    def __init__(self, enabled: bool = False, slowest: int = 10):
+        """
+        :param enabled: no-op when disabled
+        :param slowest: count of the slowest documents kept for the report
+        """
+        self.enabled = enabled
+        self.slowest = slowest
+        self.stages: Dict[str, LatencyHistogram] = {}
+        self.queries: Dict[str, LatencyHistogram] = {}
+        self.failed_queries: Dict[str, int] = {}
+        self.documents = 0
+        self.document_seconds = 0.0
+        self._slowest_documents: List[Tuple[float, str]] = []
+        self._lock = threading.Lock()
+        self.listener = QueryListener(self) if enabled else None
+
+    def stage(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, (time.perf_counter() - start) * 1000)
+
+    def record_stage(self, name: str, ms: float):
+        with self._lock:
+            self.stages.setdefault(name, LatencyHistogram()).add(ms)
+
+    def record_query(self, label: str, ms: float, failed: bool = False):
+        with self._lock:
+            self.queries.setdefault(label, LatencyHistogram()).add(ms)
+            if failed:
+                self.failed_queries[label] = self.failed_queries.get(label, 0) + 1
+
+    def record_document(self, doc_id: Any, seconds: float):
+        """
+        :param doc_id: id of the document, kept for the slowest ones
+        :param seconds: time spent on the document
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.documents += 1
+            self.document_seconds += seconds
+            item = (seconds, str(doc_id))
+            if len(self._slowest_documents) < self.slowest:
+                heapq.heappush(self._slowest_documents, item)
+            else:
+                heapq.heappushpop(self._slowest_documents, item)
+
+    def wrap_poi_store(self, poi_store):
+        return ProfiledPoiStore(poi_store, self) if self.enabled else poi_store
+
+    def report(self) -> dict:
+        """
+        listings/second is over the "extract" stage if recorded, otherwise over the time spent on documents
+        """
+        with self._lock:
+            seconds = (
+                self.stages["extract"].total_ms / 1000
+                if "extract" in self.stages
+                else self.document_seconds
+            )
+            return {
+                "documents": self.documents,
+                "listings_per_second": (
+                    round(self.documents / seconds, 2) if seconds else None
+                ),
+                "stages": {k: v.summary() for k, v in sorted(self.stages.items())},
+                "queries": {
+                    k: dict(v.summary(), failed=self.failed_queries.get(k, 0))
+                    for k, v in sorted(self.queries.items())
+                },
+                "slowest_documents": [
+                    {"id": doc_id, "ms": round(s * 1000, 3)}
+                    for s, doc_id in sorted(self._slowest_documents, reverse=True)
+                ],
+            }
+
+    def log_report(self):
+        report = self.report()
+        log.info(
+            f"Profile: {report['documents']} documents, "
+            f"{report['listings_per_second']} listings/second"
+        )
+        for title, key in [("Stage", "stages"), ("Query", "queries")]:
+            for name, s in sorted(
+                report[key].items(), key=lambda x: x[1]["total_ms"], reverse=True
+            ):
+                log.info(
+                    f"{title} {name:<40} count={s['count']} total={s['total_ms']:.0f}ms "
+                    f"mean={s['mean_ms']:.2f}ms p50<={s['p50_ms']}ms p95<={s['p95_ms']}ms "
+                    f"max={s['max_ms']:.1f}ms"
+                    + (f" failed={s['failed']}" if s.get("failed") else "")
+                )
+        for doc in report["slowest_documents"]:
+            log.info(f"Slow document {doc['id']} {doc['ms']:.1f}ms")
+
+
+_profiler = Profiler(enabled=False)
+
+
+def get_profiler() -> Profiler:
+    return _profiler
+
+
+def enable_profiling(slowest: int = 10) -> Profiler:
+    """
+    Enable profiling for the process, call it before the first MongoDB client is created
+    so that the client gets the command listener
+    """
+    global _profiler
+    _profiler = Profiler(enabled=True, slowest=slowest)
+    return _profiler
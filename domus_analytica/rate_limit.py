@@ -0,0 +1,23 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter allowing at most `rate` calls per second, calls are spaced evenly
+    """
+
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError(f"Rate should be positive but got {rate}")
+        self.interval = 1.0 / rate
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
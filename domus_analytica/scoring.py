@@ -0,0 +1,227 @@
+"""
+学習済みモデルで物件を評価し、結果をMongoDBに書き戻す
+"""
+
+import hashlib
+import logging
+import math
+from datetime import datetime
+from typing import Iterable, List
+
+import pandas as pd
+import pymongo
+from bson import ObjectId, json_util
+from pydantic import BaseModel
+from pymongo import UpdateOne
+
+from domus_analytica.config import DEFAULT_SUUMO_COLLECTION, DomusSettings
+from domus_analytica.data_clean import extract_listings, open_poi_store
+from domus_analytica.model import ModelArtifact, data_preprocessing, finite_or_none
+from domus_analytica.mongo import get_database
+from domus_analytica.trading_rollup import ComparableSalesSummary, TradingRollupStore
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SCORE_STATE_COLLECTION = "suumo_details_score_state"
+# Written back by scoring, updates of only these fields are not changes of listings
+SCORE_FIELDS = ("price_estimate", "cp_value", "price_model_version", "score_time")
+
+
+class ScoreReport(BaseModel):
+    selected: int = 0
+    scored: int = 0
+    unpriced: int = 0
+    failed: int = 0
+
+
+def _batches(docs: List[dict], batch_size: int) -> Iterable[List[dict]]:
+    for i in range(0, len(docs), batch_size):
+        yield docs[i : i + batch_size]
+
+
+def changed_after(last_changed: datetime, last_id: ObjectId) -> dict:
+    """
+    Filter of the listing history store after a watermark, listings changed in the same crawl
+    share last_changed, so _id breaks the tie
+    """
+    return {
+        "$or": [
+            {"last_changed": {"$gt": last_changed}},
+            {"last_changed": last_changed, "_id": {"$gt": last_id}},
+        ]
+    }
+
+
+def score_updates(
+    artifact: ModelArtifact,
+    df: pd.DataFrame,
+    score_time: datetime,
+    report: ScoreReport,
+) -> List[UpdateOne]:
+    """
+    Predict the preprocessed rows and build the updates of the score fields
+    :param df: result of data_preprocessing
+    :param report: failed and unpriced are counted into it
+    :return: one update per scored listing
+    """
+    unit_prices = artifact.predict_unit_price(df)
+    estimates = unit_prices * df["exclusive_area"].to_numpy(dtype="float64")
+    prices = df.reindex(columns=["price"])["price"].to_numpy(dtype="float64")
+    updates = []
+    for doc_id, estimate, price in zip(df["doc_id"], estimates, prices):
+        estimate = finite_or_none(estimate)
+        if estimate is None:
+            report.failed += 1
+            continue
+        cp_value = (
+            finite_or_none(estimate * 100 / price)
+            if math.isfinite(price) and price > 0
+            else None
+        )
+        if cp_value is None:
+            report.unpriced += 1
+        updates.append(
+            UpdateOne(
+                {"_id": doc_id},
+                {
+                    "$set": {
+                        "price_estimate": estimate,
+                        "cp_value": cp_value,
+                        "price_model_version": artifact.version,
+                        "score_time": score_time,
+                    }
+                },
+            )
+        )
+    return updates
+
+
+def score_listings(
+    config: DomusSettings,
+    artifact: ModelArtifact,
+    suumo_filter: dict,
+    batch_size: int = 5000,
+    incremental: bool = False,
+) -> ScoreReport:
+    """
+    Write price_estimate (万円) and cp_value (price_estimate * 100 / price) to suumo_details
+    :param config: DomusSettings instance
+    :param artifact: the model to score with
+    :param suumo_filter: filter of suumo_details to score
+    :param batch_size: listings extracted, predicted and written in one batch,
+        the ones failed to parse are counted as failed, skipped and retried by the next incremental run
+    :param incremental: only score listings inserted after the last run with the same filter and model,
+        the spider inserts a new document for every crawl, so changed listings are included as well,
+        the history store (suumo_listings) updates them in place, so it selects them by last_changed
+    :return: counts of listings
+    """
+    domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+    suumo_details = domus_db.get_collection(config.suumo_collection)
+    state_coll = domus_db.get_collection(DEFAULT_SCORE_STATE_COLLECTION)
+    # The history store updates current documents in place, a new _id is only a new listing
+    history = config.reads_listing_history
+    # Other collections are told apart, the default one keeps the key of existing states
+    state_key = (
+        suumo_filter
+        if config.suumo_collection == DEFAULT_SUUMO_COLLECTION
+        else {"collection": config.suumo_collection, "filter": suumo_filter}
+    )
+    state_id = hashlib.sha1(
+        json_util.dumps(state_key, sort_keys=True).encode()
+    ).hexdigest()
+
+    query = suumo_filter
+    state = state_coll.find_one({"_id": state_id}) if incremental else None
+    if state and (
+        state["model_version"] != artifact.version
+        # Saved before the history store was selected by last_changed
+        or (history and state.get("last_changed") is None)
+    ):
+        state = None
+    retry_ids = state.get("failed_ids", []) if state else []
+    if state:
+        if history:
+            log.info(f"Scoring listings changed after {state['last_changed']}")
+            watermark = changed_after(state["last_changed"], state["last_id"])
+        else:
+            log.info(f"Scoring listings inserted after {state['last_id']}")
+            watermark = {"_id": {"$gt": state["last_id"]}}
+        if retry_ids:
+            log.info(f"Retrying {len(retry_ids)} listings failed in the last run")
+            watermark = {"$or": [watermark, {"_id": {"$in": retry_ids}}]}
+        query = {"$and": [suumo_filter, watermark]}
+    elif incremental:
+        log.info(f"No previous run with model {artifact.version}, scoring all listings")
+
+    sort = [("_id", pymongo.ASCENDING)]
+    if history:
+        sort.insert(0, ("last_changed", pymongo.ASCENDING))
+    docs = list(
+        suumo_details.find(
+            query,
+            projection={"_id": True, "last_changed": True},
+            batch_size=config.mongo_batch_size,
+        ).sort(sort)
+    )
+    report = ScoreReport(selected=len(docs))
+    log.info(f"{len(docs)} listings to score with model {artifact.version}")
+    # The watermark passes the failed listings, they are kept in the state to be retried
+    retry_ids = set(retry_ids)
+    unprocessed = {d["_id"] for d in docs if d["_id"] in retry_ids}
+    failed_ids: List[ObjectId] = []
+
+    def position(doc: dict) -> tuple:
+        return (doc.get("last_changed"), doc["_id"]) if history else (doc["_id"],)
+
+    # The retried listings come before the watermark, it never moves back
+    mark = (
+        {"_id": state["last_id"], "last_changed": state.get("last_changed")}
+        if state
+        else None
+    )
+
+    # Loaded once for all batches
+    poi_store = open_poi_store(config, domus_db)
+    comps = ComparableSalesSummary.load(TradingRollupStore(domus_db))
+    for batch in _batches(docs, batch_size):
+        failed: List[ObjectId] = []
+        df = extract_listings(
+            config,
+            {"_id": {"$in": [d["_id"] for d in batch]}},
+            poi_store,
+            comps,
+            failed=failed,
+        )
+        # Unparseable listings are skipped, so one of them doesn't stop every later run
+        report.failed += len(failed)
+        failed_ids.extend(failed)
+        unprocessed.difference_update(d["_id"] for d in batch)
+        score_time = datetime.now()
+        updates = (
+            score_updates(artifact, data_preprocessing(df), score_time, report)
+            if len(df)
+            else []
+        )
+        if updates:
+            suumo_details.bulk_write(updates, ordered=False)
+        report.scored += len(updates)
+        if mark is None or position(batch[-1]) > position(mark):
+            mark = {
+                "_id": batch[-1]["_id"],
+                "last_changed": batch[-1].get("last_changed"),
+            }
+        # Saved after every batch, so an interrupted run resumes from here
+        state_coll.replace_one(
+            {"_id": state_id},
+            {
+                "filter": json_util.dumps(suumo_filter),
+                "model_version": artifact.version,
+                "last_id": mark["_id"],
+                "last_changed": mark["last_changed"],
+                "failed_ids": failed_ids + list(unprocessed),
+                "update_time": score_time,
+            },
+            upsert=True,
+        )
+        log.info(f"[{report.scored}/{report.selected}] listings scored")
+    return report
@@ -6,12 +6,18 @@ from abc import ABC
 from typing import Optional, Dict, Any, Iterable
 from urllib.parse import urljoin
 
-import pymongo
 import requests
 from bs4 import BeautifulSoup
 from gridfs import GridFS
 
 from domus_analytica.constants import USER_AGENT, XML_PARSER
+from domus_analytica.metrics import (
+    CACHE_LOOKUPS,
+    HTTP_REQUEST_SECONDS,
+    HTTP_REQUESTS,
+    PARSE_SECONDS,
+)
+from domus_analytica.mongo import get_database
 
 log = logging.getLogger(__name__)
 
@@ -26,7 +32,7 @@ class BasePageCache(ABC):
 
 class MongoDBPageCache(BasePageCache):
     def __init__(self, mongo_uri: str, db_name: str):
-        self.fs = GridFS(pymongo.MongoClient(mongo_uri).get_database(db_name))
+        self.fs = GridFS(get_database(mongo_uri, db_name))
 
     def get_cache(self, filename: str) -> Optional[bytes]:
         f = self.fs.find_one(dict(filename=filename))
@@ -37,24 +43,79 @@ class MongoDBPageCache(BasePageCache):
         self.fs.put(data, filename=filename)
 
 
+# Responses worth retrying, the others are raised to the caller
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+DEFAULT_BASE_URL = "https://suumo.jp"
+
+
 class SuumoSpider:
     def __init__(
-        self, cache: BasePageCache, wait_interval: float = 3.0, use_cache: bool = False
+        self,
+        cache: BasePageCache,
+        wait_interval: float = 3.0,
+        use_cache: bool = False,
+        base_url: str = DEFAULT_BASE_URL,
+        max_retries: int = 3,
+        retry_backoff: float = 2.0,
     ):
+        """
+        :param cache: cache of detail pages
+        :param wait_interval: min seconds between requests
+        :param use_cache: read detail pages from the cache if cached
+        :param base_url: site to crawl, e.g. a local stand-in for load testing
+        :param max_retries: retries of a request on 429, 5xx and connection errors
+        :param retry_backoff: seconds to wait before the first retry, doubled for each retry,
+            Retry-After of the response is respected if it's longer
+        """
         self.use_cache = use_cache
         self.wait_interval = wait_interval
         self.cache = cache
         self.session = requests.session()
         self.session.headers.update({"User-Agent": USER_AGENT})
-        self.base_url = "https://suumo.jp"
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retries = 0
         self._last_request = 0
 
-    def get(self, url: str, *args, **kwargs):
+    def _send(self, url: str, *args, **kwargs) -> requests.Response:
         sleep_time = (self._last_request + self.wait_interval) - time.time()
         if sleep_time > 0:
             time.sleep(sleep_time)
         self._last_request = time.time()
-        return self.session.get(urljoin(self.base_url, url), *args, **kwargs)
+        status = "error"
+        try:
+            with HTTP_REQUEST_SECONDS.time(target="suumo"):
+                resp = self.session.get(urljoin(self.base_url, url), *args, **kwargs)
+            status = str(resp.status_code)
+            return resp
+        finally:
+            HTTP_REQUESTS.inc(target="suumo", status=status)
+
+    def get(self, url: str, *args, **kwargs) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            delay = min(self.retry_backoff * 2**attempt, 60.0)
+            try:
+                resp = self._send(url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt == self.max_retries:
+                    raise ex
+                reason = type(ex).__name__
+            else:
+                if (
+                    resp.status_code not in RETRY_STATUS_CODES
+                    or attempt == self.max_retries
+                ):
+                    return resp
+                reason = str(resp.status_code)
+                retry_after = resp.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            self.retries += 1
+            log.warning(
+                f"Request to {url} failed with {reason}, retry {attempt + 1} in {delay:.1f}s"
+            )
+            time.sleep(delay)
 
     def read_search_page(
         self,
@@ -75,6 +136,11 @@ class SuumoSpider:
         return resp.content
 
     def parse_search_page(self, content: bytes) -> Iterable[dict]:
+        with PARSE_SECONDS.time(kind="suumo_search"):
+            items = list(self._parse_search_page(content))
+        yield from items
+
+    def _parse_search_page(self, content: bytes) -> Iterable[dict]:
         soup = BeautifulSoup(content, XML_PARSER)
         for property_unit in soup.find_all("div", attrs={"class": "property_unit"}):
             title = property_unit.find("h2", attrs={"class": "property_unit-title"})
@@ -88,6 +154,26 @@ class SuumoSpider:
             ]
             yield {"url": url, "title": title.get_text(), "properties": properties}
 
+    def iter_search_results(
+        self, url: str, args: Dict[str, Any], page_size: int = 100
+    ) -> Iterable[dict]:
+        """
+        Read every page of the search result
+        :param url: path of the search, e.g. /ms/chuko/tokyo/city/
+        :param args: query of the search
+        :return: items of parse_search_page
+        """
+        page_id = 1
+        while True:
+            content = self.read_search_page(
+                url, args, page_id=page_id, page_size=page_size
+            )
+            total_pages = self.get_page_count(content)
+            yield from self.parse_search_page(content)
+            if page_id >= total_pages:
+                break
+            page_id += 1
+
     def get_page_count(self, content: bytes) -> int:
         soup = BeautifulSoup(content, XML_PARSER)
         numbers = [
@@ -106,6 +192,9 @@ class SuumoSpider:
         """
         if self.use_cache:
             cache_data = self.cache.get_cache(url)
+            CACHE_LOOKUPS.inc(
+                cache="suumo_page", result="hit" if cache_data else "miss"
+            )
             if cache_data:
                 log.debug(f"Request to {url} hit cache.")
                 return cache_data
@@ -119,6 +208,10 @@ class SuumoSpider:
         return resp.content
 
     def parse_detail_page(self, content: bytes) -> dict:
+        with PARSE_SECONDS.time(kind="suumo_detail"):
+            return self._parse_detail_page(content)
+
+    def _parse_detail_page(self, content: bytes) -> dict:
         content_text = content.decode()
         soup = BeautifulSoup(content, XML_PARSER)
         # Get GPS data
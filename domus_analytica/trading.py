@@ -0,0 +1,61 @@
+"""
+不動産取引価格データの正規化
+"""
+
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+ERA_OFFSETS = {"明治": 1867, "大正": 1911, "昭和": 1925, "平成": 1988, "令和": 2018}
+
+
+def parse_number(s: pd.Series) -> pd.Series:
+    return pd.to_numeric(
+        s.str.replace(",", "", regex=False).str.extract(
+            r"([+-]?\d+(?:\.\d+)?)", expand=False
+        ),
+        errors="coerce",
+    )
+
+
+def parse_year(s: pd.Series) -> pd.Series:
+    """
+    Parse year written in western calendar (2020年) or Japanese era (令和2年, 平成元年)
+    :return: western year, NA if can't be parsed (e.g. 戦前)
+    """
+    s = s.str.replace("元年", "1年", regex=False)
+    western = pd.to_numeric(s.str.extract(r"^(\d{4})年", expand=False), errors="coerce")
+    era = s.str.extract(r"^(明治|大正|昭和|平成|令和)(\d+)年")
+    era_year = pd.to_numeric(era[0].map(ERA_OFFSETS), errors="coerce") + pd.to_numeric(
+        era[1], errors="coerce"
+    )
+    return western.fillna(era_year).astype("Int64")
+
+
+def parse_quarter(s: pd.Series) -> pd.Series:
+    """
+    Parse 2023年第1四半期 to 20231, which is sortable
+    """
+    quarter = pd.to_numeric(
+        s.str.extract(r"第(\d)四半期", expand=False), errors="coerce"
+    )
+    return (parse_year(s) * 10 + quarter).astype("Int64")
+
+
+def structure_bucket(s: pd.Series) -> pd.Series:
+    """
+    Map building structure (ＲＣ, ＳＲＣ, 木造, 鉄骨造...) to build_type of the listings
+    """
+    normalized = s.fillna("").map(lambda x: unicodedata.normalize("NFKC", str(x)))
+    return pd.Series(
+        np.select(
+            [
+                normalized.str.contains("木造", regex=False),
+                normalized.str.contains("RC", regex=False),
+            ],
+            ["wood", "RC"],
+            "other",
+        ),
+        index=s.index,
+    )
@@ -0,0 +1,590 @@
+"""
+不動産取引価格の集計（市区町村・地区・最寄駅 × 構造 × 四半期）
+"""
+
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+import pymongo
+from pydantic import BaseModel
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from domus_analytica.indexes import TRADING_CSV_INDEXES, TRADING_ROLLUP_INDEXES
+from domus_analytica.trading import parse_number, parse_quarter, structure_bucket
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ROLLUP_COLLECTION = "japan_trading_rollup"
+DEFAULT_PROPERTY_TYPES = ["中古マンション等"]
+ALL_STRUCTURES = "*"
+# Columns identifying the location of each level, city_code is always included since names aren't unique
+ROLLUP_LEVELS = {
+    "city": [],
+    "district": ["district_name"],
+    "station": ["nearest_station_name"],
+}
+# Log-spaced histogram of price per sqm (万円), 1万/㎡ to 1000万/㎡
+HIST_EDGES = np.geomspace(1, 1000, 61)
+
+
+def rollup_key(
+    level: str,
+    city_code: str,
+    district_name: Optional[str] = None,
+    station_name: Optional[str] = None,
+) -> str:
+    if level == "city":
+        return city_code
+    elif level == "district":
+        return f"{city_code}|{district_name}"
+    elif level == "station":
+        return f"{city_code}|{station_name}"
+    raise ValueError(f"Unknown rollup level {level}")
+
+
+def histogram_quantile(hist: np.ndarray, q: float) -> float:
+    """
+    Quantile interpolated (in log scale) from a histogram with HIST_EDGES
+    """
+    cumsum = np.cumsum(hist)
+    target = q * cumsum[-1]
+    i = int(np.searchsorted(cumsum, target))
+    i = min(i, len(hist) - 1)
+    before = cumsum[i - 1] if i > 0 else 0
+    ratio = (target - before) / hist[i] if hist[i] > 0 else 0.5
+    log_edges = np.log(HIST_EDGES)
+    return float(np.exp(log_edges[i] + ratio * (log_edges[i + 1] - log_edges[i])))
+
+
+class ComparableSales(BaseModel):
+    count: int
+    mean: float
+    std: float
+    p25: float
+    p50: float
+    p75: float
+    quarter_from: int
+    quarter_to: int
+
+
+def load_csv_records(
+    coll: Collection, year: int, property_types: List[str]
+) -> pd.DataFrame:
+    """
+    Load records imported by import-trading-csv, transaction_quarter is required
+    """
+    df = pd.DataFrame(
+        coll.find(
+            {
+                "transaction_quarter": {"$gte": year * 10, "$lt": (year + 1) * 10},
+                "type": {"$in": property_types},
+            },
+            projection={
+                "_id": False,
+                "city_code": True,
+                "prefecture_name": True,
+                "city_name": True,
+                "district_name": True,
+                "nearest_station_name": True,
+                "building_structure": True,
+                "total_transaction_price": True,
+                "area_in_sqm": True,
+                "transaction_quarter": True,
+            },
+        ),
+        columns=[
+            "city_code",
+            "prefecture_name",
+            "city_name",
+            "district_name",
+            "nearest_station_name",
+            "building_structure",
+            "total_transaction_price",
+            "area_in_sqm",
+            "transaction_quarter",
+        ],
+    )
+    return pd.DataFrame(
+        {
+            # astype(str) would turn a missing code into "00nan", a rollup key
+            "city_code": df["city_code"].astype("string").str.zfill(5),
+            "municipality": df["prefecture_name"] + df["city_name"],
+            "district_name": df["district_name"],
+            "nearest_station_name": df["nearest_station_name"],
+            "structure": structure_bucket(df["building_structure"]),
+            "quarter": df["transaction_quarter"],
+            "price_per_sqm": pd.to_numeric(
+                df["total_transaction_price"], errors="coerce"
+            )
+            / pd.to_numeric(df["area_in_sqm"], errors="coerce")
+            / 10000,
+        }
+    )
+
+
+def load_api_records(
+    coll: Collection, year: int, property_types: List[str]
+) -> pd.DataFrame:
+    """
+    Load records downloaded by import-trading-api, they don't have the nearest station
+    """
+    df = pd.DataFrame(
+        coll.find(
+            {"param_year": year, "Type": {"$in": property_types}},
+            projection={
+                "_id": False,
+                "MunicipalityCode": True,
+                "Prefecture": True,
+                "Municipality": True,
+                "DistrictName": True,
+                "Structure": True,
+                "TradePrice": True,
+                "Area": True,
+                "Period": True,
+            },
+        ),
+        columns=[
+            "MunicipalityCode",
+            "Prefecture",
+            "Municipality",
+            "DistrictName",
+            "Structure",
+            "TradePrice",
+            "Area",
+            "Period",
+        ],
+    ).astype("string")
+    return pd.DataFrame(
+        {
+            "city_code": df["MunicipalityCode"].str.zfill(5),
+            "municipality": df["Prefecture"] + df["Municipality"],
+            "district_name": df["DistrictName"],
+            "nearest_station_name": pd.Series(pd.NA, index=df.index, dtype="string"),
+            "structure": structure_bucket(df["Structure"]),
+            "quarter": parse_quarter(df["Period"]),
+            "price_per_sqm": parse_number(df["TradePrice"])
+            / parse_number(df["Area"])
+            / 10000,
+        }
+    )
+
+
+def aggregate_records(df: pd.DataFrame) -> Iterable[dict]:
+    """
+    Aggregate records to rollup documents of every level, structure and quarter
+    """
+    price = pd.to_numeric(df["price_per_sqm"], errors="coerce").astype(float)
+    # Every rollup key starts with the city code
+    df = df.assign(price_per_sqm=price, price_sq=price**2)[
+        np.isfinite(price)
+        & (price > 0)
+        & df["quarter"].notna()
+        & df["city_code"].notna()
+    ]
+    df = df.assign(
+        quarter=df["quarter"].astype(int),
+        bin=np.clip(
+            np.searchsorted(HIST_EDGES, df["price_per_sqm"]) - 1,
+            0,
+            len(HIST_EDGES) - 2,
+        ),
+    )
+    for level, level_columns in ROLLUP_LEVELS.items():
+        level_df = df.dropna(subset=level_columns)
+        for structure in ("by_structure", ALL_STRUCTURES):
+            if structure == ALL_STRUCTURES:
+                level_df = level_df.assign(structure=ALL_STRUCTURES)
+            keys = ["city_code", *level_columns, "structure", "quarter"]
+            grouped = level_df.groupby(keys, sort=False)
+            stats = grouped.agg(
+                n=("price_per_sqm", "count"),
+                sum=("price_per_sqm", "sum"),
+                sum_sq=("price_sq", "sum"),
+            )
+            quantiles = grouped["price_per_sqm"].quantile([0.25, 0.5, 0.75]).unstack()
+            hists: Dict[tuple, List[List[int]]] = {}
+            for group_bin, count in level_df.groupby([*keys, "bin"]).size().items():
+                hists.setdefault(group_bin[:-1], []).append(
+                    [int(group_bin[-1]), int(count)]
+                )
+            for group_key, row in stats.iterrows():
+                group = dict(zip(keys, group_key))
+                key = rollup_key(
+                    level,
+                    group["city_code"],
+                    group.get("district_name"),
+                    group.get("nearest_station_name"),
+                )
+                q = quantiles.loc[group_key]
+                yield {
+                    "_id": f"{level}|{key}|{group['structure']}|{group['quarter']}",
+                    "level": level,
+                    "key": key,
+                    "structure": group["structure"],
+                    "quarter": int(group["quarter"]),
+                    "n": int(row["n"]),
+                    "sum": float(row["sum"]),
+                    "sum_sq": float(row["sum_sq"]),
+                    "p25": float(q[0.25]),
+                    "p50": float(q[0.5]),
+                    "p75": float(q[0.75]),
+                    # Sparse histogram, [bin, count] pairs
+                    "hist": hists[group_key],
+                }
+
+
+class TradingRollupStore:
+    def __init__(self, db: Database, collection: str = DEFAULT_ROLLUP_COLLECTION):
+        self.coll = db.get_collection(collection)
+        self.state_coll = db.get_collection(f"{collection}_state")
+        # Municipality name (都道府県+市区町村) of each city code, used to locate listings by address
+        self.city_coll = db.get_collection(f"{collection}_city")
+
+    def ensure_indexes(self):
+        self.coll.create_indexes(TRADING_ROLLUP_INDEXES)
+
+    def replace_year(self, year: int, docs: Iterable[dict]) -> int:
+        self.coll.delete_many({"quarter": {"$gte": year * 10, "$lt": (year + 1) * 10}})
+        docs = list(docs)
+        if docs:
+            self.coll.insert_many(docs, ordered=False)
+        return len(docs)
+
+    def save_cities(self, df: pd.DataFrame):
+        cities = df[["city_code", "municipality"]].dropna().drop_duplicates()
+        if len(cities) > 0:
+            self.city_coll.bulk_write(
+                [
+                    ReplaceOne({"_id": code}, {"name": name}, upsert=True)
+                    for code, name in cities.itertuples(index=False)
+                ],
+                ordered=False,
+            )
+
+    def load_cities(self) -> Dict[str, str]:
+        """
+        :return: municipality name -> city code
+        """
+        return {doc["name"]: doc["_id"] for doc in self.city_coll.find()}
+
+    def comparable_sales(
+        self,
+        level: str,
+        key: str,
+        structure: str = ALL_STRUCTURES,
+        quarter_from: Optional[int] = None,
+        quarter_to: Optional[int] = None,
+    ) -> Optional[ComparableSales]:
+        """
+        Statistics of price per sqm (万円) in the location and period
+        :param level: city, district or station
+        :param key: built by rollup_key
+        :param structure: RC, wood, other or * for all
+        :param quarter_from: e.g. 20221 for 2022Q1, inclusive
+        :param quarter_to: e.g. 20234 for 2023Q4, inclusive
+        :return: None if there is no transaction
+        """
+        quarter_filter = {}
+        if quarter_from is not None:
+            quarter_filter["$gte"] = quarter_from
+        if quarter_to is not None:
+            quarter_filter["$lte"] = quarter_to
+        query = {"level": level, "key": key, "structure": structure}
+        if quarter_filter:
+            query["quarter"] = quarter_filter
+        docs = list(self.coll.find(query, projection={"_id": False}))
+        if not docs:
+            return None
+        count = sum(d["n"] for d in docs)
+        mean = sum(d["sum"] for d in docs) / count
+        variance = max(sum(d["sum_sq"] for d in docs) / count - mean**2, 0.0)
+        if len(docs) == 1:
+            p25, p50, p75 = docs[0]["p25"], docs[0]["p50"], docs[0]["p75"]
+        else:
+            hist = np.zeros(len(HIST_EDGES) - 1)
+            for d in docs:
+                for b, c in d["hist"]:
+                    hist[b] += c
+            p25, p50, p75 = (histogram_quantile(hist, q) for q in (0.25, 0.5, 0.75))
+        return ComparableSales(
+            count=count,
+            mean=mean,
+            std=float(np.sqrt(variance)),
+            p25=p25,
+            p50=p50,
+            p75=p75,
+            quarter_from=min(d["quarter"] for d in docs),
+            quarter_to=max(d["quarter"] for d in docs),
+        )
+
+    def latest_quarter(self) -> Optional[int]:
+        for doc in self.coll.find(
+            projection={"quarter": True},
+            sort=[("quarter", pymongo.DESCENDING)],
+            limit=1,
+        ):
+            return doc["quarter"]
+        return None
+
+    def load_frame(
+        self,
+        level: str,
+        structure: str = ALL_STRUCTURES,
+        quarter_from: Optional[int] = None,
+    ) -> pd.DataFrame:
+        """
+        Load rollups of a level as a DataFrame for joining in batch
+        """
+        query: Dict = {"level": level, "structure": structure}
+        if quarter_from is not None:
+            query["quarter"] = {"$gte": quarter_from}
+        return pd.DataFrame(
+            self.coll.find(
+                query,
+                projection={"_id": False, "hist": False, "level": False},
+            ),
+            columns=[
+                "key",
+                "structure",
+                "quarter",
+                "n",
+                "sum",
+                "sum_sq",
+                "p25",
+                "p50",
+                "p75",
+            ],
+        )
+
+
+class TradingRollupBuilder:
+    def __init__(
+        self,
+        store: TradingRollupStore,
+        csv_coll: Optional[Collection] = None,
+        api_coll: Optional[Collection] = None,
+        property_types: Optional[List[str]] = None,
+    ):
+        """
+        Build rollups from japan_trading (CSV) and/or japan_trading_api, they contain the same transactions,
+        so usually only one of them should be used
+        """
+        if csv_coll is None and api_coll is None:
+            raise ValueError("At least one source collection is required")
+        self.store = store
+        self.csv_coll = csv_coll
+        self.api_coll = api_coll
+        self.property_types = property_types or DEFAULT_PROPERTY_TYPES
+
+    def source_counts(self) -> Dict[int, Dict[str, int]]:
+        """
+        Count of source records by year, used to detect years need refreshing
+        """
+        counts: Dict[int, Dict[str, int]] = {}
+        if self.csv_coll is not None:
+            self.csv_coll.create_indexes(TRADING_CSV_INDEXES)
+            for r in self.csv_coll.aggregate(
+                [
+                    {"$match": {"transaction_quarter": {"$type": "number"}}},
+                    {
+                        "$group": {
+                            "_id": {
+                                "$floor": {"$divide": ["$transaction_quarter", 10]}
+                            },
+                            "n": {"$sum": 1},
+                        }
+                    },
+                ]
+            ):
+                counts.setdefault(int(r["_id"]), {})["csv"] = r["n"]
+        if self.api_coll is not None:
+            for r in self.api_coll.aggregate(
+                [{"$group": {"_id": "$param_year", "n": {"$sum": 1}}}]
+            ):
+                counts.setdefault(int(r["_id"]), {})["api"] = r["n"]
+        return counts
+
+    def refresh(self, rebuild: bool = False) -> List[int]:
+        """
+        Rebuild rollups of the years whose source records changed,
+        and remove the ones of the years without source records any more
+        :param rebuild: rebuild all years
+        :return: years rebuilt
+        """
+        self.store.ensure_indexes()
+        states = {s["_id"]: s["counts"] for s in self.store.state_coll.find()}
+        source_counts = self.source_counts()
+        for year in sorted(set(states) - set(source_counts)):
+            self.store.replace_year(year, [])
+            self.store.state_coll.delete_one({"_id": year})
+            log.info(f"Source records of {year} are gone, its rollups removed")
+        if not rebuild and self.store.city_coll.estimated_document_count() == 0:
+            # Rollups built before the city table was added, it's saved by rebuilt years only
+            log.info("City table is empty, rebuilding all years")
+            rebuild = True
+        refreshed = []
+        for year, counts in sorted(source_counts.items()):
+            if not rebuild and states.get(year) == counts:
+                continue
+            frames = []
+            if self.csv_coll is not None:
+                frames.append(
+                    load_csv_records(self.csv_coll, year, self.property_types)
+                )
+            if self.api_coll is not None:
+                frames.append(
+                    load_api_records(self.api_coll, year, self.property_types)
+                )
+            df = pd.concat(frames, ignore_index=True)
+            docs = self.store.replace_year(year, aggregate_records(df))
+            self.store.save_cities(df)
+            self.store.state_coll.replace_one(
+                {"_id": year},
+                {"counts": counts, "update_time": datetime.now()},
+                upsert=True,
+            )
+            log.info(f"{docs} rollups built from {len(df)} records of {year}")
+            refreshed.append(year)
+        return refreshed
+
+
+def quarter_index(quarter: pd.Series) -> pd.Series:
+    """
+    20231 -> continuous quarter index, so that quarters can be subtracted
+    """
+    return (quarter // 10) * 4 + quarter % 10 - 1
+
+
+def resolve_city_code(address: Optional[str], cities: Dict[str, str]) -> Optional[str]:
+    """
+    Find city code by the longest municipality name which is a prefix of the address
+    """
+    if not isinstance(address, str):
+        return None
+    for length in range(len(address), 0, -1):
+        code = cities.get(address[:length])
+        if code is not None:
+            return code
+    return None
+
+
+def resolve_city_codes(addresses: pd.Series, cities: Dict[str, str]) -> pd.Series:
+    return addresses.map(lambda address: resolve_city_code(address, cities))
+
+
+def summarize_rollups(frame: pd.DataFrame, window: int) -> pd.DataFrame:
+    """
+    Summarize rollups of each key into comparable sales features
+    :param frame: loaded by TradingRollupStore.load_frame
+    :param window: count of quarters for the recent period, trend compares it with the period before it
+    :return: DataFrame indexed by key with price_median, volume and trend
+    """
+    if len(frame) == 0:
+        return pd.DataFrame(columns=["price_median", "volume", "trend"])
+    qi = quarter_index(frame["quarter"])
+    latest = qi.max()
+    recent = frame[qi > latest - window]
+    previous = frame[(qi <= latest - window) & (qi > latest - 2 * window)]
+    recent_sum = recent.groupby("key")[["n", "sum"]].sum()
+    previous_sum = previous.groupby("key")[["n", "sum"]].sum()
+    return pd.DataFrame(
+        {
+            # Median of quarters weighted by transactions, close enough as a feature
+            "price_median": (recent["p50"] * recent["n"]).groupby(recent["key"]).sum()
+            / recent_sum["n"],
+            "volume": recent_sum["n"],
+            "trend": (recent_sum["sum"] / recent_sum["n"])
+            / (previous_sum["sum"] / previous_sum["n"])
+            - 1,
+        }
+    )
+
+
+class ComparableSalesSummary(BaseModel, arbitrary_types_allowed=True):
+    # municipality name -> city code
+    cities: Dict[str, str]
+    # level -> comps_{level}_{price_median,volume,trend} indexed by key
+    levels: Dict[str, pd.DataFrame]
+
+    @staticmethod
+    def load(store: TradingRollupStore, window: int = 4) -> "ComparableSalesSummary":
+        """
+        Load and summarize the rollups of the recent 2 * window quarters
+        :param store: rollups
+        :param window: count of quarters for the recent period
+        """
+        latest = store.latest_quarter()
+        quarter_from = None
+        if latest is not None:
+            start = latest // 10 * 4 + latest % 10 - 1 - 2 * window + 1
+            quarter_from = start // 4 * 10 + start % 4 + 1
+        return ComparableSalesSummary(
+            cities=store.load_cities(),
+            levels={
+                level: summarize_rollups(
+                    store.load_frame(level, quarter_from=quarter_from), window
+                ).add_prefix(f"comps_{level}_")
+                for level in ("city", "station")
+            },
+        )
+
+    def lookup(self, address: Optional[str], station_name: Optional[str]) -> dict:
+        """
+        Comparable sales features of one listing, same as join but without DataFrame operations
+        """
+        city_code = resolve_city_code(address, self.cities)
+        result = {}
+        if city_code is None:
+            return result
+        for level, key in (
+            ("city", city_code),
+            ("station", f"{city_code}|{station_name}" if station_name else None),
+        ):
+            frame = self.levels[level]
+            if key is not None and key in frame.index:
+                result.update(frame.loc[key].to_dict())
+        return result
+
+    def join(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        :param df: listing table with address and nearest_station_name
+        :return: the table with comps_{city,station}_{price_median,volume,trend}
+        """
+        if len(df) == 0:
+            return df
+        df = df.assign(
+            city_code=resolve_city_codes(df["address"], self.cities).astype("string")
+        )
+        station_key = (
+            df["city_code"] + "|" + df["nearest_station_name"].astype("string")
+            if "nearest_station_name" in df.columns
+            else pd.Series(pd.NA, index=df.index, dtype="string")
+        )
+        for level, join_key in (("city", df["city_code"]), ("station", station_key)):
+            df = df.join(
+                self.levels[level]
+                .reindex(join_key.astype(object))
+                .set_axis(df.index, axis=0)
+            )
+        return df
+
+
+def add_comparable_sales_features(
+    df: pd.DataFrame, store: TradingRollupStore, window: int = 4
+) -> pd.DataFrame:
+    """
+    Join comparable sales of the municipality and the nearest station to the listing table,
+    only the pre-aggregated rollups are loaded so it costs a few queries in total
+    :param df: listing table with address and nearest_station_name
+    :param store: rollups
+    :param window: count of quarters for the recent period
+    :return: the table with comps_{city,station}_{price_median,volume,trend}
+    """
+    if len(df) == 0:
+        return df
+    return ComparableSalesSummary.load(store, window).join(df)
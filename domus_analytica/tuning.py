@@ -0,0 +1,265 @@
+"""
+XGBoostのハイパーパラメータ探索
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import xgboost as xgb
+from pydantic import BaseModel
+from sklearn.model_selection import KFold
+
+from domus_analytica.model import DEFAULT_PARAMS, FeatureMatrix, split_indices
+
+log = logging.getLogger(__name__)
+
+
+class Trial(BaseModel):
+    trial_id: int
+    params: dict
+    # Mean RMSE of validation folds at each fold, used for pruning other trials
+    running_rmse: List[float]
+    rmse: float
+    best_rounds: int
+    pruned: bool
+    seconds: float
+
+
+def sample_params(seed: int, trial_id: int) -> dict:
+    """
+    Parameters of a trial, the same trial always gets the same parameters so that a search can resume
+    """
+    rng = np.random.default_rng([seed, trial_id])
+    return dict(
+        DEFAULT_PARAMS,
+        max_depth=int(rng.integers(3, 11)),
+        learning_rate=float(np.exp(rng.uniform(np.log(0.01), np.log(0.3)))),
+        min_child_weight=float(np.exp(rng.uniform(0, np.log(20)))),
+        subsample=float(rng.uniform(0.5, 1.0)),
+        colsample_bytree=float(rng.uniform(0.5, 1.0)),
+        reg_lambda=float(np.exp(rng.uniform(np.log(0.1), np.log(10)))),
+    )
+
+
+# Data of the worker process, the matrix is memory-mapped so workers share its pages
+_worker: Dict = {}
+
+
+def _init_worker(matrix_dir: str, folds: int, seed: int, nthread: int):
+    x = np.load(Path(matrix_dir) / "x.npy", mmap_mode="r")
+    y = np.load(Path(matrix_dir) / "y.npy", mmap_mode="r")
+    with open(Path(matrix_dir) / "features.json", "r") as fp:
+        features = json.load(fp)
+    _worker.update(
+        x=x,
+        y=y,
+        features=features,
+        folds=list(
+            KFold(n_splits=folds, shuffle=True, random_state=seed).split(
+                np.arange(len(y))
+            )
+        ),
+        nthread=nthread,
+        dmatrices={},
+    )
+
+
+def _fold_matrices(fold: int) -> Tuple[xgb.DMatrix, xgb.DMatrix]:
+    # Built once per worker and reused by all the trials it runs
+    if fold not in _worker["dmatrices"]:
+        train_idx, val_idx = _worker["folds"][fold]
+        x, y, features = _worker["x"], _worker["y"], _worker["features"]
+        dtrain = xgb.QuantileDMatrix(x[train_idx], y[train_idx], feature_names=features)
+        dval = xgb.QuantileDMatrix(
+            x[val_idx], y[val_idx], feature_names=features, ref=dtrain
+        )
+        _worker["dmatrices"][fold] = (dtrain, dval)
+    return _worker["dmatrices"][fold]
+
+
+def _run_trial(
+    trial_id: int,
+    params: dict,
+    num_boost_round: int,
+    early_stopping_rounds: int,
+    prune_thresholds: List[float],
+) -> Trial:
+    start = time.perf_counter()
+    scores, rounds, running = [], [], []
+    pruned = False
+    for fold in range(len(_worker["folds"])):
+        dtrain, dval = _fold_matrices(fold)
+        booster = xgb.train(
+            dict(params, nthread=_worker["nthread"]),
+            dtrain,
+            num_boost_round=num_boost_round,
+            evals=[(dval, "val")],
+            early_stopping_rounds=early_stopping_rounds,
+            verbose_eval=False,
+        )
+        scores.append(booster.best_score)
+        rounds.append(booster.best_iteration + 1)
+        running.append(float(np.mean(scores)))
+        if fold < len(prune_thresholds) and running[-1] > prune_thresholds[fold]:
+            pruned = True
+            break
+    return Trial(
+        trial_id=trial_id,
+        params=params,
+        running_rmse=running,
+        rmse=running[-1],
+        best_rounds=int(np.mean(rounds)),
+        pruned=pruned,
+        seconds=time.perf_counter() - start,
+    )
+
+
+class HyperparameterSearch:
+    def __init__(
+        self,
+        study_dir: str,
+        folds: int = 5,
+        workers: int = 2,
+        num_boost_round: int = 1000,
+        early_stopping_rounds: int = 20,
+        min_trials_to_prune: int = 5,
+        seed: int = 0,
+    ):
+        """
+        Random search with K-fold cross validation on the train and validation sets,
+        test set from split_indices is left untouched
+        :param study_dir: directory for the shared matrix and trials.jsonl, reuse it to resume
+        :param folds: count of CV folds
+        :param workers: count of worker processes, cores are divided among them
+        :param num_boost_round: max boosting rounds, usually stopped earlier
+        :param early_stopping_rounds: stop boosting if validation RMSE doesn't improve
+        :param min_trials_to_prune: a trial is stopped if its RMSE is worse than the median of finished trials
+            after the same fold, when there are this many finished trials
+        :param seed: seed of sampling parameters and splitting folds
+        """
+        self.study_dir = Path(study_dir)
+        self.folds = folds
+        self.workers = workers
+        self.num_boost_round = num_boost_round
+        self.early_stopping_rounds = early_stopping_rounds
+        self.min_trials_to_prune = min_trials_to_prune
+        self.seed = seed
+
+    @property
+    def trials_path(self) -> Path:
+        return self.study_dir / "trials.jsonl"
+
+    def load_trials(self) -> List[Trial]:
+        if not self.trials_path.is_file():
+            return []
+        with open(self.trials_path, "r") as fp:
+            return [Trial.model_validate_json(line) for line in fp if line.strip()]
+
+    def check_study(self, matrix: FeatureMatrix):
+        """
+        Trials are comparable only if they were run on the same data and folds
+        """
+        study = {
+            "rows": len(matrix.y),
+            "features": matrix.features,
+            "folds": self.folds,
+            "seed": self.seed,
+        }
+        study_path = self.study_dir / "study.json"
+        if study_path.is_file():
+            with open(study_path, "r") as fp:
+                if json.load(fp) != study:
+                    raise ValueError(
+                        f"{self.study_dir} was created with other data or folds, use another directory"
+                    )
+        else:
+            self.study_dir.mkdir(parents=True, exist_ok=True)
+            with open(study_path, "w") as fp:
+                json.dump(study, fp)
+
+    def prepare_matrix(self, matrix: FeatureMatrix) -> Path:
+        """
+        Save the rows for CV as plain .npy files, which can be memory-mapped by workers
+        """
+        matrix_dir = self.study_dir / "matrix"
+        matrix_dir.mkdir(parents=True, exist_ok=True)
+        train_idx, val_idx, _ = split_indices(len(matrix.y))
+        rows = np.sort(np.concatenate([train_idx, val_idx]))
+        np.save(matrix_dir / "x.npy", np.ascontiguousarray(matrix.x[rows]))
+        np.save(matrix_dir / "y.npy", np.ascontiguousarray(matrix.y[rows]))
+        with open(matrix_dir / "features.json", "w") as fp:
+            json.dump(matrix.features, fp)
+        return matrix_dir
+
+    def prune_thresholds(self, trials: List[Trial]) -> List[float]:
+        finished = [t for t in trials if not t.pruned]
+        if len(finished) < self.min_trials_to_prune:
+            return []
+        return [
+            float(np.median([t.running_rmse[fold] for t in finished]))
+            for fold in range(self.folds - 1)
+        ]
+
+    def run(self, matrix: FeatureMatrix, n_trials: int) -> List[Trial]:
+        """
+        Run until there are n_trials trials in study_dir
+        :return: all trials of the study
+        """
+        self.check_study(matrix)
+        trials = self.load_trials()
+        done = {t.trial_id for t in trials}
+        pending = [i for i in range(n_trials) if i not in done]
+        log.info(f"{len(done)} trials finished before, {len(pending)} to run")
+        if not pending:
+            return trials
+        matrix_dir = self.prepare_matrix(matrix)
+        nthread = max((os.cpu_count() or 1) // self.workers, 1)
+        with ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(str(matrix_dir), self.folds, self.seed, nthread),
+        ) as executor, open(self.trials_path, "a") as fp:
+            running = set()
+
+            def submit():
+                trial_id = pending.pop(0)
+                running.add(
+                    executor.submit(
+                        _run_trial,
+                        trial_id,
+                        sample_params(self.seed, trial_id),
+                        self.num_boost_round,
+                        self.early_stopping_rounds,
+                        self.prune_thresholds(trials),
+                    )
+                )
+
+            while pending and len(running) < self.workers:
+                submit()
+            while running:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    trial = future.result()
+                    # Appended as soon as it finishes, so an interrupted search loses running trials only
+                    fp.write(trial.model_dump_json() + "\n")
+                    fp.flush()
+                    trials.append(trial)
+                    log.info(
+                        f"Trial {trial.trial_id} {'pruned' if trial.pruned else 'finished'} "
+                        f"in {trial.seconds:.1f}s, RMSE={trial.rmse:.4f} "
+                        f"rounds={trial.best_rounds}"
+                    )
+                    if pending:
+                        submit()
+        return trials
+
+
+def best_trial(trials: List[Trial]) -> Optional[Trial]:
+    finished = [t for t in trials if not t.pruned]
+    return min(finished, key=lambda t: t.rmse) if finished else None
@@ -0,0 +1,208 @@
+"""
+物件価格のオンライン評価サービス
+"""
+
+import json
+import logging
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple, Union
+
+import xgboost as xgb
+
+from domus_analytica.config import DomusSettings
+from domus_analytica.data_clean import gis_features, parse_listing
+from domus_analytica.geopoint import GeoPoint
+from domus_analytica.model import (
+    ModelArtifact,
+    feature_vector,
+    finite_or_none,
+    preprocess_record,
+)
+from domus_analytica.mongo import get_database
+from domus_analytica.poi_index import PoiIndex
+from domus_analytica.poi_raster import PoiRasters, RasterPoiStore
+from domus_analytica.poi_snapshot import PoiSnapshot
+from domus_analytica.poi_store import PoiStore
+from domus_analytica.spider import MongoDBPageCache, SuumoSpider
+from domus_analytica.trading_rollup import ComparableSalesSummary, TradingRollupStore
+
+log = logging.getLogger(__name__)
+
+
+class ValuationService:
+    def __init__(
+        self,
+        artifact: ModelArtifact,
+        poi_index: Union[PoiIndex, PoiSnapshot, RasterPoiStore],
+        comps: ComparableSalesSummary,
+        spider: Optional[SuumoSpider] = None,
+    ):
+        """
+        Value listings with everything needed kept in memory, nothing is queried per request
+        except the page cache when a SUUMO URL is given
+        :param artifact: trained model
+        :param poi_index: POI for GIS features, in memory or memory-mapped
+        :param comps: summarized comparable sales
+        :param spider: reads SUUMO detail pages, None to disable valuing by URL
+        """
+        self.artifact = artifact
+        self.poi_index = poi_index
+        self.comps = comps
+        self.spider = spider
+
+    @staticmethod
+    def load(config: DomusSettings, model_path: str) -> "ValuationService":
+        domus_db = get_database(config.mongo_uri, config.mongo_db_name, config)
+        poi_index: Union[PoiIndex, PoiSnapshot, RasterPoiStore] = (
+            PoiSnapshot(config.poi_snapshot_dir)
+            if config.poi_snapshot_dir
+            else PoiIndex.load(
+                PoiStore(
+                    domus_db,
+                    layout=config.poi_storage_layout,
+                    base_collection=config.poi_collection,
+                ),
+                batch_size=config.mongo_batch_size,
+            )
+        )
+        if config.poi_raster_dir:
+            poi_index = RasterPoiStore(poi_index, PoiRasters(config.poi_raster_dir))
+        return ValuationService(
+            artifact=ModelArtifact.load(model_path),
+            poi_index=poi_index,
+            comps=ComparableSalesSummary.load(TradingRollupStore(domus_db)),
+            spider=SuumoSpider(
+                cache=MongoDBPageCache(config.mongo_uri, db_name=config.mongo_db_name),
+                use_cache=True,
+            ),
+        )
+
+    def listing_from_url(self, url: str) -> Tuple[dict, Optional[GeoPoint]]:
+        """
+        :param url: SUUMO detail page, e.g. /ms/chuko/fukuoka/sc_fukuokashihakata/nc_74582921/
+        :return: listing attributes and location
+        """
+        if self.spider is None:
+            raise ValueError("Valuing by URL is not enabled")
+        doc = self.spider.parse_detail_page(self.spider.read_detail_page(url))
+        doc["search_details"] = {"url": url, "title": ""}
+        location = GeoPoint.parse_obj(doc["gps"]) if "gps" in doc else None
+        return parse_listing(doc), location
+
+    def value(self, listing: dict, location: Optional[GeoPoint]) -> dict:
+        """
+        :param listing: attributes in the same form as extract_info_to_table
+        :param location: location of the listing, GIS features are missing if None
+        :return: estimation with feature values and their contributions
+        """
+        row = dict(listing)
+        if location is not None:
+            row.update(gis_features(self.poi_index, location))
+        row.update(
+            self.comps.lookup(row.get("address"), row.get("nearest_station_name"))
+        )
+        row = preprocess_record(row)
+        features = self.artifact.features
+        # SHAP values, their sum is the prediction
+        contributions = self.artifact.booster.predict(
+            xgb.DMatrix(feature_vector(row, features), feature_names=features),
+            pred_contribs=True,
+        )[0]
+        unit_price = float(contributions.sum())
+        exclusive_area = finite_or_none(row.get("exclusive_area") or math.nan)
+        price_estimate = (
+            unit_price * exclusive_area if exclusive_area is not None else None
+        )
+        price = finite_or_none(row["price"]) if row.get("price") else None
+        return {
+            "model_version": self.artifact.version,
+            "unit_price_estimate": unit_price,
+            "price_estimate": price_estimate,
+            "cp_value": (
+                price_estimate * 100 / price
+                if price_estimate is not None and price
+                else None
+            ),
+            "features": {
+                name: finite_or_none(row[name])
+                for name in features
+                if row.get(name) is not None
+            },
+            "contributions": dict(
+                zip(features + ["bias"], (float(c) for c in contributions))
+            ),
+        }
+
+    def handle(self, request: dict) -> dict:
+        """
+        :param request: {"url": SUUMO detail URL} or {"latitude": .., "longitude": .., **listing}
+        """
+        if "url" in request:
+            listing, location = self.listing_from_url(request["url"])
+        else:
+            listing = {
+                k: v for k, v in request.items() if k not in ("latitude", "longitude")
+            }
+            location = (
+                GeoPoint(latitude=request["latitude"], longitude=request["longitude"])
+                if "latitude" in request and "longitude" in request
+                else None
+            )
+        return self.value(listing, location)
+
+
+class ValuationRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, so clients don't pay a TCP handshake per request
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't wait for the delayed ACK between them
+    disable_nagle_algorithm = True
+    server: "ValuationServer"
+
+    def _send_json(self, status: int, body: Dict):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(
+                200,
+                {"status": "ok", "model_version": self.server.service.artifact.version},
+            )
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path != "/valuation":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(body)
+            if not isinstance(request, dict):
+                raise ValueError("Request should be a JSON object")
+        except ValueError as ex:
+            self._send_json(400, {"error": str(ex)})
+            return
+        try:
+            self._send_json(200, self.server.service.handle(request))
+        except (ValueError, KeyError, TypeError) as ex:
+            self._send_json(400, {"error": repr(ex)})
+        except Exception as ex:
+            log.error(f"Failed to value {request}", exc_info=ex)
+            self._send_json(500, {"error": repr(ex)})
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class ValuationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service: ValuationService, host: str, port: int):
+        super().__init__((host, port), ValuationRequestHandler)
+        self.service = service